@@ -12,6 +12,7 @@ these functions:
   - erf_psycho_2gammas: erf function from 0 to 1, with two lapse rates
 Functions in the toolbox are:
   - mle_fit_psycho:     Maximumum likelihood fit of psychometric function
+  - mle_fit_psycho_batch: Maximumum likelihood fit of many datasets at once
   - neg_likelihood:      Negative likelihood of a psychometric function
 For more info, see:
   - Examples:           Examples of use of psychofit toolbox
@@ -101,6 +102,197 @@ def mle_fit_psycho(data, P_model='weibull', parstart=None, parmin=None, parmax=N
     return pars[iBestFit, :], L
 
 
+def mle_fit_psycho_batch(data, P_model='weibull', parstart=None, parmin=None, parmax=None, nfits=5):
+    """
+    Maximumum likelihood fit of a psychometric function to many datasets at once.
+    The Nelder-Mead simplex iterations of mle_fit_psycho are vectorized over all datasets and
+    random restarts: each iteration evaluates the likelihood of every fit in a single array
+    operation instead of one optimisation per dataset and restart.
+    Args:
+        data: list of 3 x n matrices, see mle_fit_psycho. The number of stim levels may
+              differ between datasets
+        P_model: The psychometric function, see mle_fit_psycho
+        parstart: Starting parameters, either shared by all datasets or a k x n_pars matrix,
+                  e.g. the parameters of the previous session as a warm start.  Rows containing
+                  NaNs and None use the mle_fit_psycho defaults of the dataset
+        parmin: Minimum parameter values, vector or k x n_pars matrix.  If None, the
+                mle_fit_psycho defaults are used
+        parmax: Maximum parameter values, vector or k x n_pars matrix.  If None, the
+                mle_fit_psycho defaults are used
+        nfits: The number of fits per dataset, the first one starts at parstart, the others
+               at random parameters within the bounds
+    Returns:
+        pars: k x n_pars matrix of the parameters from the best of the fits of each dataset
+        L: vector of the likelihoods of the best fits
+    Examples:
+        Fit the left and right block psychometric curves of a session together
+        >>> pars, L = mle_fit_psycho_batch([data_20, data_80], 'erf_psycho_2gammas')
+    """
+    k = len(data)
+    npars = 4 if P_model.endswith('2gammas') else 3
+    if k == 0:
+        return np.empty((0, npars)), np.empty(0)
+    data = [np.asarray(d, dtype=float) for d in data]
+    if any(d.ndim != 2 or d.shape[0] != 3 for d in data):
+        raise ValueError('data must be m by 3 matrices')
+
+    # pad the datasets to the same number of stim levels, missing conditions have no trials
+    nmax = max(d.shape[1] for d in data)
+    xx, nn, pp = (np.zeros((k, nmax)) for _ in range(3))
+    for i, d in enumerate(data):
+        ii = np.isfinite(d[2, :])
+        xx[i, :np.sum(ii)], nn[i, :np.sum(ii)], pp[i, :np.sum(ii)] = d[:, ii]
+    xmin = np.array([np.min(d[0, :]) for d in data])
+    xmax = np.array([np.max(d[0, :]) for d in data])
+    xmean = np.array([np.mean(d[0, :]) for d in data])
+
+    def per_dataset(pars, default):
+        if pars is None:
+            return default
+        pars = np.broadcast_to(np.asarray(pars, dtype=float), (k, npars)).copy()
+        inan = np.any(np.isnan(pars), axis=1)
+        pars[inan] = default[inan]
+        return pars
+
+    rep = [.05] * (npars - 2)
+    parstart = per_dataset(parstart, np.c_[xmean, np.full(k, 3.), np.tile(rep, (k, 1))])
+    parmin = per_dataset(parmin, np.c_[xmin, np.zeros((k, npars - 1))])
+    parmax = per_dataset(parmax, np.c_[xmax, np.full(k, 10.), np.full((k, npars - 2), .4)])
+
+    # stack the restarts of all datasets: fit i is for dataset i % k
+    x0 = np.concatenate([parstart] + [parmin + np.random.rand(k, npars) * (parmax - parmin)
+                                      for _ in range(nfits - 1)])
+    ifit = np.tile(np.arange(k), nfits)
+    xx, nn, pp, parmin, parmax = (a[ifit] for a in (xx, nn, pp, parmin, parmax))
+
+    def f(pars, rows):
+        return _neg_likelihood_batch(pars, xx[rows], nn[rows], pp[rows], P_model, parmin[rows], parmax[rows])
+
+    pars, nll = _fmin_batch(f, x0)
+    ibest = np.argmin(nll.reshape(nfits, k), axis=0) * k + np.arange(k)
+    return pars[ibest], -nll[ibest]
+
+
+def _neg_likelihood_batch(pars, xx, nn, pp, P_model, parmin, parmax):
+    """
+    Negative likelihoods of m psychometric fits, see neg_likelihood.
+    :param pars: m x n_pars parameters
+    :param xx, nn, pp: m x n stim levels, number of trials and proportions
+    :param parmin, parmax: m x n_pars parameter bounds
+    :return: vector of m negative likelihoods
+    """
+    dispatcher = {
+        'weibull': weibull,
+        'weibull50': weibull50,
+        'erf_psycho': erf_psycho,
+        'erf_psycho_2gammas': erf_psycho_2gammas
+    }
+    if P_model not in dispatcher:
+        raise ValueError('invalid model, options are "weibull", ' +
+                         '"weibull50", "erf_psycho" and "erf_psycho_2gammas"')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the model functions unpack the parameters along the first dimension
+        probs = dispatcher[P_model](pars.T[:, :, np.newaxis], xx)
+        probs[probs == 0] = np.finfo(float).eps
+        probs[probs == 1] = 1 - np.finfo(float).eps
+        terms = nn * (pp * np.log(probs) + (1 - pp) * np.log(1 - probs))
+    # sequential sum as the builtin sum of neg_likelihood, so that both round identically
+    ll = - functools.reduce(np.add, terms.T)
+    # here is where you effectively put the constraints.
+    ll[np.any(pars < parmin, axis=1) | np.any(pars > parmax, axis=1)] = 10000000
+    return ll
+
+
+def _fmin_batch(fun, x0, xatol=1e-4, fatol=1e-4, maxiter=None, maxfun=None):
+    """
+    Nelder-Mead minimisation of k independent problems, following scipy.optimize.fmin. The
+    simplices of all problems are updated together until each one converges or exhausts its
+    number of iterations or function evaluations.
+    :param fun: fun(x, rows) returns the m objective values for parameters x (m x n) of the
+     problems indexed by rows
+    :param x0: k x n starting points
+    :param xatol, fatol: absolute tolerances on the parameters and objective, as in fmin
+    :param maxiter: maximum number of iterations, defaults to 200 * n
+    :param maxfun: maximum number of function evaluations per problem, defaults to 200 * n
+    :return: k x n minimisers, vector of k minima
+    """
+    rho, chi, psi, sigma = 1, 2, 0.5, 0.5
+    k, n = x0.shape
+    maxiter = maxiter or 200 * n
+    maxfun = maxfun or 200 * n
+    # initial simplices: 5 % perturbation of each parameter
+    sim = np.repeat(np.asarray(x0, dtype=float)[:, np.newaxis, :], n + 1, axis=1)
+    for j in range(n):
+        sim[:, j + 1, j] = np.where(sim[:, j + 1, j] != 0, sim[:, j + 1, j] * 1.05, 0.00025)
+    fsim = np.stack([fun(sim[:, j], np.arange(k)) for j in range(n + 1)], axis=1)
+    fcalls = np.full(k, n + 1)
+
+    def sort(s, fs):
+        order = np.argsort(fs, axis=1)  # same sort kind as fmin to break ties identically
+        return np.take_along_axis(s, order[:, :, np.newaxis], axis=1), np.take_along_axis(fs, order, axis=1)
+
+    def budget(i):
+        # as fmin, a problem stops at the first evaluation exceeding maxfun, leaving its step incomplete
+        can = fcalls[active[i]] < maxfun
+        fcalls[active[i[can]]] += 1
+        aborted[i[~can]] = True
+        return i[can]
+
+    sim, fsim = sort(sim, fsim)
+    active = np.arange(k)
+    # as fmin, the iteration count starts at 1
+    for _ in range(1, maxiter):
+        converged = ((np.max(np.abs(sim[active, 1:] - sim[active, :1]), axis=(1, 2)) <= xatol) &
+                     (np.max(np.abs(fsim[active, 1:] - fsim[active, :1]), axis=1) <= fatol))
+        active = active[~converged & (fcalls[active] < maxfun)]
+        if active.size == 0:
+            break
+        s, fs = sim[active], fsim[active]
+        xbar = np.mean(s[:, :-1], axis=1)
+        worst = s[:, -1]
+        xnew = (1 + rho) * xbar - rho * worst  # reflection
+        fxr = fun(xnew, active)
+        fcalls[active] += 1
+        fnew = fxr.copy()
+        shrink, aborted = (np.zeros(active.size, dtype=bool) for _ in range(2))
+        # expansion
+        iexp = budget(np.where(fxr < fs[:, 0])[0])
+        if iexp.size:
+            xe = (1 + rho * chi) * xbar[iexp] - rho * chi * worst[iexp]
+            fxe = fun(xe, active[iexp])
+            ok = fxe < fxr[iexp]
+            xnew[iexp[ok]], fnew[iexp[ok]] = xe[ok], fxe[ok]
+        # outside contraction
+        ico = budget(np.where((fxr >= fs[:, -2]) & (fxr < fs[:, -1]))[0])
+        if ico.size:
+            xc = (1 + psi * rho) * xbar[ico] - psi * rho * worst[ico]
+            fxc = fun(xc, active[ico])
+            ok = fxc <= fxr[ico]
+            xnew[ico[ok]], fnew[ico[ok]] = xc[ok], fxc[ok]
+            shrink[ico[~ok]] = True
+        # inside contraction
+        ici = budget(np.where(fxr >= fs[:, -1])[0])
+        if ici.size:
+            xcc = (1 - psi) * xbar[ici] + psi * worst[ici]
+            fxcc = fun(xcc, active[ici])
+            ok = fxcc < fs[ici, -1]
+            xnew[ici[ok]], fnew[ici[ok]] = xcc[ok], fxcc[ok]
+            shrink[ici[~ok]] = True
+        keep = ~shrink & ~aborted
+        s[keep, -1], fs[keep, -1] = xnew[keep], fnew[keep]
+        # shrink, one vertex at a time as a problem may run out of evaluations midway
+        ish = np.where(shrink)[0]
+        for j in range(1, n + 1):
+            if ish.size == 0:
+                break
+            s[ish, j] = s[ish, 0] + sigma * (s[ish, j] - s[ish, 0])
+            ish = budget(ish)
+            if ish.size:
+                fs[ish, j] = fun(s[ish, j], active[ish])
+        sim[active], fsim[active] = sort(s, fs)
+    return sim[:, 0], fsim[:, 0]
+
+
 def neg_likelihood(pars, data, P_model='weibull', parmin=None, parmax=None):
     """
     Negative likelihood of a psychometric function.
@@ -83,8 +83,30 @@ def get_lab_training_status(lab, date=None, details=True, one=None):
     one = one or ONE()
     subj_lab = one.alyx.rest('subjects', 'list', lab=lab, alive=True, water_restricted=True)
     subjects = [subj['nickname'] for subj in subj_lab]
+    sessions = {}
     for subj in subjects:
-        get_subject_training_status(subj, date=date, details=details, one=one)
+        trials, task_protocol, ephys_sess, n_delay = get_sessions(subj, date=date, one=one)
+        if trials:
+            sessions[subj] = (trials, task_protocol, ephys_sess, n_delay)
+
+    # Fit the psychometric curves of all subjects at once
+    trials_all, blocks, keys = [], [], []
+    for subj, (trials, task_protocol, _, _) in sessions.items():
+        if np.any(np.array(task_protocol) == 'training'):
+            fits = [('psych', None)]
+        else:
+            fits = [('psych_20', 0.2), ('psych_80', 0.8)]
+        for key, block in fits:
+            trials_all.append(concatenate_trials(trials))
+            blocks.append(block)
+            keys.append((subj, key))
+    psychs = {subj: Bunch() for subj in sessions}
+    for (subj, key), psych in zip(keys, compute_psychometric_batch(trials_all, blocks=blocks)):
+        psychs[subj][key] = psych
+
+    for subj, (trials, task_protocol, ephys_sess, n_delay) in sessions.items():
+        _display_subject_training_status(subj, trials, task_protocol, ephys_sess, n_delay, details=details,
+                                         psychs=psychs[subj])
 
 
 def get_subject_training_status(subj, date=None, details=True, one=None):
@@ -106,8 +128,13 @@ def get_subject_training_status(subj, date=None, details=True, one=None):
     trials, task_protocol, ephys_sess, n_delay = get_sessions(subj, date=date, one=one)
     if not trials:
         return
+    _display_subject_training_status(subj, trials, task_protocol, ephys_sess, n_delay, details=details)
+
+
+def _display_subject_training_status(subj, trials, task_protocol, ephys_sess, n_delay, details=True, psychs=None):
+    """Computes and displays the training status of a subject from the output of get_sessions"""
     sess_dates = list(trials.keys())
-    status, info = get_training_status(trials, task_protocol, ephys_sess, n_delay)
+    status, info = get_training_status(trials, task_protocol, ephys_sess, n_delay, psychs=psychs)
 
     if details:
         if np.any(info.get('psych')):
@@ -223,7 +250,7 @@ def get_sessions(subj, date=None, one=None):
     return trials, task_protocol, ephys_sess_dates, n_delay
 
 
-def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay):
+def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay, psychs=None):
     """
     Compute training status of a subject from three consecutive training datasets
 
@@ -236,6 +263,9 @@ def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay):
     :type ephys_sess_dates: list of strings
     :param n_delay: number of sessions on ephys rig with delay before start > 15 min
     :type n_delay: int
+    :param psychs: optional psychometric fit parameters already computed on the concatenated
+    trials, e.g. by compute_psychometric_batch, with keys 'psych' or 'psych_20' and 'psych_80'
+    :type psychs: dict
     :returns:
         - status - training status of subject
         - info - Bunch containing performance metrics that decide training status e.g performance
@@ -243,13 +273,14 @@ def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay):
     """
 
     info = Bunch()
+    psychs = psychs or {}
     trials_all = concatenate_trials(trials)
 
     # Case when all sessions are trainingChoiceWorld
     if np.all(np.array(task_protocol) == 'training'):
         signed_contrast = get_signed_contrast(trials_all)
         (info.perf_easy, info.n_trials,
-         info.psych, info.rt) = compute_training_info(trials, trials_all)
+         info.psych, info.rt) = compute_training_info(trials, trials_all, psych=psychs.get('psych'))
         if not np.any(signed_contrast == 0):
             status = 'in training'
         else:
@@ -267,7 +298,7 @@ def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay):
             np.any(np.array(task_protocol) == 'training'):
         status = 'trained 1b'
         (info.perf_easy, info.n_trials,
-         info.psych, info.rt) = compute_training_info(trials, trials_all)
+         info.psych, info.rt) = compute_training_info(trials, trials_all, psych=psychs.get('psych'))
 
         return status, info
 
@@ -276,7 +307,8 @@ def get_training_status(trials, task_protocol, ephys_sess_dates, n_delay):
 
         (info.perf_easy, info.n_trials,
          info.psych_20, info.psych_80,
-         info.rt) = compute_bias_info(trials, trials_all)
+         info.rt) = compute_bias_info(trials, trials_all, psych_20=psychs.get('psych_20'),
+                                      psych_80=psychs.get('psych_80'))
         # We are still on training rig and so all sessions should be biased
         if len(ephys_sess_dates) == 0:
             assert np.all(np.array(task_protocol) == 'biased')
@@ -381,7 +413,7 @@ def concatenate_trials(trials):
     return trials_all
 
 
-def compute_training_info(trials, trials_all):
+def compute_training_info(trials, trials_all, psych=None):
     """
     Compute all relevant performance metrics for when subject is on trainingChoiceWorld
 
@@ -390,6 +422,8 @@ def compute_training_info(trials, trials_all):
     :type trials: Bunch
     :param trials_all: trials object with data concatenated over three training sessions
     :type trials_all: Bunch
+    :param psych: precomputed psychometric fit parameters of trials_all, fitted if None
+    :type psych: np.array
     :returns:
         - perf_easy - performance of easy trials for each session
         - n_trials - number of trials in each session
@@ -400,13 +434,14 @@ def compute_training_info(trials, trials_all):
     signed_contrast = get_signed_contrast(trials_all)
     perf_easy = np.array([compute_performance_easy(trials[k]) for k in trials.keys()])
     n_trials = np.array([compute_n_trials(trials[k]) for k in trials.keys()])
-    psych = compute_psychometric(trials_all, signed_contrast=signed_contrast)
+    if psych is None:
+        psych = compute_psychometric(trials_all, signed_contrast=signed_contrast)
     rt = compute_median_reaction_time(trials_all, contrast=0, signed_contrast=signed_contrast)
 
     return perf_easy, n_trials, psych, rt
 
 
-def compute_bias_info(trials, trials_all):
+def compute_bias_info(trials, trials_all, psych_20=None, psych_80=None):
     """
     Compute all relevant performance metrics for when subject is on biasedChoiceWorld
 
@@ -415,6 +450,10 @@ def compute_bias_info(trials, trials_all):
     :type trials: Bunch
     :param trials_all: trials object with data concatenated over three training sessions
     :type trials_all: Bunch
+    :param psych_20: precomputed psychometric fit parameters of the 20 block, fitted if None
+    :type psych_20: np.array
+    :param psych_80: precomputed psychometric fit parameters of the 80 block, fitted if None
+    :type psych_80: np.array
     :returns:
         - perf_easy - performance of easy trials for each session
         - n_trials - number of trials in each session
@@ -426,8 +465,8 @@ def compute_bias_info(trials, trials_all):
     signed_contrast = get_signed_contrast(trials_all)
     perf_easy = np.array([compute_performance_easy(trials[k]) for k in trials.keys()])
     n_trials = np.array([compute_n_trials(trials[k]) for k in trials.keys()])
-    psych_20 = compute_psychometric(trials_all, signed_contrast=signed_contrast, block=0.2)
-    psych_80 = compute_psychometric(trials_all, signed_contrast=signed_contrast, block=0.8)
+    if psych_20 is None or psych_80 is None:
+        psych_20, psych_80 = compute_psychometric_batch([trials_all, trials_all], blocks=[0.2, 0.8])
     rt = compute_median_reaction_time(trials_all, contrast=0, signed_contrast=signed_contrast)
 
     return perf_easy, n_trials, psych_20, psych_80, rt
@@ -559,6 +598,49 @@ def compute_psychometric(trials, signed_contrast=None, block=None, plotting=Fals
         return psych
 
 
+def compute_psychometric_batch(trials, blocks=None, parstart=None, nfits=5):
+    """
+    Compute psychometric fit parameters for many trials objects and blocks at once, all the fits
+    share the same vectorized optimisation iterations (see psy.mle_fit_psycho_batch).
+
+    :param trials: list of trials objects that must contain contrastLeft, contrastRight and
+    probabilityLeft
+    :type trials: list of dict
+    :param blocks: the block of each fit (0.2, 0.5, 0.8 or None for all trials), by default all trials
+    :type blocks: list
+    :param parstart: starting parameters of each fit, e.g. the previous session parameters as a
+    warm start. Rows containing NaNs use the same defaults as compute_psychometric
+    :type parstart: np.array (n fits, 4)
+    :param nfits: number of fits for each dataset, the first one starts at parstart
+    :type nfits: int
+    :return: array of psychometric fit parameters (n fits, 4) - bias, threshold, lapse high,
+    lapse low. Fits of blocks without trials are NaN
+    """
+    blocks = [None] * len(trials) if blocks is None else blocks
+    psych = np.full((len(trials), 4), np.nan)
+    data, ifit = [], []
+    for i, (trials_, block) in enumerate(zip(trials, blocks)):
+        if block is not None and not np.any(trials_.probabilityLeft == block):
+            continue
+        prob_choose_right, contrasts, n_contrasts = compute_performance(trials_, block=block, prob_right=True)
+        data.append(np.vstack([contrasts, n_contrasts, prob_choose_right]))
+        ifit.append(i)
+    if len(data) == 0:
+        return psych
+    default = np.array([[np.mean(d[0]), 20., 0.05, 0.05] for d in data])
+    if parstart is not None:
+        parstart = np.array(parstart, dtype=float)[ifit]
+        parstart[np.any(np.isnan(parstart), axis=1)] = default[np.any(np.isnan(parstart), axis=1)]
+    psych[ifit], _ = psy.mle_fit_psycho_batch(
+        data,
+        P_model='erf_psycho_2gammas',
+        parstart=default if parstart is None else parstart,
+        parmin=np.array([[np.min(d[0]), 0., 0., 0.] for d in data]),
+        parmax=np.array([[np.max(d[0]), 100., 1, 1] for d in data]),
+        nfits=nfits)
+    return psych
+
+
 def compute_median_reaction_time(trials, stim_on_type='stimOn_times', contrast=None, signed_contrast=None):
     """
     Compute median reaction time on zero contrast trials from trials object
@@ -22,6 +22,7 @@ import spikeglx
 from iblutil.util import Bunch
 from ibllib.io.extractors.training_wheel import extract_wheel_moves, extract_first_movement_times
 from ibllib.atlas import atlas, AllenAtlas, BrainRegions
+from ibllib.ephys.sync_probes import ClockSync
 from ibllib.pipes import histology
 from ibllib.pipes.ephys_alignment import EphysAlignment
 from ibllib.plots import vertical_lines
@@ -1023,10 +1024,11 @@ class SpikeSortingLoader:
             except ALFObjectNotFound:
                 ap_meta = None
                 fs = 30_000
+            clock = ClockSync(timestamps)
             self._sync = {
                 'timestamps': timestamps,
-                'forward': interp1d(timestamps[:, 0], timestamps[:, 1], fill_value='extrapolate'),
-                'reverse': interp1d(timestamps[:, 1], timestamps[:, 0], fill_value='extrapolate'),
+                'forward': clock.forward,
+                'reverse': clock.reverse,
                 'ap_meta': ap_meta,
                 'fs': fs,
             }
@@ -1034,9 +1036,12 @@ class SpikeSortingLoader:
     def timesprobe2times(self, values, direction='forward'):
         self._get_probe_info()
         if direction == 'forward':
-            return self._sync['forward'](values * self._sync['fs'])
+            samples = np.multiply(values, self._sync['fs'], dtype=np.float64)
+            return self._sync['forward'](samples, out=samples)
         elif direction == 'reverse':
-            return self._sync['reverse'](values) / self._sync['fs']
+            times = self._sync['reverse'](values)
+            times /= self._sync['fs']
+            return times
 
     def samples2times(self, values, direction='forward'):
         """
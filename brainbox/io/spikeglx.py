@@ -1,5 +1,9 @@
+import os
+import re
 import shutil
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
 import json
@@ -7,7 +11,6 @@ import string
 import random
 
 import numpy as np
-from one.alf.files import remove_uuid_string
 
 import spikeglx
 
@@ -117,13 +120,39 @@ class Streamer(spikeglx.Reader):
     one = ONE()
     sr = Streamer(pid=pid, one=one)
     raw_voltage = sr[int(t0 * sr.fs):int((t0 + nsecs) * sr.fs), :]
+
+    The mtscomp chunks are downloaded individually in a cache folder that can be shared by several
+    processes: each chunk is written in a temporary folder then atomically renamed. The cache size
+    may be bounded, in which case the least recently used chunks are removed, except the ones being
+    downloaded or read by any process, which are flagged by a marker file in the chunk folder.
+    Sequential reads may be sped up by downloading the next chunks in a background thread:
+    sr = Streamer(pid=pid, one=one, cache_size=20 * 1024 ** 3, prefetch=4)
     """
-    def __init__(self, pid, one, typ='ap', cache_folder=None, remove_cached=False):
+    READER_TIMEOUT = 3600  # seconds after which a reader marker is considered stale (crashed process)
+
+    def __init__(self, pid, one, typ='ap', cache_folder=None, remove_cached=False, cache_size=None, prefetch=0):
+        """
+        :param pid: probe insertion uuid
+        :param one: ONE instance
+        :param typ: 'ap' or 'lf'
+        :param cache_folder: folder in which the chunks are cached, defaults to {ONE cache}/cache/{typ}
+        :param remove_cached: if True, the chunks are downloaded in folders private to this instance
+         and removed after each read
+        :param cache_size: maximum size in bytes of the chunks cache for this file, defaults to no limit
+        :param prefetch: number of chunks following each read to download in a background thread
+        """
         self.target_dir = None  # last chunk directory download or read
         self.one = one
         self.pid = pid
         self.cache_folder = cache_folder or Path(self.one.alyx._par.CACHE_DIR).joinpath('cache', typ)
         self.remove_cached = remove_cached
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self._executor = None  # background thread downloading the chunks ahead of the reads
+        self._pending = {}  # chunk index: future of the chunks being downloaded in the background
+        self._lock = threading.Lock()
+        # unique identifier of this instance, used for the reader markers and the private chunk folders
+        self._uid = ''.join(random.choice(string.ascii_letters) for _ in np.arange(10))
         self.eid, self.pname = self.one.pid2eid(pid)
         self.file_chunks = self.one.load_dataset(self.eid, f'*.{typ}.ch', collection=f"*{self.pname}")
         meta_file = self.one.load_dataset(self.eid, f'*.{typ}.meta', collection=f"*{self.pname}")
@@ -143,103 +172,192 @@ class Streamer(spikeglx.Reader):
         n0 = self.chunks['chunk_bounds'][first_chunk]
         _logger.debug(f'Streamer: caching sample {n0}, (t={n0 / self.fs})')
         self.cache_folder.mkdir(exist_ok=True, parents=True)
-        sr, file_cbin = self._download_raw_partial(first_chunk=first_chunk, last_chunk=last_chunk)
-        if not volts:
-            data = np.copy(sr._raw[nsel.start - n0:nsel.stop - n0, csel])
-        else:
-            data = sr[nsel.start - n0: nsel.stop - n0, csel]
-        sr.close()
-        if self.remove_cached:
-            shutil.rmtree(self.target_dir)
-        return data
+        # start the download of the next chunks before reading the current ones
+        if self.prefetch:
+            for ichunk in range(last_chunk + 1, min(last_chunk + 1 + self.prefetch, self.chunks['chunk_bounds'].size - 1)):
+                self._submit(ichunk)
+        data = []
+        for ichunk in range(first_chunk, last_chunk + 1):
+            file_cbin = self._get_chunk(ichunk)
+            c0, c1 = self.chunks['chunk_bounds'][ichunk:ichunk + 2]
+            sl = slice(max(nsel.start, c0) - c0, min(nsel.stop, c1) - c0)
+            try:
+                sr = spikeglx.Reader(file_cbin, ignore_warnings=True)
+                if not volts:
+                    data.append(np.copy(sr._raw[sl, csel]))
+                else:
+                    data.append(sr[sl, csel])
+                sr.close()
+            finally:
+                if self.remove_cached:
+                    shutil.rmtree(file_cbin.parent, ignore_errors=True)
+                else:
+                    self._reader_marker(file_cbin.parent).unlink(missing_ok=True)
+        return np.concatenate(data, axis=0)
 
-    def _download_raw_partial(self, first_chunk=0, last_chunk=0):
+    def _chunk_dir(self, ichunk):
         """
-        downloads one or several chunks of a mtscomp file and copy ch files and metadata to return
-        a spikeglx.Reader object
-        :param first_chunk:
-        :param last_chunk:
-        :return: spikeglx.Reader of the current chunk, Pathlib.Path of the directory where it is stored
-        :return: cbin local path
+        :param ichunk: chunk index
+        :return: pathlib.Path of the cache directory of the chunk
         """
-        assert str(self.url_cbin).endswith('.cbin')
-        webclient = self.one.alyx
-        relpath = Path(self.url_cbin.replace(webclient._par.HTTP_DATA_SERVER, '.')).parents[0]
-        # write the temp file into a subdirectory
-        tdir_chunk = f"chunk_{str(first_chunk).zfill(6)}_to_{str(last_chunk).zfill(6)}"
-        # for parallel processes, there is a risk of collisions if the removed cached flag is set to True
-        # if the folder is to be removed append a unique identifier to avoid having duplicate names
+        relpath = Path(self.url_cbin.replace(self.one.alyx._par.HTTP_DATA_SERVER, '.')).parents[0]
+        tdir_chunk = f"chunk_{str(ichunk).zfill(6)}"
+        # the removed chunks are not shared, to avoid deleting a chunk read by another process
         if self.remove_cached:
-            tdir_chunk += ''.join([random.choice(string.ascii_letters) for _ in np.arange(10)])
-        self.target_dir = Path(self.cache_folder, relpath, tdir_chunk)
-        Path(self.target_dir).mkdir(parents=True, exist_ok=True)
-        ch_file_stream = self.target_dir.joinpath(self.file_chunks.name).with_suffix('.stream.ch')
-
-        # Get the first sample index, and the number of samples to download.
-        i0 = self.chunks['chunk_bounds'][first_chunk]
-        ns_stream = self.chunks['chunk_bounds'][last_chunk + 1] - i0
-        total_samples = self.chunks['chunk_bounds'][-1]
-
-        # handles the meta file
-        meta_local_path = ch_file_stream.with_suffix('.meta')
-        if not meta_local_path.exists():
-            shutil.copy(self.file_chunks.with_suffix('.meta'), meta_local_path)
-
-        # if the cached version happens to be the same as the one on disk, just load it
-        if ch_file_stream.exists() and ch_file_stream.with_suffix('.cbin').exists():
-            with open(ch_file_stream, 'r') as f:
-                cmeta_stream = json.load(f)
-            if (cmeta_stream.get('chopped_first_sample', None) == i0 and
-                    cmeta_stream.get('chopped_total_samples', None) == total_samples):
-                return spikeglx.Reader(ch_file_stream.with_suffix('.cbin'), ignore_warnings=True), ch_file_stream
+            tdir_chunk += f"_{self._uid}"
+        return Path(self.cache_folder, relpath, tdir_chunk)
 
+    def _reader_marker(self, chunk_dir):
+        """
+        :param chunk_dir: chunk directory
+        :return: pathlib.Path of the file flagging that this instance is reading the chunk
+        """
+        return chunk_dir.joinpath(f".reader_{os.getpid()}_{self._uid}")
+
+    def _submit(self, ichunk):
+        """
+        Starts the download of a chunk in the background thread if it isn't cached or pending
+        :param ichunk: chunk index
+        """
+        chunk_dir = self._chunk_dir(ichunk)
+        with self._lock:
+            if ichunk in self._pending or chunk_dir.exists():
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending[ichunk] = self._executor.submit(self._download_chunk, ichunk)
+
+    def _get_chunk(self, ichunk):
+        """
+        Returns the cached chunk file, waiting for a pending download or downloading it if needed
+        :param ichunk: chunk index
+        :return: pathlib.Path of the chunk .cbin file
+        """
+        with self._lock:
+            future = self._pending.get(ichunk)
+        if future is not None:
+            future.result()
+        self.target_dir = self._chunk_dir(ichunk)
+        file_cbin = self.target_dir.joinpath(self.file_chunks.name).with_suffix('.stream.cbin')
+        # flag the chunk as being read before checking it exists so that other processes don't evict it
+        try:
+            self._reader_marker(self.target_dir).touch()
+        except FileNotFoundError:
+            pass
+        if file_cbin.exists():
+            os.utime(self.target_dir)  # the directory modification time is used for LRU eviction
         else:
-            shutil.copy(self.file_chunks, ch_file_stream)
-        assert ch_file_stream.exists()
-
-        cmeta = self.chunks.copy()
-        # prepare the metadata file
-        cmeta['chunk_bounds'] = cmeta['chunk_bounds'][first_chunk:last_chunk + 2]
-        cmeta['chunk_bounds'] = [int(_ - i0) for _ in cmeta['chunk_bounds']]
-        assert len(cmeta['chunk_bounds']) >= 2
-        assert cmeta['chunk_bounds'][0] == 0
-
-        first_byte = cmeta['chunk_offsets'][first_chunk]
-        cmeta['chunk_offsets'] = cmeta['chunk_offsets'][first_chunk:last_chunk + 2]
-        cmeta['chunk_offsets'] = [_ - first_byte for _ in cmeta['chunk_offsets']]
-        assert len(cmeta['chunk_offsets']) >= 2
-        assert cmeta['chunk_offsets'][0] == 0
-        n_bytes = cmeta['chunk_offsets'][-1]
-        assert n_bytes > 0
-
-        # Save the chopped chunk bounds and offsets.
-        cmeta['sha1_compressed'] = None
-        cmeta['sha1_uncompressed'] = None
-        cmeta['chopped'] = True
-        cmeta['chopped_first_sample'] = int(i0)
-        cmeta['chopped_samples'] = int(ns_stream)
-        cmeta['chopped_total_samples'] = int(total_samples)
-
-        with open(ch_file_stream, 'w') as f:
-            json.dump(cmeta, f, indent=2, sort_keys=True)
-
-        # Download the requested chunks
-        retries = 0
-        while True:
+            self._download_chunk(ichunk)
+            self._reader_marker(self.target_dir).touch()
+        return file_cbin
+
+    def _download_chunk(self, ichunk):
+        """
+        Downloads a single chunk of the mtscomp file and writes the chopped ch and meta files so that
+        the chunk directory can be read as a standalone spikeglx file. The files are written in a
+        temporary directory that is renamed once complete, so that concurrent processes never read
+        a partially written chunk.
+        :param ichunk: chunk index
+        :return: pathlib.Path of the chunk directory
+        """
+        assert str(self.url_cbin).endswith('.cbin')
+        try:
+            chunk_dir = self._chunk_dir(ichunk)
+            if chunk_dir.exists():
+                return chunk_dir
+            tmp_dir = chunk_dir.with_name(
+                chunk_dir.name + '.' + ''.join(random.choice(string.ascii_letters) for _ in np.arange(10)) + '.tmp')
+            tmp_dir.mkdir(parents=True)
+            ch_file_stream = tmp_dir.joinpath(self.file_chunks.name).with_suffix('.stream.ch')
+            shutil.copy(self.file_chunks.with_suffix('.meta'), ch_file_stream.with_suffix('.meta'))
+
+            # prepare the metadata file
+            i0 = self.chunks['chunk_bounds'][ichunk]
+            cmeta = self.chunks.copy()
+            cmeta['chunk_bounds'] = [int(_ - i0) for _ in cmeta['chunk_bounds'][ichunk:ichunk + 2]]
+            first_byte = cmeta['chunk_offsets'][ichunk]
+            cmeta['chunk_offsets'] = [_ - first_byte for _ in cmeta['chunk_offsets'][ichunk:ichunk + 2]]
+            n_bytes = cmeta['chunk_offsets'][-1]
+            assert n_bytes > 0
+            # Save the chopped chunk bounds and offsets.
+            cmeta['sha1_compressed'] = None
+            cmeta['sha1_uncompressed'] = None
+            cmeta['chopped'] = True
+            cmeta['chopped_first_sample'] = int(i0)
+            cmeta['chopped_samples'] = int(cmeta['chunk_bounds'][-1])
+            cmeta['chopped_total_samples'] = int(self.chunks['chunk_bounds'][-1])
+            with open(ch_file_stream, 'w') as f:
+                json.dump(cmeta, f, indent=2, sort_keys=True)
+
+            # Download the requested chunk
+            retries = 0
+            while True:
+                try:
+                    cbin_local_path = self.one.alyx.download_file(
+                        self.url_cbin, chunks=(first_byte, n_bytes),
+                        target_dir=tmp_dir, clobber=True, return_md5=False)
+                    break
+                except Exception as e:
+                    retries += 1
+                    if retries > 5:
+                        raise e
+                    _logger.warning(f'Failed to download chunk {ichunk}, retrying')
+                    time.sleep(1)
+            cbin_local_path.replace(ch_file_stream.with_suffix('.cbin'))
             try:
-                cbin_local_path = webclient.download_file(
-                    self.url_cbin, chunks=(first_byte, n_bytes),
-                    target_dir=self.target_dir, clobber=True, return_md5=False)
+                tmp_dir.rename(chunk_dir)
+            except OSError:  # another process or thread completed the same chunk in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            self._evict()
+        finally:
+            with self._lock:
+                self._pending.pop(ichunk, None)
+        return chunk_dir
+
+    def _evict(self):
+        """
+        Removes the least recently used chunks of this file until the cache size is below cache_size.
+        The chunks being read by any process, as flagged by a reader marker file younger than
+        READER_TIMEOUT seconds, and the chunks pending download by this instance are kept.
+        """
+        if self.cache_size is None:
+            return
+        chunk_dirs = []
+        for d in self._chunk_dir(0).parent.glob('chunk_*'):
+            # only the shared chunks are evicted, the private and temporary folders are left to their owner
+            if not re.fullmatch(r'chunk_\d{6}', d.name):
+                continue
+            try:
+                chunk_dirs.append((d, d.stat().st_mtime, sum(f.stat().st_size for f in d.iterdir())))
+            except FileNotFoundError:  # removed by another process in the meantime
+                continue
+        total = sum(size for _, _, size in chunk_dirs)
+        with self._lock:
+            protected = {self._chunk_dir(ichunk) for ichunk in self._pending} | {self.target_dir}
+        for d, _, size in sorted(chunk_dirs, key=lambda x: x[1]):
+            if total <= self.cache_size:
                 break
-            except Exception as e:
-                retries += 1
-                if retries > 5:
-                    raise e
-                _logger.warning(f'Failed to download chunk {first_chunk} to {last_chunk}, retrying')
-                time.sleep(1)
-        cbin_local_path_renamed = remove_uuid_string(cbin_local_path).with_suffix('.stream.cbin')
-        cbin_local_path.replace(cbin_local_path_renamed)
-        assert cbin_local_path_renamed.exists()
-
-        reader = spikeglx.Reader(cbin_local_path_renamed, ignore_warnings=True)
-        return reader, cbin_local_path
+            if d in protected or self._is_read(d):
+                continue
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
+
+    def _is_read(self, chunk_dir):
+        """
+        :param chunk_dir: chunk directory
+        :return: True if a reader marker younger than READER_TIMEOUT seconds is in the chunk directory
+        """
+        now = time.time()
+        for marker in chunk_dir.glob('.reader_*'):
+            try:
+                if now - marker.stat().st_mtime < self.READER_TIMEOUT:
+                    return True
+            except FileNotFoundError:
+                continue
+        return False
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        super(Streamer, self).close()
@@ -1,61 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 from neurodsp import smooth, utils, fourier
 from brainbox.processing import bincount2D
 
 
-def estimate_drift(spike_times, spike_amps, spike_depths, display=False):
+# binning parameters
+DT_SECS = 1  # output sampling rate of the depth estimation (seconds)
+DEPTH_BIN_UM = 2  # binning parameter for depth
+AMP_BIN_LOG10 = [1.25, 3.25]  # binning parameter for amplitudes (log10 in uV)
+N_AMP = 1  # number of amplitude bins
+
+NXCORR = 50  # positive and negative lag in depth samples to look for depth
+NT_SMOOTH = 9  # length of the Gaussian smoothing window in samples (DT_SECS rate)
+
+
+def _drift_xcorr(atd_, ref, lp):
+    """
+    Cross-correlation along depth of each time bin against a reference, summed over amplitude bins
+    :param atd_: (N_AMP, nt, nd) depth spectra of the histogram
+    :param ref: (N_AMP, nd) reference depth spectrum
+    :param lp: (nd,) depth low-pass filter
+    :return: (nt, 2 * NXCORR + 1) cross-correlation for lags -NXCORR to NXCORR
+    """
+    xcorr = np.real(np.fft.ifft(lp * atd_ * np.conj(ref)[:, np.newaxis, :]))
+    xcorr = np.sum(xcorr, axis=0)
+    return np.c_[xcorr[:, -NXCORR:], xcorr[:, :NXCORR + 1]]
+
+
+def _drift_lags(xcorr):
+    # to experiment: parabolic fit to get max values
+    xcorr = xcorr - np.mean(xcorr, 1)[:, np.newaxis]
+    return utils.parabolic_max(xcorr)[0] - NXCORR
+
+
+def _drift_block(spike_times, spike_amps, spike_depths, spike_shanks, t0, nt, nd, shanks):
+    """
+    Computes the depth cross-correlations of a block of nt time bins starting at t0 against the
+    block reference: the median depth spectrum over the block.
+    :return: (nt, 2 * NXCORR + 1) cross-correlation summed over shanks
+    """
+    fdscale = np.abs(np.fft.fftfreq(nd, d=DEPTH_BIN_UM))
+    # k-filter along the depth direction
+    lp = fourier._freq_vector(fdscale, np.array([1 / 16, 1 / 8]), typ='lp')
+    abins = (np.log10(spike_amps * 1e6) - AMP_BIN_LOG10[0]) / np.diff(AMP_BIN_LOG10) * N_AMP
+    abins = np.minimum(np.maximum(0, np.floor(abins)), N_AMP - 1)
+    xcorr = np.zeros((nt, 2 * NXCORR + 1))
+    for shank in shanks:
+        # 3d histogram of spikes along amplitude, depths and time
+        atd_hist = np.zeros((N_AMP, nt, nd), dtype=np.single)
+        for abin in np.unique(abins):
+            inds = np.where(np.logical_and.reduce((abins == abin, ~np.isnan(spike_depths), spike_shanks == shank)))[0]
+            a, _, _ = bincount2D(spike_depths[inds], spike_times[inds], DEPTH_BIN_UM, DT_SECS,
+                                 [0, nd * DEPTH_BIN_UM], [t0, t0 + nt * DT_SECS])
+            atd_hist[int(abin)] = a[:-1, :-1]
+        # compute the depth lag by xcorr
+        # to experiment: LP the fft for a better tracking ?
+        atd_ = np.fft.fft(atd_hist, axis=-1)
+        # xcorrelation against reference
+        xcorr += _drift_xcorr(atd_, np.median(atd_, axis=1), lp)
+    return xcorr
+
+
+def estimate_drift(spike_times, spike_amps, spike_depths, display=False, block_secs=None, n_workers=1,
+                   spike_shanks=None):
     """
     Electrode drift for spike sorted data.
     :param spike_times:
     :param spike_amps:
     :param spike_depths:
     :param display:
+    :param block_secs: (optional) for long recordings, the recording is processed in time blocks
+     of block_secs so that the memory is bounded. Each block overlaps the previous one by a quarter
+     of its time bins and is cross-correlated against its own reference. The blocks are chained by
+     offsetting each one by the median lag difference with the previous block over the overlap.
+    :param n_workers: (optional) number of processes computing the blocks
+    :param spike_shanks: (optional) shank of each spike for multi-shank probes (NP2.4): the
+     depth histograms are computed per shank and the cross-correlations summed over shanks
     :return: drift (ntimes vector) in input units (usually um)
     :return: ts (ntimes vector) time scale in seconds
 
     """
-    # binning parameters
-    DT_SECS = 1  # output sampling rate of the depth estimation (seconds)
-    DEPTH_BIN_UM = 2  # binning parameter for depth
-    AMP_BIN_LOG10 = [1.25, 3.25]  # binning parameter for amplitudes (log10 in uV)
-    N_AMP = 1  # number of amplitude bins
-
-    NXCORR = 50  # positive and negative lag in depth samples to look for depth
-    NT_SMOOTH = 9  # length of the Gaussian smoothing window in samples (DT_SECS rate)
-
     # experimental: try the amp with a log scale
     nd = int(np.ceil(np.nanmax(spike_depths) / DEPTH_BIN_UM))
     tmin, tmax = (np.min(spike_times), np.max(spike_times))
     nt = int((np.ceil(tmax) - np.floor(tmin)) / DT_SECS)
+    if spike_shanks is None:
+        spike_shanks = np.zeros(spike_times.size, dtype=int)
+    shanks = np.unique(spike_shanks)
 
-    # 3d histogram of spikes along amplitude, depths and time
-    atd_hist = np.zeros((N_AMP, nt, nd), dtype=np.single)
-    abins = (np.log10(spike_amps * 1e6) - AMP_BIN_LOG10[0]) / np.diff(AMP_BIN_LOG10) * N_AMP
-    abins = np.minimum(np.maximum(0, np.floor(abins)), N_AMP - 1)
+    # split the time bins in blocks overlapping the previous block and select the spikes of each block
+    nt_block = nt if block_secs is None else max(int(block_secs / DT_SECS), 2 * NT_SMOOTH)
+    n_overlap = nt_block // 4
+    first_bins = np.arange(0, nt, nt_block)
+    starts = np.maximum(first_bins - n_overlap, 0)
+    t0s = np.floor(tmin) + starts * DT_SECS
+    nts = np.minimum(first_bins + nt_block, nt) - starts
+    isort = np.argsort(spike_times, kind='stable')
+    islices = np.searchsorted(spike_times[isort], np.c_[t0s, t0s + nts * DT_SECS])
+    blocks = [isort[i0:i1] for i0, i1 in islices]
+    args = [[a[inds] for inds in blocks] for a in (spike_times, spike_amps, spike_depths, spike_shanks)]
+    args += [t0s, nts, [nd] * t0s.size, [shanks] * t0s.size]
+    if n_workers > 1 and t0s.size > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            lags = list(map(_drift_lags, executor.map(_drift_block, *args)))
+    else:
+        lags = [_drift_lags(_drift_block(*a)) for a in zip(*args)]
 
-    for i, abin in enumerate(np.unique(abins)):
-        inds = np.where(np.logical_and(abins == abin, ~np.isnan(spike_depths)))[0]
-        a, _, _ = bincount2D(spike_depths[inds], spike_times[inds], DEPTH_BIN_UM, DT_SECS,
-                             [0, nd * DEPTH_BIN_UM], [np.floor(tmin), np.ceil(tmax)])
-        atd_hist[i] = a[:-1, :-1]
-
-    fdscale = np.abs(np.fft.fftfreq(nd, d=DEPTH_BIN_UM))
-    # k-filter along the depth direction
-    lp = fourier._freq_vector(fdscale, np.array([1 / 16, 1 / 8]), typ='lp')
-    # compute the depth lag by xcorr
-    # to experiment: LP the fft for a better tracking ?
-    atd_ = np.fft.fft(atd_hist, axis=-1)
-    # xcorrelation against reference
-    xcorr = np.real(np.fft.ifft(lp * atd_ * np.conj(np.median(atd_, axis=1))[:, np.newaxis, :]))
-    xcorr = np.sum(xcorr, axis=0)
-    xcorr = np.c_[xcorr[:, -NXCORR:], xcorr[:, :NXCORR + 1]]
-    xcorr = xcorr - np.mean(xcorr, 1)[:, np.newaxis]
-    # import easyqc
-    # easyqc.viewdata(xcorr - np.mean(xcorr, 1)[:, np.newaxis], DEPTH_BIN_UM, title='xcor')
-
-    # to experiment: parabolic fit to get max values
-    raw_drift = (utils.parabolic_max(xcorr)[0] - NXCORR) * DEPTH_BIN_UM
+    # each block is relative to its own reference: the offset between successive references is
+    # the median lag difference over the overlapping time bins
+    for i in range(1, len(lags)):
+        nov = first_bins[i] - starts[i]
+        lags[i] = lags[i][nov:] + np.median(lags[i - 1][-nov:] - lags[i][:nov])
+    raw_drift = np.concatenate(lags)
+    raw_drift *= DEPTH_BIN_UM
     drift = smooth.rolling_window(raw_drift, window_len=NT_SMOOTH, window='hanning')
     drift = drift - np.mean(drift)
     ts = DT_SECS * np.arange(drift.size)
@@ -15,6 +15,7 @@ Run the following to set-up the workspace to run the docstring examples:
 >>> units_b = bb.processing.get_units_bunch(spks_b)  # may take a few mins to compute
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import time
 import logging
 
@@ -852,8 +853,87 @@ def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, param
     return df_units, rec_qc
 
 
+def _cluster_slices(spike_clusters, cluster_ids):
+    """
+    Sorts the spikes per cluster with a single argsort, so that each cluster is a contiguous slice
+    Within a cluster the original order of the spikes (usually time) is preserved.
+    :param spike_clusters: (nspikes,) cluster id of each spike
+    :param cluster_ids: (nclusters,) cluster ids to select, in output order
+    :return: icl: indices of the selected spikes, grouped in the order of cluster_ids
+     starts: (nclusters,) first index of each cluster slice in the grouped arrays
+     counts: (nclusters,) number of spikes for each cluster
+    """
+    ordre = np.argsort(spike_clusters, kind='stable')
+    sorted_clusters = spike_clusters[ordre]
+    iss = np.searchsorted(sorted_clusters, cluster_ids, side='left')
+    counts = np.searchsorted(sorted_clusters, cluster_ids, side='right') - iss
+    starts = np.cumsum(counts) - counts
+    labels = np.repeat(np.arange(counts.size), counts)
+    icl = ordre[iss[labels] + np.arange(labels.size) - starts[labels]]
+    return icl, starts, counts
+
+
+def _grouped_time_metrics(ts, depths, starts, counts, min_time, max_time, rp=0.002,
+                          min_isi=0.0001):
+    """
+    Vectorized version of `contamination_alt`, `contamination` and of the depth drift for
+    spikes grouped per cluster as output by `_cluster_slices`. Clusters without spikes are NaN.
+    :param ts: (nspikes,) spike times grouped per cluster, sorted in time within each cluster
+    :param depths: (nspikes,) spike depths grouped per cluster
+    :param starts: (nclusters,) first index of each cluster
+    :param counts: (nclusters,) number of spikes for each cluster
+    :param min_time: the minimum time (in s) that a potential spike occurred.
+    :param max_time: the maximum time (in s) that a potential spike occurred.
+    :param rp: refractory period (in s)
+    :param min_isi: the minimum interspike-interval (in s) for counting duplicate spikes.
+    :return: contamination_alt, contamination, drift: (nclusters,) arrays
+    """
+    nclust = counts.size
+    labels = np.repeat(np.arange(nclust), counts)
+    has_spikes = counts > 0
+    same = labels[1:] == labels[:-1]  # consecutive spikes belonging to the same cluster
+    dts = np.diff(ts)
+    # contamination alt: min absolute root of -x ** 2 + x + c
+    n_isi_viol = np.bincount(labels[1:][same & (dts < rp)], minlength=nclust)
+    t = np.zeros(nclust)
+    t[has_spikes] = ts[starts[has_spikes] + counts[has_spikes] - 1] - ts[starts[has_spikes]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = (t * n_isi_viol) / (2 * rp * counts ** 2)
+    ce_alt = (np.sqrt(1 + 4 * c) - 1) / 2
+    # contamination: remove the duplicate spikes and count the violations on the remaining isis
+    keep = np.ones(ts.size, dtype=bool)
+    keep[1:][same & (dts <= min_isi)] = False
+    klabels = labels[keep]
+    ksame = klabels[1:] == klabels[:-1]
+    num_violations = np.bincount(klabels[1:][ksame & (np.diff(ts[keep]) < rp)], minlength=nclust)
+    num_spikes = np.bincount(klabels, minlength=nclust)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        violation_rate = num_violations / (2 * num_spikes * (rp - min_isi))
+        ce = violation_rate / (num_spikes / (max_time - min_time))
+    # drift: cumulative absolute depth displacement in um / hour
+    drift = np.bincount(labels[1:][same], weights=np.abs(np.diff(depths))[same], minlength=nclust)
+    drift = drift / (max_time - min_time) * 3600
+    for x in (ce_alt, ce, drift):
+        x[~has_spikes] = np.nan
+    return ce_alt, ce, drift
+
+
+def _amplitude_metrics(amps, params=METRICS_PARAMS):
+    """
+    Computes the noise cutoff and missed spikes estimate for a list of amplitudes arrays
+    :param amps: list of (nspikes,) amplitudes arrays, one per cluster
+    :param params: metrics parameters (see the METRICS_PARAMS constant)
+    :return: (nclusters, 2) array: noise_cutoff, missed_spikes_est
+    """
+    out = np.zeros((len(amps), 2))
+    for i, a in enumerate(amps):
+        _, out[i, 0], _ = noise_cutoff(a, **params['noise_cutoff'])
+        out[i, 1], _, _ = missed_spikes_est(a, **params['missed_spikes_est'])
+    return out
+
+
 def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
-                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None):
+                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None, n_workers=1):
     """
     Computes single unit metrics from only the spike times, amplitudes, and
     depths for a set of units.
@@ -888,6 +968,8 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
     with the input arrays.
     tbounds: (optional) list or 2 elements array containing a time-selection to perform the
      metrics computation on.
+    n_workers: (optional) number of processes used to compute the amplitude distribution metrics
+     (noise cutoff and missed spikes estimate), defaults to 1 (no process pool).
     params : dict (optional)
         Parameters used for computing some of the metrics in the function:
             'presence_window': float
@@ -984,23 +1066,26 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
                                 **{'sampleRate': 30000, 'binSizeCorr': 1 / 30000})
     r.slidingRP_viol[srp['cidx']] = srp['value']
 
-    # loop over each cluster to compute the rest of the metrics
-    for ic in np.arange(nclust):
-        # slice the spike_times array
-        ispikes = spike_clusters == cluster_ids[ic]
-        if np.all(~ispikes):  # if this cluster has no spikes, continue
-            continue
-        ts = spike_times[ispikes]
-        amps = spike_amps[ispikes]
-        depths = spike_depths[ispikes]
-        # compute metrics
-        r.contamination_alt[ic] = contamination_alt(ts, rp=params['refractory_period'])
-        r.contamination[ic], _ = contamination(
-            ts, tmin, tmax, rp=params['refractory_period'], min_isi=params['min_isi'])
-        _, r.noise_cutoff[ic], _ = noise_cutoff(amps, **params['noise_cutoff'])
-        r.missed_spikes_est[ic], _, _ = missed_spikes_est(amps, **params['missed_spikes_est'])
-        # wonder if there is a need to low-cut this
-        r.drift[ic] = np.sum(np.abs(np.diff(depths))) / (tmax - tmin) * 3600
+    # sort the spikes by cluster once, each cluster is then a contiguous slice of the arrays
+    icl, starts, counts = _cluster_slices(spike_clusters, cluster_ids)
+    ts, amps, depths = (spike_times[icl], spike_amps[icl], spike_depths[icl])
+    r.contamination_alt[:], r.contamination[:], r.drift[:] = _grouped_time_metrics(
+        ts, depths, starts, counts, tmin, tmax, rp=params['refractory_period'],
+        min_isi=params['min_isi'])
+    # the amplitude distributions metrics can't be vectorized and are computed per cluster
+    ic = np.where(counts > 0)[0]
+    amps = [amps[starts[i]:starts[i] + counts[i]] for i in ic]
+    if n_workers > 1 and ic.size > 1:
+        chunks = [amps[i::n_workers] for i in range(n_workers)]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            res = list(executor.map(_amplitude_metrics, chunks, [params] * n_workers))
+        amp_metrics = np.zeros((ic.size, 2))
+        for i in range(n_workers):
+            amp_metrics[i::n_workers] = res[i]
+    else:
+        amp_metrics = _amplitude_metrics(amps, params)
+    r.noise_cutoff[ic] = amp_metrics[:, 0]
+    r.missed_spikes_est[ic] = amp_metrics[:, 1]
 
     r.label = compute_labels(r)
     return r
@@ -8,6 +8,7 @@ Code from sigtest_pseudosessions and sigtest_linshift by B. Benson
 
 import numpy as np
 import scipy as sp
+import scipy.sparse
 import scipy.stats
 import types
 from itertools import groupby
@@ -17,7 +18,7 @@ from sklearn.model_selection import KFold, LeaveOneOut, LeaveOneGroupOut
 from sklearn.metrics import accuracy_score
 
 
-def get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
+def get_spike_counts_in_bins(spike_times, spike_clusters, intervals, return_sparse=False):
     """
     Return the number of spikes in a sequence of time intervals, for each neuron.
 
@@ -29,11 +30,13 @@ def get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
         cluster ids corresponding to each event in `spikes`
     intervals : 2D array of shape (n_events, 2)
         the start and end times of the events
+    return_sparse : bool
+        if True, the counts are returned as a scipy.sparse.csr_matrix
 
     Returns
     ---------
     counts : 2D array of shape (n_neurons, n_events)
-        the spike counts of all neurons ffrom scipy.stats import sem, tor all events
+        the spike counts of all neurons for all events
         value (i, j) is the number of spikes of neuron `neurons[i]` in interval #j
     cluster_ids : 1D array
         list of cluster ids
@@ -46,16 +49,47 @@ def get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
 
     intervals_idx = np.searchsorted(spike_times, intervals)
 
-    # For each neuron and each interval, the number of spikes in the interval.
-    cluster_ids = np.unique(spike_clusters)
+    # intervals ending before they start contain no spikes
+    intervals_idx[:, 1] = np.maximum(intervals_idx[:, 0], intervals_idx[:, 1])
+
+    # index of the neuron of each spike, via a lookup table for non-negative integer cluster ids
+    if np.issubdtype(spike_clusters.dtype, np.integer) and np.min(spike_clusters) >= 0:
+        cluster_ids = np.flatnonzero(np.bincount(spike_clusters)).astype(spike_clusters.dtype)
+        lut = np.zeros(cluster_ids[-1] + 1, dtype=np.int64)
+        lut[cluster_ids] = np.arange(cluster_ids.size)
+        iclusters = lut[spike_clusters]
+    else:
+        cluster_ids, iclusters = np.unique(spike_clusters, return_inverse=True)
     n_neurons = len(cluster_ids)
     n_intervals = intervals.shape[0]
-    counts = np.zeros((n_neurons, n_intervals), dtype=np.uint32)
-    for j in range(n_intervals):
-        i0, i1 = intervals_idx[j, :]
-        # Count the number of spikes in the window, for each neuron.
-        x = np.bincount(spike_clusters[i0:i1], minlength=cluster_ids.max() + 1)
-        counts[:, j] = x[cluster_ids]
+
+    # For each neuron and each interval, the number of spikes in the interval.
+    # the intervals are visited in chronological order. The counts are obtained with a single 2D
+    # bincount on (neuron, interval) spike labels unless the intervals overlap so much that the
+    # labels outnumber the cumulative counts per neuron at each interval bound
+    order = np.lexsort((intervals_idx[:, 1], intervals_idx[:, 0]))
+    nspi = intervals_idx[order, 1] - intervals_idx[order, 0]
+    if return_sparse or np.sum(nspi) <= n_neurons * n_intervals * 2:
+        # the (neuron, interval) label of each spike within each interval
+        iint = np.repeat(order, nspi)
+        ispi = np.repeat(intervals_idx[order, 0] - (np.cumsum(nspi) - nspi), nspi) + np.arange(iint.size)
+        if return_sparse:
+            counts = sp.sparse.coo_matrix((np.ones(iint.size, dtype=np.uint32), (iclusters[ispi], iint)),
+                                          shape=(n_neurons, n_intervals)).tocsr()
+        else:
+            counts = np.bincount(iclusters[ispi] * n_intervals + iint, minlength=n_neurons * n_intervals)
+            counts = counts.astype(np.uint32).reshape(n_neurons, n_intervals)
+    else:
+        # cumulative spike counts per neuron at each interval bound, the counts are the differences
+        bounds, ibounds = np.unique(intervals_idx, return_inverse=True)
+        ibounds = ibounds.reshape(n_intervals, 2)
+        nseg = bounds.size - 1
+        iseg = np.repeat(np.arange(nseg), np.diff(bounds))
+        cumcounts = np.zeros((n_neurons, nseg + 1), dtype=np.uint32)
+        cumcounts[:, 1:] = np.bincount(iclusters[bounds[0]:bounds[-1]] * nseg + iseg,
+                                       minlength=n_neurons * nseg).reshape(n_neurons, nseg)
+        np.cumsum(cumcounts, axis=1, out=cumcounts)
+        counts = cumcounts[:, ibounds[:, 1]] - cumcounts[:, ibounds[:, 0]]
     return counts, cluster_ids
 
 
@@ -193,6 +227,101 @@ def xcorr(spike_times, spike_clusters, bin_size=None, window_size=None):
     return _symmetrize_correlograms(correlograms)
 
 
+def _xcorr_pair(ia, ib, spike_times, bin_size, half, chunk_size):
+    """Cross-correlogram of a pair of clusters, from their sorted spike indices.
+
+    For each chunk of consecutive spikes of the first cluster, the window of matching spikes of
+    the second cluster is bounded by binary search and the matches are expanded at once.
+    The zero lag follows `xcorr`: the max over the two spike orderings.
+
+    """
+    ta, tb = spike_times[ia], spike_times[ib]
+    counts = np.zeros(2 * half + 1, dtype=np.int64)
+    n0 = np.zeros(2, dtype=np.int64)  # zero lag matches with the spike of a before / after b
+    wmax = (half + 1) * bin_size
+    for first in range(0, ia.size, chunk_size):
+        ta_ = ta[first:first + chunk_size]
+        lo = np.searchsorted(tb, ta_ - wmax, side='left')
+        nmatch = np.searchsorted(tb, ta_ + wmax, side='right') - lo
+        if nmatch.sum() == 0:
+            continue
+        iref = np.repeat(np.arange(ta_.size), nmatch)
+        imatch = lo[iref] + np.arange(iref.size) - np.repeat(np.cumsum(nmatch) - nmatch, nmatch)
+        lags = np.round((tb[imatch] - ta_[iref]) / bin_size).astype(np.int64)
+        ok = np.abs(lags) <= half
+        sa, sb = ia[first:first + chunk_size][iref], ib[imatch]
+        ok &= sa != sb  # excludes the spike itself for autocorrelograms
+        zero = ok & (lags == 0)
+        n0 += [np.sum(zero & (sa < sb)), np.sum(zero & (sa > sb))]
+        counts += np.bincount(lags[ok & ~zero] + half, minlength=2 * half + 1)
+    counts[half] = n0.max()
+    return counts
+
+
+def xcorr_pairs(spike_times, spike_clusters, bin_size=None, window_size=None, pairs=None,
+                chunk_size=100000):
+    """Compute cross-correlograms for a subset of cluster pairs.
+
+    Unlike `xcorr`, which shifts the whole spike train and returns the dense
+    `(n_clusters, n_clusters, winsize_bins)` array, this works from the sorted spike list of each
+    cluster and only computes the requested pairs (e.g. neighbours on the probe), so that the
+    time and memory scale with the number of pairs and of spikes within the window.
+    The spikes are processed in chunks of consecutive spikes, i.e. in time chunks.
+
+    Parameters
+    ----------
+
+    :param spike_times: Spike times in seconds.
+    :type spike_times: array-like
+    :param spike_clusters: Spike-cluster mapping.
+    :type spike_clusters: array-like
+    :param bin_size: Size of the bin, in seconds.
+    :type bin_size: float
+    :param window_size: Size of the window, in seconds.
+    :type window_size: float
+    :param pairs: `(n_pairs, 2)` array of cluster ids, defaults to all pairs `i <= j`.
+    :type pairs: array-like
+    :param chunk_size: Maximum number of reference spikes processed at once.
+    :type chunk_size: int
+
+    Returns `pairs`, the `(n_pairs, 2)` array of cluster ids, and an `(n_pairs, winsize_bins)`
+    array of cross-correlograms such that `correlograms[k]` is equal to
+    `xcorr(...)[i, j]` for `i, j = pairs[k]`.
+
+    """
+    spike_times, spike_clusters = np.asarray(spike_times), np.asarray(spike_clusters)
+    assert np.all(np.diff(spike_times) >= 0), "The spike times must be increasing."
+    assert spike_times.ndim == 1
+    assert spike_times.shape == spike_clusters.shape
+
+    bin_size = np.clip(bin_size, 1e-5, 1e5)  # in seconds
+    window_size = np.clip(window_size, 1e-5, 1e5)  # in seconds
+    half = int(.5 * window_size / bin_size)
+
+    clusters = np.unique(spike_clusters)
+    if pairs is None:
+        pairs = np.c_[np.triu_indices(clusters.size)]
+        pairs = clusters[pairs]
+    pairs = np.atleast_2d(np.asarray(pairs)).reshape(-1, 2)
+
+    # sorted spike indices of each cluster
+    iclusters = np.searchsorted(clusters, spike_clusters)
+    isort = np.argsort(iclusters, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(iclusters, minlength=clusters.size))]
+    spike_times = spike_times.astype(np.float64)
+
+    def spikes_of(cluster):
+        ic = np.searchsorted(clusters, cluster)
+        if ic == clusters.size or clusters[ic] != cluster:
+            return np.array([], dtype=np.int64)
+        return isort[bounds[ic]:bounds[ic + 1]]
+
+    correlograms = np.zeros((pairs.shape[0], 2 * half + 1), dtype=np.int32)
+    for k, (a, b) in enumerate(pairs):
+        correlograms[k] = _xcorr_pair(spikes_of(a), spikes_of(b), spike_times, bin_size, half, chunk_size)
+    return pairs, correlograms
+
+
 def classify(population_activity, trial_labels, classifier, cross_validation=None,
              return_training=False):
     """
@@ -3,7 +3,7 @@ Computes properties of single-cells, e.g. the autocorrelation and firing rate.
 '''
 
 import numpy as np
-from scipy.signal import convolve, gaussian
+from scipy.signal import fftconvolve, gaussian
 from iblutil.util import Bunch
 from brainbox.population.decode import xcorr
 
@@ -100,7 +100,8 @@ def bin_spikes2D(spike_times, spike_clusters, cluster_ids, align_times, pre_time
 
 def calculate_peths(
         spike_times, spike_clusters, cluster_ids, align_times, pre_time=0.2,
-        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True):
+        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True, dtype=np.float64,
+        chunk_size=None):
     """
     Calcluate peri-event time histograms; return means and standard deviations
     for each time point across specified clusters
@@ -124,9 +125,15 @@ def calculate_peths(
     :type smoothing: float
     :param return_fr: `True` to return (estimated) firing rate, `False` to return spike counts
     :type return_fr: bool
+    :param dtype: data type of the binned spikes output, use np.float32 to halve the memory
+    :type dtype: numpy dtype
+    :param chunk_size: number of align times binned and smoothed at once, defaults to all.
+     Bounds the size of the intermediate arrays for large numbers of events / clusters
+    :type chunk_size: int
     :return: peths, binned_spikes
     :rtype: peths: Bunch({'mean': peth_means, 'std': peth_stds, 'tscale': ts, 'cscale': ids})
     :rtype: binned_spikes: np.array (n_align_times, n_clusters, n_bins)
+    :raises ValueError: if align_times is empty
     """
 
     # initialize containers
@@ -134,7 +141,15 @@ def calculate_peths(
     n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
     n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
     n_bins = n_bins_pre + n_bins_post
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
+    align_times = np.asarray(align_times)
+    if align_times.size == 0:
+        raise ValueError('align_times is empty: at least one event is needed to compute the peths')
+    ids = np.unique(cluster_ids)
+    n_events, n_clusters = (align_times.size, ids.size)
+    # ts represent bin edges, and the last bin only contains spikes falling on the last edge
+    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+    nx = tscale.size
+    binned_spikes = np.zeros(shape=(n_events, n_clusters, n_bins - 2 * n_offset), dtype=dtype)
 
     # build gaussian kernel if requested
     if smoothing > 0:
@@ -143,65 +158,55 @@ def calculate_peths(
         # half (causal) gaussian filter
         # window[int(np.ceil(w/2)):] = 0
         window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
-
-    ids = np.unique(cluster_ids)
 
-    # filter spikes outside of the loop
-    idxs = np.bitwise_and(spike_times >= np.min(align_times) - (n_bins_pre + 1) * bin_size,
-                          spike_times <= np.max(align_times) + (n_bins_post + 1) * bin_size)
-    idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
+    # keep only the spikes from the selected clusters, sorted by time, and index their clusters
+    spike_times, spike_clusters = (np.asarray(spike_times), np.asarray(spike_clusters))
+    idxs = np.isin(spike_clusters, ids)
     spike_times = spike_times[idxs]
-    spike_clusters = spike_clusters[idxs]
-
-    # compute floating tscale
-    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        xind = (np.floor((i_spikes - np.min(ts)) / bin_size)).astype(np.int64)
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
-
-        # smooth
+    spike_clusters = np.searchsorted(ids, spike_clusters[idxs])
+    if np.any(np.diff(spike_times) < 0):
+        ordre = np.argsort(spike_times, kind='stable')
+        spike_times, spike_clusters = (spike_times[ordre], spike_clusters[ordre])
+
+    # the mean and std are accumulated over chunks of events. The data is shifted by the first
+    # event values to avoid numerical cancellation when computing the variance
+    chunk_size = chunk_size or max(n_events, 1)
+    sum_, sum_sq, shift = (0, 0, None)
+    for first in np.arange(0, n_events, chunk_size):
+        t0s = align_times[first:first + chunk_size]
+        nev = t0s.size
+        # window of each event in the sorted spike times: spikes within ts[0] <= t <= ts[-1]
+        tstart = tscale[0] + t0s
+        i0 = np.searchsorted(spike_times, tstart, side='left')
+        i1 = np.searchsorted(spike_times, tscale[-1] + t0s, side='right')
+        # flat indices of all (event, spike) pairs and a single bincount into (events, clusters, bins)
+        counts = i1 - i0
+        iev = np.repeat(np.arange(nev), counts)
+        ispi = i0[iev] + np.arange(iev.size) - (np.cumsum(counts) - counts)[iev]
+        xind = (np.floor((spike_times[ispi] - tstart[iev]) / bin_size)).astype(np.int64)
+        ind3d = (iev * n_clusters + spike_clusters[ispi]) * nx + xind
+        r = np.bincount(ind3d, minlength=nev * n_clusters * nx).reshape(nev, n_clusters, nx)
+        binned_spikes[first:first + nev] = r[:, :, n_offset:n_bins - n_offset]
+
+        # smooth all the rows at once along the time axis
         if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode='same', method='auto')[:-1]
+            r = fftconvolve(r, window[np.newaxis, np.newaxis, :], mode='same', axes=2)
+        r = r[:, :, n_offset:n_bins - n_offset].astype(np.float64)
+        if return_fr:
+            r /= bin_size
+        if shift is None:
+            shift = r[0].copy()
+        r -= shift
+        sum_ += np.sum(r, axis=0)
+        sum_sq += np.sum(r ** 2, axis=0)
 
     # average
-    if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
-    else:
-        binned_spikes_ = np.copy(binned_spikes)
-    if return_fr:
-        binned_spikes_ /= bin_size
-
-    peth_means = np.mean(binned_spikes_, axis=0)
-    peth_stds = np.std(binned_spikes_, axis=0)
-
-    if smoothing > 0:
-        peth_means = peth_means[:, n_offset:-n_offset]
-        peth_stds = peth_stds[:, n_offset:-n_offset]
-        binned_spikes = binned_spikes[:, :, n_offset:-n_offset]
-        tscale = tscale[n_offset:-n_offset]
+    peth_means = sum_ / n_events
+    peth_stds = np.sqrt(np.maximum(sum_sq / n_events - peth_means ** 2, 0))
+    peth_means += shift
 
     # package output
+    tscale = tscale[n_offset:nx - n_offset]
     tscale = (tscale[:-1] + tscale[1:]) / 2
     peths = Bunch({'means': peth_means, 'stds': peth_stds, 'tscale': tscale, 'cscale': ids})
     return peths, binned_spikes
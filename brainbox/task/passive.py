@@ -2,10 +2,34 @@
 Functions dealing with passive task
 """
 import numpy as np
+import scipy.sparse
 from brainbox.processing import bincount2D
 from scipy.linalg import svd
 
 
+def get_rf_map_states(rf_map_frames, file_states=None):
+    """
+    Compact representation of the receptive field mapping stimulus, computed in one pass over
+    the frames
+    Parameters
+    ----------
+    rf_map_frames: receptive field map frames np.array(n_frames, x_pos, y_pos)
+    file_states: (optional) .npy file in which the states are saved, the cube returned is then
+    memory mapped
+
+    Returns
+    -------
+    rf_map_states: int8 np.array(n_frames, x_pos, y_pos), state of each pixel on each frame:
+    1 for white squares, -1 for black squares and 0 for gray
+    """
+    gray = np.median(rf_map_frames)
+    rf_map_states = np.sign(rf_map_frames - gray).astype(np.int8)
+    if file_states is not None:
+        np.save(file_states, rf_map_states)
+        rf_map_states = np.load(file_states, mmap_mode='r')
+    return rf_map_states
+
+
 def get_on_off_times_and_positions(rf_map):
     """
 
@@ -24,47 +48,69 @@ def get_on_off_times_and_positions(rf_map):
     """
 
     rf_map_times = rf_map['times']
-    rf_map_frames = rf_map['frames'].astype('float')
-
-    gray = np.median(rf_map_frames)
-
-    x_bin = rf_map_frames.shape[1]
-    y_bin = rf_map_frames.shape[2]
-
-    stim_on_frames = np.zeros((x_bin * y_bin, 1), dtype=np.ndarray)
-    stim_off_frames = np.zeros((x_bin * y_bin, 1), dtype=np.ndarray)
-    rf_map_pos = np.zeros((x_bin * y_bin, 2), dtype=int)
-
-    i = 0
-    for x_pos in np.arange(x_bin):
-        for y_pos in np.arange(y_bin):
+    rf_map_states = rf_map['states'] if 'states' in rf_map else get_rf_map_states(rf_map['frames'])
 
-            pixel_val = rf_map_frames[:, x_pos, y_pos] - gray
-            pixel_non_grey = np.where(pixel_val != 0)[0]
-            # Find cases where the frame before was gray (i.e when the stim came on)
-            frame_change = np.where(rf_map_frames[pixel_non_grey - 1, x_pos, y_pos] == gray)[0]
+    x_bin = rf_map_states.shape[1]
+    y_bin = rf_map_states.shape[2]
+    rf_map_pos = np.c_[np.repeat(np.arange(x_bin), y_bin), np.tile(np.arange(y_bin), x_bin)]
 
-            stim_pos = pixel_non_grey[frame_change]
-
-            # On stimulus, white squares
-            on_pix = np.where(pixel_val[stim_pos] > 0)[0]
-            stim_on = stim_pos[on_pix]
-            stim_on_frames[i, 0] = stim_on
-
-            off_pix = np.where(pixel_val[stim_pos] < 0)[0]
-            stim_off = stim_pos[off_pix]
-            stim_off_frames[i, 0] = stim_off
-
-            rf_map_pos[i, :] = [x_pos, y_pos]
-            i += 1
+    # pixels (ordered by x then y) by frames, stim onsets are when the frame before was gray
+    states = np.reshape(np.transpose(rf_map_states, (1, 2, 0)), (x_bin * y_bin, -1))
+    onsets = np.logical_and(states != 0, np.roll(states, 1, axis=1) == 0)
 
     rf_stim_frames = {}
-    rf_stim_frames['on'] = stim_on_frames
-    rf_stim_frames['off'] = stim_off_frames
+    for stim_type, sign in zip(['on', 'off'], [1, -1]):
+        ipix, iframes = np.nonzero(np.logical_and(onsets, states == sign))
+        stim_frames = np.zeros((x_bin * y_bin, 1), dtype=np.ndarray)
+        stim_frames[:, 0] = np.split(iframes, np.searchsorted(ipix, np.arange(1, x_bin * y_bin)))
+        rf_stim_frames[stim_type] = stim_frames
 
     return rf_map_times, rf_map_pos, rf_stim_frames
 
 
+def _average_event_windows(binned_array, times, event_times, event_groups, n_groups, pre_stim, post_stim,
+                           n_bins):
+    """
+    For all the rows of the binned array at once, averages the windows of n_bins starting
+    pre_stim before each event, per group of events. The windows are summed per group by a sparse
+    product with the (groups, time bins) matrix of the events onsets, one time lag at a time.
+    Events with windows extending past the binned array are discarded.
+    :return: np.array(n_rows, n_groups, n_bins), zero for the groups without events
+    """
+    n_rows, n_times = binned_array.shape
+    stim_intervals = np.c_[event_times - pre_stim, event_times + post_stim]
+    iok = stim_intervals[:, 1] <= times[-1]
+    idx_start = np.searchsorted(times, stim_intervals[iok, 0])
+    event_groups = event_groups[iok]
+    onsets = scipy.sparse.csr_matrix((np.ones(idx_start.size), (event_groups, idx_start)), shape=(n_groups, n_times))
+    binned = np.r_[binned_array.T, np.zeros((n_bins, n_rows))]
+    sums = np.zeros((n_groups, n_rows, n_bins))
+    for lag in range(n_bins):
+        sums[:, :, lag] = onsets @ binned[lag:lag + n_times]
+    counts = np.bincount(event_groups, minlength=n_groups)
+    sums[counts > 0] /= counts[counts > 0, np.newaxis, np.newaxis]
+    return np.transpose(sums, (1, 0, 2))
+
+
+def _rf_map_from_binned(binned_array, times, rf_map_times, rf_map_pos, rf_stim_frames, t_bin,
+                        pre_stim, post_stim):
+    x_bin = len(np.unique(rf_map_pos[:, 0]))
+    y_bin = len(np.unique(rf_map_pos[:, 1]))
+    n_bins = int((pre_stim + post_stim) / t_bin)
+    rf_map = {}
+    for stim_type, stims in rf_stim_frames.items():
+        # all the stimulus onsets of all pixels at once
+        stim_frames = [stim_frame[0] for stim_frame in stims]
+        ipix = np.repeat(np.arange(len(stim_frames)), [len(sf) for sf in stim_frames])
+        stim_on_times = rf_map_times[np.concatenate(stim_frames).astype(int)]
+        avg = _average_event_windows(binned_array, times, stim_on_times, ipix, len(stim_frames),
+                                     pre_stim, post_stim, n_bins)
+        _rf_map = np.zeros(shape=(binned_array.shape[0], x_bin, y_bin, n_bins))
+        _rf_map[:, rf_map_pos[:, 0], rf_map_pos[:, 1], :] = avg
+        rf_map[stim_type] = _rf_map
+    return rf_map
+
+
 def get_rf_map_over_depth(rf_map_times, rf_map_pos, rf_stim_frames, spike_times, spike_depths,
                           t_bin=0.01, d_bin=80, pre_stim=0.05, post_stim=1.5, y_lim=[0, 3840],
                           x_lim=None):
@@ -93,45 +139,38 @@ def get_rf_map_over_depth(rf_map_times, rf_map_pos, rf_stim_frames, spike_times,
 
     binned_array, times, depths = bincount2D(spike_times, spike_depths, t_bin, d_bin,
                                              ylim=y_lim, xlim=x_lim)
+    rf_map = _rf_map_from_binned(binned_array, times, rf_map_times, rf_map_pos, rf_stim_frames,
+                                 t_bin, pre_stim, post_stim)
+    return rf_map, depths
 
-    x_bin = len(np.unique(rf_map_pos[:, 0]))
-    y_bin = len(np.unique(rf_map_pos[:, 1]))
-    n_bins = int((pre_stim + post_stim) / t_bin)
-
-    rf_map = {}
-
-    for stim_type, stims in rf_stim_frames.items():
-        _rf_map = np.zeros(shape=(depths.shape[0], x_bin, y_bin, n_bins))
-        for pos, stim_frame in zip(rf_map_pos, stims):
-
-            x_pos = pos[0]
-            y_pos = pos[1]
-
-            # Case where there is no stimulus at this position
-            if len(stim_frame[0]) == 0:
-                _rf_map[:, x_pos, y_pos, :] = np.zeros((depths.shape[0], n_bins))
-                continue
-
-            stim_on_times = rf_map_times[stim_frame[0]]
-            stim_intervals = np.c_[stim_on_times - pre_stim, stim_on_times + post_stim]
-
-            out_intervals = stim_intervals[:, 1] > times[-1]
-            idx_intervals = np.searchsorted(times, stim_intervals)[np.invert(out_intervals)]
-
-            # Case when no spikes during the passive period
-            if idx_intervals.shape[0] == 0:
-                avg_stim_trials = np.zeros((depths.shape[0], n_bins))
-            else:
-                stim_trials = np.zeros((depths.shape[0], n_bins, idx_intervals.shape[0]))
-                for i, on in enumerate(idx_intervals):
-                    stim_trials[:, :, i] = binned_array[:, on[0]:on[1]]
-                avg_stim_trials = np.mean(stim_trials, axis=2)
 
-            _rf_map[:, x_pos, y_pos, :] = avg_stim_trials
+def get_rf_map_over_clusters(rf_map_times, rf_map_pos, rf_stim_frames, spike_times, spike_clusters,
+                             t_bin=0.01, pre_stim=0.05, post_stim=1.5, x_lim=None):
+    """
+    Compute receptive field map for each stimulus onset for all clusters at once
+    Parameters
+    ----------
+    rf_map_times
+    rf_map_pos
+    rf_stim_frames
+    spike_times: array of spike times
+    spike_clusters: array of spike clusters
+    t_bin: bin size along time dimension
+    pre_stim: time period before rf map stim onset to epoch around
+    post_stim: time period after rf map onset to epoch around
+    x_lim: values to limit in time direction
 
-        rf_map[stim_type] = _rf_map
+    Returns
+    -------
+    rfmap: receptive field map for 'on' 'off' stimuli.
+    Each rfmap has shape (clusters, x_pos, y_pos, epoch_window)
+    clusters: clusters for which the receptive field map has been computed
+    """
 
-    return rf_map, depths
+    binned_array, times, clusters = bincount2D(spike_times, spike_clusters, t_bin, xlim=x_lim)
+    rf_map = _rf_map_from_binned(binned_array, times, rf_map_times, rf_map_pos, rf_stim_frames,
+                                 t_bin, pre_stim, post_stim)
+    return rf_map, clusters
 
 
 def get_svd_map(rf_map):
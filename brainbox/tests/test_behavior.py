@@ -163,6 +163,21 @@ class TestTraining(unittest.TestCase):
                                    rtol=1e-5)
         assert (np.isclose(rt, 0.83655))
 
+    def test_compute_psychometric_batch(self):
+        trials, _ = self._get_trials(sess_dates=['2020-09-01', '2020-09-02', '2020-09-03'])
+        trials_all = train.concatenate_trials(trials)
+        blocks = [None, 0.2, 0.8, 100]
+        psychs = train.compute_psychometric_batch([trials_all] * 4, blocks=blocks)
+        self.assertEqual(psychs.shape, (4, 4))
+        # empty blocks are NaN
+        self.assertTrue(np.all(np.isnan(psychs[3])))
+        for psych, block in zip(psychs[:3], blocks):
+            expected = train.compute_psychometric(trials_all, block=block)
+            np.testing.assert_allclose(psych, expected, rtol=1e-2, atol=1e-2)
+        # warm start from the fit parameters
+        warm = train.compute_psychometric_batch([trials_all] * 4, blocks=blocks, parstart=psychs, nfits=1)
+        np.testing.assert_allclose(warm[:3], psychs[:3], rtol=1e-2, atol=1e-2)
+
     def test_in_training(self):
         trials, task_protocol = self._get_trials(
             sess_dates=['2020-08-25', '2020-08-24', '2020-08-21'])
@@ -390,5 +405,51 @@ class PsychofitTest(unittest.TestCase):
         self.assertTrue(np.allclose(expected, pars, rtol=.01), f'unexpected pars for {model}')
         self.assertTrue(np.isclose(-195.55603, L, atol=1e-5), f'unexpected likelihood for {model}')
 
+    def test_mle_fit_psycho_batch(self):
+        # A single fit follows the same iterations as mle_fit_psycho
+        for model in self.test_data.keys():
+            np.random.seed(0)
+            expected_pars, expected_L = psy.mle_fit_psycho(self.test_data[model], P_model=model, nfits=1)
+            pars, L = psy.mle_fit_psycho_batch([self.test_data[model]], P_model=model, nfits=1)
+            np.testing.assert_allclose(pars[0], expected_pars, atol=1e-6)
+            np.testing.assert_allclose(L[0], expected_L, atol=1e-6)
+
+        # Datasets of different sizes, with missing conditions and per dataset bounds
+        model = 'erf_psycho_2gammas'
+        data = self.test_data[model]
+        datasets = [data, data[:, 2:], data.copy()]
+        datasets[2][2, 4] = np.nan
+        parmin = np.array([[-50., 0., 0., 0.], [-30., 0., 0., 0.], [-50., 0., 0., 0.]])
+        parmax = np.array([[50., 100., 1., 1.], [50., 100., 1., 1.], [50., 100., 1., 1.]])
+        parstart = np.array([0., 20., .05, .05])
+        pars, L = psy.mle_fit_psycho_batch(datasets, P_model=model, parstart=parstart,
+                                           parmin=parmin, parmax=parmax, nfits=1)
+        self.assertEqual(pars.shape, (3, 4))
+        for i, d in enumerate(datasets):
+            expected_pars, expected_L = psy.mle_fit_psycho(
+                d, P_model=model, parstart=parstart, parmin=parmin[i], parmax=parmax[i], nfits=1)
+            np.testing.assert_allclose(pars[i], expected_pars, atol=1e-6)
+            np.testing.assert_allclose(L[i], expected_L, atol=1e-6)
+
+        # Random restarts can only improve the likelihood
+        _, L10 = psy.mle_fit_psycho_batch(datasets, P_model=model, parstart=parstart,
+                                          parmin=parmin, parmax=parmax, nfits=10)
+        self.assertTrue(np.all(L10 >= L - 1e-6))
+
+        # Random starting points, some of which exhaust the 200 * n function evaluations of fmin
+        rs = np.random.RandomState(1)
+        datasets, parstart = [], parmin[0] + rs.rand(20, 4) * (parmax[0] - parmin[0])
+        for _ in range(20):
+            nn = rs.randint(10, 60, data.shape[1])
+            p = psy.erf_psycho_2gammas([rs.uniform(-10, 10), rs.uniform(5, 30), .1, .1], data[0])
+            datasets.append(np.vstack([data[0], nn, rs.binomial(nn, p) / nn]))
+        pars, L = psy.mle_fit_psycho_batch(datasets, P_model=model, parstart=parstart,
+                                           parmin=parmin[0], parmax=parmax[0], nfits=1)
+        for i, d in enumerate(datasets):
+            expected_pars, expected_L = psy.mle_fit_psycho(
+                d, P_model=model, parstart=parstart[i], parmin=parmin[0], parmax=parmax[0], nfits=1)
+            np.testing.assert_allclose(pars[i], expected_pars, atol=1e-6)
+            np.testing.assert_allclose(L[i], expected_L, atol=1e-6)
+
     def tearDown(self):
         np.random.seed()
@@ -1,15 +1,22 @@
 import json
 from pathlib import Path
 import unittest
+from unittest import mock
 import tempfile
 import shutil
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 
 import numpy as np
 import numpy.testing
 
+import spikeglx
 from brainbox.io import one as bbone
+from brainbox.io.spikeglx import Streamer
 from one.api import ONE
 from one.alf.cache import make_parquet_db
+from one.webclient import http_download_file
 
 
 class TestIO_ALF(unittest.TestCase):
@@ -86,5 +93,98 @@ class TestIO_ONE(unittest.TestCase):
         self.assertRaises(ValueError, bbone.load_iti, trials)
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Local stand-in for the data server, serving files with support for byte range requests"""
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        file = Path(self.translate_path(self.path))
+        first, last = map(int, self.headers['Range'].replace('bytes=', '').split('-'))
+        self.requests.append((file.name, first, last))
+        with open(file, 'rb') as fid:
+            fid.seek(first)
+            data = fid.read(last - first + 1)
+        self.send_response(206)
+        self.send_header('Content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TestStreamer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # compressed file on the server, ch and meta files available locally
+        server_dir = self.tmpdir.joinpath('server', 'probe00')
+        server_dir.mkdir(parents=True)
+        meta_file = Path(__file__).parents[2].joinpath(
+            'ibllib', 'tests', 'fixtures', 'sync_ephys_fpga', 'sample3B_g0_t0.nidq.meta')
+        self.mock = spikeglx._mock_spikeglx_file(
+            server_dir.joinpath('sample3B_g0_t0.nidq.bin'), meta_file, ns=30003 * 5, nc=2, sync_depth=8, random=True)
+        sr = spikeglx.Reader(self.mock['bin_file'])
+        sr.compress_file(keep_original=False)
+        sr.close()
+        local_dir = self.tmpdir.joinpath('local')
+        local_dir.mkdir()
+        for ext in ['.ch', '.meta']:
+            shutil.copy(server_dir.joinpath('sample3B_g0_t0.nidq' + ext), local_dir)
+        # serves the files in a background thread
+        handler = partial(RangeRequestHandler, directory=str(self.tmpdir.joinpath('server')))
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url_server = f'http://127.0.0.1:{self.server.server_address[1]}'
+        # mock ONE instance pointing to the local server
+        self.one = mock.MagicMock()
+        self.one.alyx._par.CACHE_DIR = str(self.tmpdir.joinpath('cache'))
+        self.one.alyx._par.HTTP_DATA_SERVER = url_server
+        self.one.alyx.download_file.side_effect = lambda url, **kwargs: http_download_file(url, silent=True, **kwargs)
+        self.one.pid2eid.return_value = ('eid', 'probe00')
+        self.one.load_dataset.side_effect = lambda eid, pattern, **kwargs: next(local_dir.glob(pattern))
+        self.one.record2url.return_value = [f'{url_server}/probe00/sample3B_g0_t0.nidq.cbin']
+        RangeRequestHandler.requests = []
+
+    def test_streamer_cache(self):
+        sr = Streamer(pid='pid', one=self.one, typ='nidq', cache_size=None)
+        nc = len(sr.chunks['chunk_bounds']) - 1
+        self.assertEqual(nc, 5)
+        # read across chunk boundaries and compare with the original data
+        data = sr[25000:70000, :]
+        np.testing.assert_allclose(data, self.mock['D'][25000:70000, :] * sr.channel_conversion_sample2v['nidq'],
+                                   rtol=1e-6)
+        np.testing.assert_array_equal(sr.read(slice(100, 200), volts=False), self.mock['D'][100:200, :])
+        self.assertEqual(len(RangeRequestHandler.requests), 3)
+        # overlapping reads use the cached chunks
+        sr[40000:100000, :]
+        self.assertEqual(len(RangeRequestHandler.requests), 4)
+        self.assertEqual(len(list(sr._chunk_dir(0).parent.glob('chunk_*'))), 4)
+        # with a bounded cache the least recently used chunks are removed, except the ones being read
+        sr.cache_size = 1
+        sr._chunk_dir(1).joinpath('.reader_0_otherprocess').touch()
+        sr[140000:141000, 0]
+        self.assertEqual(sorted(d.name for d in sr._chunk_dir(0).parent.glob('chunk_*')),
+                         ['chunk_000001', 'chunk_000004'])
+        sr.close()
+        # with remove cached, the chunks are downloaded in private folders removed after each read
+        sr = Streamer(pid='pid', one=self.one, typ='nidq', remove_cached=True)
+        self.assertNotEqual(sr._chunk_dir(1).name, 'chunk_000001')
+        sr[50000:70000, :]
+        self.assertEqual(sorted(d.name for d in sr._chunk_dir(0).parent.glob('chunk_*')),
+                         ['chunk_000001', 'chunk_000004'])
+
+    def test_streamer_prefetch(self):
+        sr = Streamer(pid='pid', one=self.one, typ='nidq', prefetch=2)
+        data = np.concatenate([sr[i * 30003:(i + 1) * 30003, :] for i in range(5)])
+        sr.close()
+        np.testing.assert_allclose(data, self.mock['D'] * sr.channel_conversion_sample2v['nidq'], rtol=1e-6)
+        # each chunk is downloaded exactly once
+        self.assertEqual(sorted(r[1] for r in RangeRequestHandler.requests), sr.chunks['chunk_offsets'][:-1])
+
+
 if __name__ == '__main__':
     unittest.main(exit=False, verbosity=2)
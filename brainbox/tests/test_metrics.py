@@ -1,6 +1,7 @@
 import numpy as np
 from brainbox.metrics import electrode_drift
-from brainbox.metrics.single_units import quick_unit_metrics, noise_cutoff
+from brainbox.metrics.single_units import (quick_unit_metrics, noise_cutoff, missed_spikes_est,
+                                           contamination, contamination_alt, METRICS_PARAMS)
 from iblutil.numerical import ismember
 
 REC_LEN_SECS = 1000
@@ -69,6 +70,33 @@ def test_clusters_metrics():
     _assertions(dfm, idf, np.arange(5))
 
 
+def test_clusters_metrics_grouped():
+    """
+    Checks the grouped computation against the single unit functions, including the process pool
+    """
+    np.random.seed(42)
+    frs = np.array([3, 100, 80, 40, 60])
+    cid = np.array([0, 1, 3, 4, 6])
+    t, a, c = multiple_spike_trains(firing_rates=frs, rec_len_secs=200, cluster_ids=cid)
+    t[np.where(c == 3)[0][:20]] -= 1e-5  # add some duplicate spikes
+    t = np.sort(t)
+    d = np.random.randn(t.size) * 10
+    cluster_ids = np.arange(7)
+    rp, min_isi = (METRICS_PARAMS['refractory_period'], METRICS_PARAMS['min_isi'])
+    for n_workers in [1, 2]:
+        r = quick_unit_metrics(c, t, a, d, cluster_ids=cluster_ids, n_workers=n_workers)
+        for i in cid:
+            ts, amps, depths = (t[c == i], a[c == i], d[c == i])
+            assert np.isclose(r.contamination_alt[i], contamination_alt(ts, rp=rp))
+            assert np.isclose(r.contamination[i], contamination(ts, t[0], t[-1], rp=rp, min_isi=min_isi)[0])
+            assert np.isclose(r.drift[i], np.sum(np.abs(np.diff(depths))) / (t[-1] - t[0]) * 3600)
+            np.testing.assert_equal(r.noise_cutoff[i], noise_cutoff(amps, **METRICS_PARAMS['noise_cutoff'])[1])
+            np.testing.assert_equal(
+                r.missed_spikes_est[i], missed_spikes_est(amps, **METRICS_PARAMS['missed_spikes_est'])[0])
+        # cluster 5 has no spikes
+        assert np.all(np.isnan([r.contamination[5], r.drift[5], r.noise_cutoff[5]]))
+
+
 def test_drift_estimate():
     """
     From spike depths, xcorrelate drift maps to find a drift estimate
@@ -89,6 +117,11 @@ def test_drift_estimate():
     # plt.plot(ts, drift_)
     # plt.plot(ts, drift)
     assert np.all(np.abs(drift - drift_)[2:] < 4)
+    # processed in blocks, in parallel and per shank, the output matches the full estimate
+    for kwargs in [dict(block_secs=50), dict(block_secs=60, n_workers=2, spike_shanks=c % 4)]:
+        drift_blocks, ts_blocks = electrode_drift.estimate_drift(t, a, cells_depth[c] + dcor, **kwargs)
+        np.testing.assert_array_equal(ts_blocks, ts)
+        assert np.all(np.abs(drift_blocks - drift_)[2:] < 4)
 
 
 def test_noise_cut_off():
@@ -1,3 +1,5 @@
+from pathlib import Path
+import tempfile
 import unittest
 import numpy as np
 import brainbox.task.passive as passive
@@ -69,6 +71,44 @@ class TestPassive(unittest.TestCase):
         self.assertTrue(np.all(np.isclose(np.vstack(rf_svd['on']), 0)))
         self.assertTrue(np.all(np.vstack(rf_svd['off']) == 0))
 
+    def test_rf_map_states_and_clusters(self):
+        test_frames = np.full((60, 15, 15), 128, dtype='uint8')
+        test_frames[10:20, 8, 8] = 0
+        test_frames[25:35, 10, 13] = 255
+        test_frames[50:60, 8, 8] = 0
+        states = passive.get_rf_map_states(test_frames)
+        self.assertEqual(states.dtype, np.int8)
+        np.testing.assert_array_equal(states, np.sign(test_frames.astype(int) - 128))
+        with tempfile.TemporaryDirectory() as td:
+            file_states = Path(td).joinpath('rf_map_states.npy')
+            states_mmap = passive.get_rf_map_states(test_frames, file_states=file_states)
+            self.assertIsInstance(states_mmap, np.memmap)
+            np.testing.assert_array_equal(states_mmap, states)
+            del states_mmap
+        # the on/off frames are the same computed from the frames or from the states
+        rf_map = {'times': np.arange(60), 'frames': test_frames}
+        _, rf_map_pos, rf_stim_frames = passive.get_on_off_times_and_positions(rf_map)
+        _, _, rf_stim_frames_ = passive.get_on_off_times_and_positions({'times': np.arange(60), 'states': states})
+        for stim_type in ['on', 'off']:
+            for sf, sf_ in zip(rf_stim_frames[stim_type], rf_stim_frames_[stim_type]):
+                np.testing.assert_array_equal(sf[0], sf_[0])
+        # two clusters firing after the on and the off stimuli respectively
+        spike_times = np.r_[np.arange(25, 27, 0.01), np.arange(10, 12, 0.01), np.arange(50, 52, 0.01)]
+        spike_clusters = np.r_[np.zeros(200), np.ones(400)].astype(int)
+        isort = np.argsort(spike_times)
+        rf_map_clu, clusters = passive.get_rf_map_over_clusters(
+            rf_map['times'], rf_map_pos, rf_stim_frames, spike_times[isort], spike_clusters[isort], x_lim=[0, 60])
+        np.testing.assert_array_equal(clusters, [0, 1])
+        self.assertEqual(rf_map_clu['on'].shape, (2, 15, 15, 155))
+        self.assertTrue(np.all(np.where(rf_map_clu['on'] != 0)[:3] == np.array([0, 10, 13])[:, np.newaxis]))
+        self.assertTrue(np.all(np.where(rf_map_clu['off'] != 0)[:3] == np.array([1, 8, 8])[:, np.newaxis]))
+        # the clusters map matches the depth map when each cluster is at its own depth
+        rf_map_depth, _ = passive.get_rf_map_over_depth(
+            rf_map['times'], rf_map_pos, rf_stim_frames, spike_times[isort], spike_clusters[isort] * 3000 + 100,
+            x_lim=[0, 60], d_bin=3000)
+        for stim_type in ['on', 'off']:
+            np.testing.assert_allclose(rf_map_depth[stim_type][:2], rf_map_clu[stim_type])
+
     def test_stim_aligned(self):
 
         # Make random times
@@ -2,7 +2,7 @@ from pathlib import Path
 import pickle
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.model_selection import KFold
-from brainbox.population.decode import (xcorr, classify, regress, get_spike_counts_in_bins,
+from brainbox.population.decode import (xcorr, xcorr_pairs, classify, regress, get_spike_counts_in_bins,
                                         sigtest_pseudosessions, sigtest_linshift)
 import unittest
 import numpy as np
@@ -38,6 +38,30 @@ class TestPopulation(unittest.TestCase):
         self.assertEqual(counts.shape, (num_clusters, np.size(event_times)))
         self.assertTrue(np.size(cluster_ids) == num_clusters)
 
+    def test_get_spike_counts_in_bins_synthetic(self):
+        np.random.seed(42)
+        spike_times, spike_clusters = _random_data(100)
+        spike_clusters = spike_clusters * 3  # sparse cluster ids
+        t0 = np.sort(np.random.rand(200) * spike_times[-1])
+
+        def _counts_loop(intervals):
+            cluster_ids = np.unique(spike_clusters)
+            counts = np.zeros((cluster_ids.size, intervals.shape[0]), dtype=np.uint32)
+            for j, (start, end) in enumerate(intervals):
+                sel = np.logical_and(spike_times >= start, spike_times < end)
+                counts[:, j] = np.sum(spike_clusters[sel] == cluster_ids[:, np.newaxis], axis=1)
+            return counts, cluster_ids
+
+        # non-overlapping intervals, overlapping intervals, heavily overlapping intervals
+        for intervals in (np.c_[t0[:-1], t0[1:]], np.c_[t0, t0 + 2], np.c_[t0, t0 + 80]):
+            expected, expected_ids = _counts_loop(intervals)
+            counts, cluster_ids = get_spike_counts_in_bins(spike_times, spike_clusters, intervals)
+            np.testing.assert_array_equal(counts, expected)
+            np.testing.assert_array_equal(cluster_ids, expected_ids)
+            self.assertEqual(counts.dtype, np.uint32)
+            counts, _ = get_spike_counts_in_bins(spike_times, spike_clusters, intervals, return_sparse=True)
+            np.testing.assert_array_equal(counts.toarray(), expected)
+
     def test_classify(self):
         if self.test_data is None:
             return
@@ -139,6 +163,26 @@ class TestPopulation(unittest.TestCase):
 
         self.assertEqual(c.shape, (max_cluster, max_cluster, 51))
 
+    def test_xcorr_pairs(self):
+        max_cluster = 10
+        spike_times, spike_clusters = _random_data(max_cluster)
+        # rounds the spike times to get spikes at the same time
+        spike_times = np.round(spike_times, 3)
+        bin_size, winsize_bins = .001, .05
+        c = xcorr(spike_times, spike_clusters, bin_size=bin_size, window_size=winsize_bins)
+        clusters = np.unique(spike_clusters)
+        # all pairs by default
+        pairs, cp = xcorr_pairs(spike_times, spike_clusters, bin_size=bin_size, window_size=winsize_bins,
+                                chunk_size=500)
+        self.assertEqual(cp.shape, (max_cluster * (max_cluster + 1) // 2, 51))
+        i, j = np.searchsorted(clusters, pairs.T)
+        np.testing.assert_array_equal(cp, c[i, j])
+        # subset of pairs, including a cluster without spikes
+        pairs, cp = xcorr_pairs(spike_times, spike_clusters, bin_size=bin_size, window_size=winsize_bins,
+                                pairs=[[3, 2], [5, 5], [5, max_cluster]])
+        np.testing.assert_array_equal(cp[:2], c[[3, 5], [2, 5]])
+        np.testing.assert_array_equal(cp[2], 0)
+
     def test_sigtest_pseudosessions(self):
         X = np.zeros((200, 700))
         y = np.zeros(700)
@@ -48,6 +48,31 @@ class TestPeths(unittest.TestCase):
         self.assertTrue(np.all(fr.shape == (n_events, len(cluster_sel), 28)))
         self.assertTrue(peth.tscale.size == 28)
 
+    def test_peths_chunks(self):
+        np.random.seed(seed=42)
+        spike_times = np.sort(np.random.rand(20000, ) * 1654)
+        spike_clusters = np.random.randint(0, 20, 20000)
+        event_times = np.sort(np.random.rand(200, ) * 1654)
+        cluster_sel = [15, 1, 2, 3, 6, 16]
+        peth, bs = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel,
+                                   align_times=event_times, smoothing=0, return_fr=False)
+        # check the binning of one cluster against a histogram
+        edges = np.arange(-8, 21) * 0.025 + event_times[5]
+        np.testing.assert_array_equal(bs[5, 2], np.histogram(spike_times[spike_clusters == 3], edges)[0])
+        np.testing.assert_allclose(peth.means, np.mean(bs, axis=0))
+        np.testing.assert_allclose(peth.stds, np.std(bs, axis=0), atol=1e-12)
+        # chunked computation and single precision output
+        peth_, bs_ = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel,
+                                     align_times=event_times, smoothing=0, return_fr=False,
+                                     chunk_size=33, dtype=np.float32)
+        self.assertEqual(bs_.dtype, np.float32)
+        np.testing.assert_array_equal(bs, bs_)
+        np.testing.assert_allclose(peth.means, peth_.means)
+        np.testing.assert_allclose(peth.stds, peth_.stds, atol=1e-12)
+        # no events
+        with self.assertRaises(ValueError):
+            calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel, align_times=[])
+
 
 def test_firing_rate():
     pass
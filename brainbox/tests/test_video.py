@@ -1,6 +1,9 @@
 import unittest
+import tempfile
+from pathlib import Path
 
 import numpy as np
+import cv2
 
 from brainbox import video
 
@@ -56,6 +59,37 @@ class TestVideo(unittest.TestCase):
         expected = np.ones(expected_shape, dtype=np.uint8) * 2
         np.testing.assert_equal(df, expected)
 
+    def test_motion_energy_from_video(self):
+        with tempfile.TemporaryDirectory() as td:
+            file = Path(td) / 'test.avi'
+            rng = np.random.default_rng(0)
+            writer = cv2.VideoWriter(str(file), cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+            for _ in range(37):
+                writer.write(rng.integers(0, 256, (48, 64, 3), dtype=np.uint8))
+            writer.release()
+            cap = cv2.VideoCapture(str(file))
+            frames = np.array([cap.read()[1][..., 0] for _ in range(37)])
+            cap.release()
+            rois = [np.s_[:10, :20], np.s_[30:, 15:40]]
+            d = 2
+            absdiff = np.abs(frames[d:].astype(np.int16) - frames[:-d])
+            expected = absdiff.sum(axis=(1, 2))
+            for n_workers in (1, 2):
+                me, roi_me = video.motion_energy_from_video(
+                    file, diff=d, rois=rois, chunk_size=8, n_workers=n_workers)
+                np.testing.assert_array_equal(me, expected)
+                for i, roi in enumerate(rois):
+                    np.testing.assert_array_equal(roi_me[:, i], absdiff[(slice(None), *roi)].sum(axis=(1, 2)))
+            # Frame range and no rois
+            me, roi_me = video.motion_energy_from_video(file, diff=d, frame_range=(5, 30), chunk_size=7)
+            self.assertIsNone(roi_me)
+            np.testing.assert_array_equal(me, expected[5:28])
+            # Consistent with in memory motion energy up to float rounding
+            df, _ = video.motion_energy(frames, diff=d, normalize=False)
+            np.testing.assert_allclose(df, expected, rtol=1e-3)
+            with self.assertRaises(ValueError):
+                video.motion_energy_from_video(file, diff=d, frame_range=(0, 2))
+
 
 if __name__ == '__main__':
     unittest.main()
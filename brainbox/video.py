@@ -1,7 +1,12 @@
 """Functions for analyzing video frame data"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
 import cv2
 
+from ibllib.io.video import get_video_frames_preload
+
 
 def frame_diff(frame1, frame2):
     """
@@ -69,3 +74,83 @@ def motion_energy(frames, diff=2, kernel=None, normalize=True):
     if normalize:
         df_ = (df_ - df_.min()) / (df_.max() - df_.min())
     return df_, stDev
+
+
+def _abs_diff_sum(frames, diff, rois):
+    """
+    Sum of the absolute difference between frames N and N + diff, computed in uint8 without float
+    promotion.
+    :param frames: uint8 array of frames (n, y, x)
+    :param diff: take difference between frames N and frames N + diff
+    :param rois: list of (y, x) index tuples, e.g. np.s_[10:50, 100:200]
+    :return: int64 vector (n - diff,) of the whole frame energy, int64 array (n - diff, n rois)
+    """
+    a, b = frames[diff:], frames[:-diff]
+    # |a - b| for unsigned integers without overflow: max - min
+    absdiff = np.maximum(a, b)
+    absdiff -= np.minimum(a, b)
+    me = absdiff.sum(axis=(1, 2), dtype=np.int64)
+    roi_me = np.zeros((me.size, len(rois)), dtype=np.int64)
+    for i, roi in enumerate(rois):
+        roi_me[:, i] = absdiff[(slice(None), *roi)].sum(axis=(1, 2), dtype=np.int64)
+    return me, roi_me
+
+
+def _motion_energy_chunk(first_last, video_path=None, diff=2, mask=None, rois=None):
+    """Loads frames [first, last + diff) of a video and returns the motion energy of frames [first, last)"""
+    first, last = first_last
+    frames = get_video_frames_preload(video_path, range(first, last + diff), mask=mask, quiet=True)
+    return _abs_diff_sum(frames, diff, rois)
+
+
+def motion_energy_from_video(video_path, diff=2, mask=np.s_[:, :, 0], rois=None, frame_range=None,
+                             chunk_size=500, n_workers=1):
+    """
+    Computes the motion energy of a video file without loading the whole video in memory.
+    The frames are read in chunks of chunk_size frames that overlap by diff frames, and the
+    absolute differences between frames N and N + diff are summed over each frame (and optionally
+    over each ROI).  Unlike motion_energy, the differences are exact integers and the output is not
+    normalized.  Chunks may be processed in parallel by a pool of processes, each holding a
+    single chunk in memory at a time.
+    :param video_path: local path to a video file
+    :param diff: take difference between frames N and frames N + diff
+    :param mask: a slice applied to each frame that must return a single channel (y, x) image
+    :param rois: an optional list of (y, x) index tuples into the masked frame, e.g.
+     [np.s_[10:50, 100:200]]
+    :param frame_range: (first, last) frames to process, by default the whole video
+    :param chunk_size: number of frame differences computed per chunk
+    :param n_workers: number of processes; chunks are processed serially if 1
+    :return me: int64 vector of length n frames - diff, the summed absolute frame differences
+    :return roi_me: int64 array (n frames - diff, n rois) of ROI energies, or None if no rois
+
+    Example - Compute the whisker pad energy of the first 10000 frames using 4 processes
+        me, (whiskers,) = motion_energy_from_video(
+            path, rois=[np.s_[100:200, 300:400]], frame_range=(0, 10000), n_workers=4)
+    """
+    if frame_range is None:
+        cap = cv2.VideoCapture(str(video_path))
+        frame_range = (0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        cap.release()
+    first, last = frame_range
+    n = last - first - diff
+    if n < 1:
+        raise ValueError('Difference must be less than number of frames')
+    last -= diff  # last frame difference
+    chunks = [(i, min(i + chunk_size, last)) for i in range(first, last, chunk_size)]
+    fcn = partial(_motion_energy_chunk, video_path=str(video_path), diff=diff, mask=mask,
+                  rois=list(rois or []))
+    me = np.zeros(n, dtype=np.int64)
+    roi_me = np.zeros((n, len(rois or [])), dtype=np.int64)
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(n_workers)
+        results = executor.map(fcn, chunks)
+    else:
+        executor, results = None, map(fcn, chunks)
+    try:
+        for (i0, i1), (me_, roi_me_) in zip(chunks, results):
+            me[i0 - first:i1 - first] = me_
+            roi_me[i0 - first:i1 - first] = roi_me_
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return me, (roi_me if rois else None)
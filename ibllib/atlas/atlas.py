@@ -1,15 +1,18 @@
 from dataclasses import dataclass
 import logging
+import os
 import matplotlib.pyplot as plt
 from pathlib import Path, PurePosixPath
 import numpy as np
 import nrrd
+import scipy.sparse as sp
 
 from one.webclient import http_download_file
 import one.params
 import one.remote.aws as aws
 
 from iblutil.numerical import ismember
+from iblutil.util import Bunch
 from ibllib.atlas.regions import BrainRegions, FranklinPaxinosRegions
 
 
@@ -20,6 +23,58 @@ PAXINOS_CCF_LANDMARKS_MLAPDV_UM = {'bregma': np.array([5700, 4300 + 160, 330])}
 S3_BUCKET_IBL = 'ibl-brain-wide-map-public'
 
 
+def _save_cache(file, volume=None, **arrays):
+    """
+    Saves a cache file through a temporary file and a rename, so that concurrent processes never
+    read a partially written file.
+    :param file: .npy file if volume is provided, .npz file otherwise
+    :param volume: array saved as an uncompressed .npy file
+    :param arrays: arrays saved in an uncompressed .npz file
+    :return: True if the file was written
+    """
+    file_tmp = file.with_name(f'{file.name}.{os.getpid()}.part')
+    try:
+        with open(file_tmp, 'wb') as fid:
+            if volume is not None:
+                np.save(fid, volume)
+            else:
+                np.savez(fid, **arrays)
+        os.replace(file_tmp, file)
+        return True
+    except OSError as e:
+        _logger.warning(f'Could not write atlas cache {file}: {e}')
+        file_tmp.unlink(missing_ok=True)
+        return False
+
+
+def _is_cache_fresh(file_cache, file_source):
+    return file_cache.exists() and file_source.exists() and file_cache.stat().st_mtime >= file_source.stat().st_mtime
+
+
+def _read_volume(file_volume, cache=True):
+    """
+    Reads an atlas volume from a nrrd or npz file. The decompressed volume is cached next to the
+    file as an uncompressed .npy file, which is memory mapped on subsequent reads: the
+    instantiation is near instant and processes share the same pages.
+    :param file_volume: nrrd or npz file
+    :param cache: if False, the volume is neither read from nor written to the .npy cache, for
+     volumes read only once such as the raw annotations
+    :return: read-only memory mapped volume, or array if the cache can't be written
+    """
+    file_npy = file_volume.with_suffix('.npy')
+    if cache and _is_cache_fresh(file_npy, file_volume):
+        return np.load(file_npy, mmap_mode='r')
+    if file_volume.suffix == '.nrrd':
+        volume, _ = nrrd.read(file_volume, index_order='C')  # ml, dv, ap
+        # we want the coronal slice to be the most contiguous
+        volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
+    elif file_volume.suffix == '.npz':
+        volume = np.load(file_volume)['arr_0']
+    if cache and _save_cache(file_npy, volume):
+        return np.load(file_npy, mmap_mode='r')
+    return volume
+
+
 def cart2sph(x, y, z):
     """
     Converts cartesian to spherical Coordinates
@@ -205,6 +260,53 @@ class BrainCoordinates:
     def mgrid(self):
         return np.meshgrid(self.xscale, self.yscale, self.zscale)
 
+    """Methods ray casting"""
+    def traverse(self, origins, directions):
+        """
+        Computes the voxels crossed by a set of lines using a 3D DDA (Amanatides & Woo), all the
+        lines are marched at once, one voxel boundary per iteration.
+        :param origins: [n, 3] array of points on the lines (x, y, z)
+        :param directions: [n, 3] array of unit direction vectors (x, y, z)
+        :return: ixyz [n, m, 3] array of voxel indices in the order of traversal, padded with -1
+                 t [n, m + 1] array of the abscissa (along directions) of the voxel boundaries,
+                 padded with nan, the voxel ixyz[i, j] spans the t[i, j]: t[i, j + 1] segment
+        """
+        origins, directions = (np.atleast_2d(np.asarray(a, dtype=float)) for a in (origins, directions))
+        n = origins.shape[0]
+        # continuous index coordinates: the voxel i spans [i - 0.5, i + 0.5[
+        u0 = (origins - np.array([self.x0, self.y0, self.z0])) / self.dxyz
+        du = directions / self.dxyz
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (-.5 - u0) / du
+            t1 = (self.nxyz - .5 - u0) / du
+            tmin = np.nanmax(np.where(du == 0, -np.inf, np.minimum(t0, t1)), axis=1)
+            tmax = np.nanmin(np.where(du == 0, np.inf, np.maximum(t0, t1)), axis=1)
+            # lines parallel to an axis and outside of the volume slab on this axis
+            outside = np.any((du == 0) & ((u0 < -.5) | (u0 >= self.nxyz - .5)), axis=1)
+            valid = ~outside & (tmin < tmax)
+            ivox = np.zeros((n, 3), dtype=int)
+            ivox[valid] = np.clip(np.floor(u0[valid] + du[valid] * tmin[valid, np.newaxis] + .5), 0, self.nxyz - 1)
+            step = np.sign(du).astype(int)
+            tdelta = np.abs(1 / du)
+            tnext = np.where(du == 0, np.inf, (ivox + step * .5 - u0) / du)
+        m = int(np.sum(self.nxyz))
+        ixyz = np.full((n, m, 3), -1, dtype=int)
+        t = np.full((n, m + 1), np.nan)
+        t[valid, 0] = tmin[valid]
+        irays = np.where(valid)[0]
+        for j in range(m):
+            if irays.size == 0:
+                break
+            ixyz[irays, j] = ivox[irays]
+            axis = np.argmin(tnext[irays], axis=1)
+            tb = np.minimum(tnext[irays, axis], tmax[irays])
+            t[irays, j + 1] = tb
+            ivox[irays, axis] += step[irays, axis]
+            tnext[irays, axis] += tdelta[irays, axis]
+            inside = np.all((ivox[irays] >= 0) & (ivox[irays] < self.nxyz), axis=1)
+            irays = irays[(tb < tmax[irays]) & inside]
+        return ixyz, t
+
 
 class BrainAtlas:
     """
@@ -237,6 +339,11 @@ class BrainAtlas:
 
         self.surface = None
         self.boundary = None
+        # label volume file and file prefix of the surface cache, see compute_surface
+        self._surface_cache = None
+        # caches for the neighbourhood queries: sphere offsets per radius and remapped label volumes
+        self._sphere_offsets = {}
+        self._mapped_labels = {}
 
     @staticmethod
     def _get_cache_dir():
@@ -251,22 +358,55 @@ class BrainAtlas:
 
         NOTE: In places where the top or bottom surface touch the top or bottom of the atlas volume, the surface
         will be set to np.nan. If you encounter issues working with these surfaces check if this might be the cause.
+
+        For atlases read from files, the surface is computed once and cached next to the label volume.
         """
         if self.surface is None:  # only compute if it hasn't already been computed
-            axz = self.xyz2dims[2]  # this is the dv axis
-            _surface = (self.label == 0).astype(np.int8) * 2
-            l0 = np.diff(_surface, axis=axz, append=2)
-            _top = np.argmax(l0 == -2, axis=axz).astype(float)
-            _top[_top == 0] = np.nan
-            _bottom = self.bc.nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(float)
-            _bottom[_bottom == self.bc.nz] = np.nan
+            cached = self._read_surface_cache()
+            if cached is None:
+                axz = self.xyz2dims[2]  # this is the dv axis
+                _surface = (self.label == 0).astype(np.int8) * 2
+                l0 = np.diff(_surface, axis=axz, append=2)
+                _top = np.argmax(l0 == -2, axis=axz).astype(float)
+                _top[_top == 0] = np.nan
+                _bottom = self.bc.nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(float)
+                _bottom[_bottom == self.bc.nz] = np.nan
+                surface = np.diff(_surface, axis=self.xyz2dims[0], append=2) + l0
+                idx_srf = np.where(surface != 0)
+                surface[idx_srf] = 1
+                isrf = np.c_[idx_srf[self.xyz2dims[0]], idx_srf[self.xyz2dims[1]], idx_srf[self.xyz2dims[2]]]
+                surface = self._write_surface_cache(_top, _bottom, surface, isrf)
+            else:
+                _top, _bottom, surface, isrf = cached
             self.top = self.bc.i2z(_top + 1)
             self.bottom = self.bc.i2z(_bottom - 1)
-            self.surface = np.diff(_surface, axis=self.xyz2dims[0], append=2) + l0
-            idx_srf = np.where(self.surface != 0)
-            self.surface[idx_srf] = 1
-            self.srf_xyz = self.bc.i2xyz(np.c_[idx_srf[self.xyz2dims[0]], idx_srf[self.xyz2dims[1]],
-                                               idx_srf[self.xyz2dims[2]]].astype(float))
+            self.surface = surface
+            self.srf_xyz = self.bc.i2xyz(isrf.astype(float))
+
+    def _read_surface_cache(self):
+        """
+        Reads the surface indices cached by _write_surface_cache
+        :return: top and bottom volume indices, memory mapped surface volume, surface voxels
+         indices (n, 3) or None if there is no up to date cache
+        """
+        if self._surface_cache is None:
+            return
+        file_label, prefix = self._surface_cache
+        file_surface, file_indices = (prefix.with_name(prefix.name + ext) for ext in ('.npy', '.npz'))
+        if not (_is_cache_fresh(file_surface, file_label) and _is_cache_fresh(file_indices, file_label)):
+            return
+        indices = np.load(file_indices)
+        return indices['top'], indices['bottom'], np.load(file_surface, mmap_mode='r'), indices['isrf']
+
+    def _write_surface_cache(self, top, bottom, surface, isrf):
+        """Caches the surface volume indices, returns the surface volume memory mapped if cached"""
+        if self._surface_cache is None:
+            return surface
+        _, prefix = self._surface_cache
+        file_surface, file_indices = (prefix.with_name(prefix.name + ext) for ext in ('.npy', '.npz'))
+        if _save_cache(file_indices, top=top, bottom=bottom, isrf=isrf) and _save_cache(file_surface, surface):
+            return np.load(file_surface, mmap_mode='r')
+        return surface
 
     def _lookup_inds(self, ixyz, mode='raise'):
         """
@@ -300,24 +440,64 @@ class BrainAtlas:
         mapping = mapping or self.regions.default_mapping
 
         if radius_um:
-            nrx = int(np.ceil(radius_um / abs(self.bc.dx) / 1e6))
-            nry = int(np.ceil(radius_um / abs(self.bc.dy) / 1e6))
-            nrz = int(np.ceil(radius_um / abs(self.bc.dz) / 1e6))
-            nr = [nrx, nry, nrz]
-            iii = self.bc.xyz2i(xyz)
-            # computing the cube radius and indices is more complicated as volume indices are not
-            # necessariy in ml, ap, dv order so the indices order is dynamic
-            rcube = np.meshgrid(*tuple((np.arange(
-                -nr[i], nr[i] + 1) * self.bc.dxyz[i]) ** 2 for i in self.xyz2dims))
-            rcube = np.sqrt(rcube[0] + rcube[1], rcube[2]) * 1e6
-            icube = tuple(slice(-nr[i] + iii[i], nr[i] + iii[i] + 1) for i in self.xyz2dims)
-            cube = self.regions.mappings[mapping][self.label[icube]]
-            ilabs, counts = np.unique(cube[rcube <= radius_um], return_counts=True)
-            return self.regions.id[ilabs], counts / np.sum(counts)
+            props = self.get_labels_proportions(xyz, radius_um=radius_um, mapping=mapping)
+            ilabs = props.indices[props.indptr[0]:props.indptr[1]]
+            return self.regions.id[ilabs], props.data[props.indptr[0]:props.indptr[1]]
         else:
             regions_indices = self._get_mapping(mapping=mapping)[self.label.flat[self._lookup(xyz, mode=mode)]]
             return self.regions.id[regions_indices]
 
+    def get_labels_proportions(self, xyz, radius_um, mapping=None, cache_mapping=False, chunk_size=4096):
+        """
+        Batched version of the spherical neighbourhood lookup: for each coordinate, computes the
+        proportion of each region within a sphere of radius radius_um. Voxels falling outside of
+        the volume are ignored.
+        :param xyz: [n, 3] array of coordinates
+        :param radius_um: radius of the sphere in um
+        :param mapping: brain region mapping (defaults to original Allen mapping)
+        :param cache_mapping: if True, keeps the remapped label volume in memory for subsequent calls
+        :param chunk_size: number of coordinates processed at once, bounds the memory usage
+        :return: scipy.sparse.csr_matrix [n, nregions] of proportions, columns index self.regions.id
+        """
+        mapping = mapping or self.regions.default_mapping
+        ixyz = np.atleast_2d(self.bc.xyz2i(xyz))
+        offsets = self._get_sphere_offsets(radius_um)
+        nxyz = self.bc.nxyz
+        if cache_mapping:
+            if mapping not in self._mapped_labels:
+                self._mapped_labels[mapping] = self._get_mapping(mapping)[self.label].astype(np.uint16)
+            labels = self._mapped_labels[mapping]
+        irows, icols = ([], [])
+        for first in range(0, ixyz.shape[0], chunk_size):
+            ivox = ixyz[first:first + chunk_size, np.newaxis, :] + offsets[np.newaxis, :, :]
+            inside = np.all(np.logical_and(ivox >= 0, ivox < nxyz), axis=-1)
+            irows.append(np.where(inside)[0] + first)
+            inds = np.atleast_1d(self._lookup_inds(ivox[inside]))
+            if cache_mapping:
+                icols.append(labels.flat[inds])
+            else:
+                icols.append(self._get_mapping(mapping)[self.label.flat[inds]])
+        irows, icols = (np.concatenate(irows), np.concatenate(icols))
+        counts = sp.csr_matrix((np.ones(irows.size), (irows, icols)),
+                               shape=(ixyz.shape[0], self.regions.id.size))
+        counts.sum_duplicates()
+        nvox = np.asarray(counts.sum(axis=1)).ravel()
+        counts.data /= np.repeat(nvox, np.diff(counts.indptr))
+        return counts
+
+    def _get_sphere_offsets(self, radius_um):
+        """
+        Returns the [m, 3] volume indices offsets (in xyz order) of the voxels whose centers lie
+        within a sphere of radius radius_um. The offsets are cached per radius.
+        """
+        if radius_um not in self._sphere_offsets:
+            nr = np.ceil(radius_um / np.abs(self.bc.dxyz) / 1e6).astype(int)
+            ixyz = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in nr], indexing='ij'), axis=-1)
+            ixyz = ixyz.reshape(-1, 3)
+            r = np.sqrt(np.sum((ixyz * self.bc.dxyz) ** 2, axis=1)) * 1e6
+            self._sphere_offsets[radius_um] = ixyz[r <= radius_um]
+        return self._sphere_offsets[radius_um]
+
     def _get_mapping(self, mapping=None):
         """
         Safe way to get mappings if nothing defined in regions.
@@ -923,6 +1103,50 @@ class Insertion:
         # Find point where trajectory intersects with top of brain
         return Insertion._get_surface_intersection(traj, brain_atlas, surface='top')
 
+    @staticmethod
+    def get_brain_intersections(x, y, z, phi, theta, depth, brain_atlas, return_voxels=True):
+        """
+        Vectorized version of get_brain_entry / get_brain_exit for a set of insertions: the lines
+        defined by the insertions are ray-marched through the atlas volume all at once, the entry
+        and exit are where each line enters the first and leaves the last brain voxel.
+        :param x, y, z: n arrays of insertion coordinates (m)
+        :param phi, theta: n arrays of azimuth and polar angles (degrees)
+        :param depth: n array of insertion depths (m)
+        :param brain_atlas: BrainAtlas instance
+        :param return_voxels: if True, returns the flat volume indices of the voxels crossed
+        :return: Bunch with keys
+            entry: [n, 3] brain entry coordinates, nan if the line doesn't cross the brain
+            exit: [n, 3] brain exit coordinates, nan if the line doesn't cross the brain
+            tip: [n, 3] tip coordinates
+            voxels, indptr: flat indices into brain_atlas.label of the voxels crossed by the line
+             i, from top to bottom, are voxels[indptr[i]:indptr[i + 1]]
+        """
+        x, y, z, phi, theta, depth = (np.atleast_1d(np.asarray(a, dtype=float))
+                                      for a in (x, y, z, phi, theta, depth))
+        origins = np.c_[x, y, z]
+        tips = np.c_[sph2cart(-depth, theta, phi)] + origins
+        directions = np.c_[sph2cart(-1, theta, phi)]
+        ixyz, t = brain_atlas.bc.traverse(origins, directions)
+        crossed = ixyz[..., 0] >= 0
+        inds = np.zeros(crossed.shape, dtype=int)
+        inds[crossed] = brain_atlas._lookup_inds(ixyz[crossed])
+        in_brain = crossed & (brain_atlas.label.flat[inds] != 0)
+        # abscissa of the boundary where the ray enters the first / leaves the last brain voxel
+        nvox = crossed.shape[1]
+        has_brain = np.any(in_brain, axis=1)
+        ifirst = np.argmax(in_brain, axis=1)
+        ilast = nvox - 1 - np.argmax(np.flip(in_brain, axis=1), axis=1)
+        irays = np.arange(x.size)
+        t_entry = np.where(has_brain, t[irays, ifirst], np.nan)
+        t_exit = np.where(has_brain, t[irays, ilast + 1], np.nan)
+        out = Bunch({'entry': origins + directions * t_entry[:, np.newaxis],
+                     'exit': origins + directions * t_exit[:, np.newaxis],
+                     'tip': tips})
+        if return_voxels:
+            out['voxels'] = inds[crossed]
+            out['indptr'] = np.r_[0, np.cumsum(np.sum(crossed, axis=1))]
+        return out
+
 
 class AllenAtlas(BrainAtlas):
     """
@@ -981,7 +1205,8 @@ class AllenAtlas(BrainAtlas):
                 file_label = _download_atlas_allen(file_label)
             file_label_remap = hist_path.with_name(f'annotation_{res_um}_lut_{LUT_VERSION}.npz')
             if not file_label_remap.exists():
-                label = self._read_volume(file_label).astype(dtype=np.int32)
+                # the raw annotations are only read to compute the remapped volume: don't cache them
+                label = self._read_volume(file_label, cache=False).astype(dtype=np.int32)
                 _logger.info("Computing brain atlas annotations lookup table")
                 # lateralize atlas: for this the regions of the left hemisphere have primary
                 # keys opposite to to the normal ones
@@ -1012,16 +1237,13 @@ class AllenAtlas(BrainAtlas):
             image = self._read_volume(hist_path)
 
         super().__init__(image, label, dxyz, regions, ibregma, dims2xyz=dims2xyz, xyz2dims=xyz2dims)
+        if not mock:
+            file_label_npy = file_label_remap.with_suffix('.npy')
+            self._surface_cache = (file_label_npy, file_label_npy.with_name(f'{file_label_npy.stem}_surface'))
 
     @staticmethod
-    def _read_volume(file_volume):
-        if file_volume.suffix == '.nrrd':
-            volume, _ = nrrd.read(file_volume, index_order='C')  # ml, dv, ap
-            # we want the coronal slice to be the most contiguous
-            volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
-        elif file_volume.suffix == '.npz':
-            volume = np.load(file_volume)['arr_0']
-        return volume
+    def _read_volume(file_volume, cache=True):
+        return _read_volume(file_volume, cache=cache)
 
     def xyz2ccf(self, xyz, ccf_order='mlapdv', mode='raise'):
         """
@@ -1290,7 +1512,8 @@ class FranklinPaxinosAtlas(BrainAtlas):
             file_label_remap = hist_path.with_name(f'annotation_{res_um[0]}_{res_um[1]}_{res_um[2]}_lut_{LUT_VERSION}.npz')
 
             if not file_label_remap.exists():
-                label = self._read_volume(file_label).astype(dtype=np.int32)
+                # the raw annotations are only read to compute the remapped volume: don't cache them
+                label = self._read_volume(file_label, cache=False).astype(dtype=np.int32)
                 _logger.info("computing brain atlas annotations lookup table")
                 # lateralize atlas: for this the regions of the left hemisphere have primary
                 # keys opposite to to the normal ones
@@ -1307,13 +1530,10 @@ class FranklinPaxinosAtlas(BrainAtlas):
             image = self._read_volume(hist_path)
 
         super().__init__(image, label, dxyz, regions, ibregma, dims2xyz=dims2xyz, xyz2dims=xyz2dims)
+        if not mock:
+            file_label_npy = file_label_remap.with_suffix('.npy')
+            self._surface_cache = (file_label_npy, file_label_npy.with_name(f'{file_label_npy.stem}_surface'))
 
     @staticmethod
-    def _read_volume(file_volume):
-        if file_volume.suffix == '.nrrd':
-            volume, _ = nrrd.read(file_volume, index_order='C')  # ml, dv, ap
-            # we want the coronal slice to be the most contiguous
-            volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
-        elif file_volume.suffix == '.npz':
-            volume = np.load(file_volume)['arr_0']
-        return volume
+    def _read_volume(file_volume, cache=True):
+        return _read_volume(file_volume, cache=cache)
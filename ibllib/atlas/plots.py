@@ -454,11 +454,13 @@ def plot_points_on_slice(xyz, values=None, coord=-1000, slice='coronal', mapping
         return fig, ax
 
 
-def compute_volume_from_points(xyz, values=None, aggr='sum', fwhm=100, ba=None):
+def compute_volume_from_points(xyz, values=None, aggr='sum', fwhm=100, ba=None, coordinate=None, axis=None):
     """
     Creates a 3D volume with xyz points placed in corresponding voxel in volume. Points that fall into the same voxel within the
     volume are aggregated according to the method specified in aggr. Gaussian smoothing with a 3D kernel with distance specified
     by fwhm (full width half max) argument is applied. If fwhm = 0, no gaussian smoothing is applied.
+    The aggregation is computed on the occupied voxels only and the smoothing is applied within the bounding box of the points
+    padded by the kernel radius.
 
     :param xyz: 3 column array of xyz coordinates of points in metres
     :param values: 1 column array of values per xyz coordinates, if no values are given the sum of xyz points in each voxel is
@@ -467,31 +469,62 @@ def compute_volume_from_points(xyz, values=None, aggr='sum', fwhm=100, ba=None):
     (https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.binned_statistic.html)
     :param fwhm: full width at half maximum of gaussian kernel in um
     :param ba: AllenAtlas object
+    :param coordinate: (optional) coordinate of the slice in metres. If provided with axis, only the slice is computed
+     and returned, as per `ba.slice(coordinate, axis, volume=volume)`
+    :param axis: (optional) xyz axis of the slice, 0 for sagittal, 1 for coronal, 2 for horizontal
     :return:
     """
 
     ba = ba or AllenAtlas()
 
     idx = ba._lookup(xyz)
-    ba_shape = ba.image.shape[0] * ba.image.shape[1] * ba.image.shape[2]
-
+    # aggregate the values on the occupied voxels only
+    ivox, iinv = np.unique(idx, return_inverse=True)
     if values is not None:
-        volume = binned_statistic(idx, values, range=[0, ba_shape], statistic=aggr, bins=ba_shape).statistic
-        volume[np.isnan(volume)] = 0
+        vox_values = binned_statistic(iinv, values, range=[0, ivox.size], statistic=aggr, bins=ivox.size).statistic
+        vox_values[np.isnan(vox_values)] = 0
     else:
-        volume = np.bincount(idx, minlength=ba_shape, weights=values)
-
-    volume = volume.reshape(ba.image.shape[0], ba.image.shape[1], ba.image.shape[2]).astype(np.float32)
+        vox_values = np.bincount(iinv, minlength=ivox.size)
+    vox_values = vox_values.astype(np.float32)
+    isub = np.array(np.unravel_index(ivox, ba.image.shape))
 
+    # the bounding box of the occupied voxels, padded by the gaussian kernel radius
     if fwhm > 0:
         # Compute sigma used for gaussian kernel
         fwhm_over_sigma_ratio = np.sqrt(8 * np.log(2))
         sigma = fwhm / (fwhm_over_sigma_ratio * ba.res_um)
-        # TODO to speed up only apply gaussian filter on slices within distance of chosen coordinate
-        volume = gaussian_filter(volume, sigma=sigma)
+        radius = int(4.0 * sigma + 0.5)  # this is the default truncation of the scipy gaussian filter
+    else:
+        radius = 0
+    first = np.maximum(isub.min(axis=1) - radius, 0)
+    last = np.minimum(isub.max(axis=1) + radius + 1, ba.image.shape)
+    if coordinate is not None:
+        # for a slice, the box is restricted to the planes within the kernel radius of the slice
+        daxis = ba.xyz2dims[axis]
+        index = [ba.bc.x2i, ba.bc.y2i, ba.bc.z2i][axis](np.array(coordinate))
+        first[daxis], last[daxis] = (max(first[daxis], index - radius), min(last[daxis], index + radius + 1))
+        if first[daxis] >= last[daxis]:
+            first[daxis], last[daxis] = (index, index + 1)
+
+    # the full volume is zero outside of the smoothed box
+    box = tuple(slice(f, la) for f, la in zip(first, last))
+    inbox = np.all(np.logical_and(isub >= first[:, np.newaxis], isub < last[:, np.newaxis]), axis=0)
+    sub = np.zeros(last - first, dtype=np.float32)
+    sub[tuple(isub[:, inbox] - first[:, np.newaxis])] = vox_values[inbox]
+    if fwhm > 0:
+        sub = gaussian_filter(sub, sigma=sigma)
+
+    if coordinate is None:
+        volume = np.zeros(ba.image.shape, dtype=np.float32)
+        volume[box] = sub
+        label = ba.label
+    else:
+        volume = np.zeros(np.delete(ba.image.shape, daxis), dtype=np.float32)
+        volume[tuple(np.delete(np.array(box), daxis))] = np.take(sub, index - first[daxis], axis=daxis)
+        label = ba.slice(coordinate, axis, volume=ba.label)
 
     # Mask so that outside of the brain is set to nan
-    volume[ba.label == 0] = np.nan
+    volume[label == 0] = np.nan
 
     return volume
 
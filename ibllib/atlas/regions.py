@@ -24,6 +24,10 @@ class _BrainRegions:
     parent: np.ndarray
     order: np.uint16
 
+    def __post_init__(self):
+        # lookup tables and nested sets computed on first use, see _lookup_table and _nested_sets
+        self._lookups = {}
+
     @property
     def rgba(self):
         rgba = np.c_[self.rgb, self.rgb[:, 0] * 0 + 255]
@@ -45,13 +49,74 @@ class _BrainRegions:
         """
         Get a bunch of the name/id
         """
-        uid, uind = np.unique(ids, return_inverse=True)
-        a, iself, _ = np.intersect1d(self.id, uid, assume_unique=False, return_indices=True)
+        inds = self._find_inds(ids, 'id')
         b = Bunch()
         for k in self.__dataclass_fields__.keys():
-            b[k] = self.__getattribute__(k)[iself[uind]]
+            b[k] = self.__getattribute__(k)[inds]
         return b
 
+    def _lookup_table(self, field, mapping=None):
+        """
+        Hash map of the values of a region attribute, optionally remapped, onto the regions table.
+        The table is computed on first use and then kept for the lifetime of the object.
+        :param field: name of the attribute, 'id' or 'acronym'
+        :param mapping: optional mapping applied to the attribute, e.g. self.acronym[self.mappings[mapping]]
+        :return: Bunch with keys
+         - index: pd.Index of the unique values
+         - first: index of the first region with each unique value
+         - groups: list of the indices of all regions with each unique value
+        """
+        key = (field, mapping)
+        if key not in self._lookups:
+            values = self.__getattribute__(field)
+            if mapping is not None:
+                values = values[self.mappings[mapping]]
+            codes, uniques = pd.factorize(values)
+            valid = np.where(codes >= 0)[0]
+            iorder = valid[np.argsort(codes[valid], kind='stable')]
+            bounds = np.cumsum(np.bincount(codes[valid], minlength=uniques.size))
+            self._lookups[key] = Bunch(index=pd.Index(uniques), first=iorder[np.r_[0, bounds[:-1]]],
+                                       groups=np.split(iorder, bounds[:-1]))
+        return self._lookups[key]
+
+    def _nested_sets(self):
+        """
+        Nested set encoding of the hierarchy: regions are numbered in the order of a depth first
+        traversal, so that the descendants of a region i are the regions whose entry number lies
+        within [tin[i], tout[i]). Computed on first use.
+        :return: tin, tout: np.arrays of entry and exit numbers of each region
+        """
+        if 'nested_sets' not in self._lookups:
+            n = self.id.size
+            pmask, i_p = ismember(self.parent, self.id)
+            iparent = np.full(n, -1)
+            iparent[pmask] = i_p
+            iparent[iparent == np.arange(n)] = -1  # a self-parented region is a root
+            ichild = np.where(iparent >= 0)[0]
+            ichild = ichild[np.argsort(iparent[ichild], kind='stable')]
+            bounds = np.cumsum(np.bincount(iparent[ichild], minlength=n))
+            children = np.split(ichild, bounds[:-1])
+            # pre-order depth first traversal from the roots
+            preorder, visited = [], np.zeros(n, dtype=bool)
+            for root in np.r_[np.where(iparent < 0)[0], np.arange(n)]:
+                stack = [root]
+                while stack:
+                    i = stack.pop()
+                    if visited[i]:
+                        continue
+                    visited[i] = True
+                    preorder.append(i)
+                    stack.extend(children[i][::-1])
+            preorder = np.array(preorder)
+            size = np.ones(n, dtype=int)
+            for i in preorder[::-1]:
+                if iparent[i] >= 0:
+                    size[iparent[i]] += size[i]
+            tin = np.zeros(n, dtype=int)
+            tin[preorder] = np.arange(n)
+            self._lookups['nested_sets'] = (tin, tin + size)
+        return self._lookups['nested_sets']
+
     def _navigate_tree(self, ids, direction='down', return_indices=False):
         """
         Private method to navigate the tree and get all related objects either up, down or along the branch.
@@ -63,18 +128,19 @@ class _BrainRegions:
         :return: Bunch
         """
         indices = ismember(self.id, ids)[0]
-        count = np.sum(indices)
-        while True:
-            if direction == 'down':
-                indices |= ismember(self.parent, self.id[indices])[0]
-            elif direction == 'up':
-                indices |= ismember(self.id, self.parent[indices])[0]
-            else:
-                raise ValueError("direction should be either 'up' or 'down'")
-            if count == np.sum(indices):  # last iteration didn't find any match
-                break
-            else:
-                count = np.sum(indices)
+        tin, tout = self._nested_sets()
+        if direction == 'down':
+            # the descendants are the regions entered within the interval of a selected region
+            cover = np.zeros(self.id.size + 1, dtype=int)
+            np.add.at(cover, tin[indices], 1)
+            np.add.at(cover, tout[indices], -1)
+            indices = (np.cumsum(cover)[:-1] > 0)[tin]
+        elif direction == 'up':
+            # the ancestors are the regions whose interval contains a selected region
+            entries = np.sort(tin[indices])
+            indices = np.searchsorted(entries, tout) > np.searchsorted(entries, tin)
+        else:
+            raise ValueError("direction should be either 'up' or 'down'")
         if return_indices:
             return self.get(self.id[indices]), np.where(indices)[0]
         else:
@@ -182,7 +248,7 @@ class _BrainRegions:
         :return: array of remapped acronyms
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(acronym, self.acronym)
+        inds = self._find_inds(acronym, 'acronym')
         return self.acronym[self.mappings[mapping]][inds]
 
     def acronym2id(self, acronym, mapping=None, hemisphere=None):
@@ -195,7 +261,7 @@ class _BrainRegions:
         :return: array of remapped atlas ids
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(acronym, self.acronym)
+        inds = self._find_inds(acronym, 'acronym')
         return self.id[self.mappings[mapping]][self._filter_lr(inds, mapping, hemisphere)]
 
     def acronym2index(self, acronym, mapping=None, hemisphere=None):
@@ -208,10 +274,8 @@ class _BrainRegions:
         """
         mapping = mapping or self.default_mapping
         acronym = self.acronym2acronym(acronym, mapping=mapping)
-        index = list()
-        for id in acronym:
-            inds = np.where(self.acronym[self.mappings[mapping]] == id)[0]
-            index.append(self._filter_lr_index(inds, hemisphere))
+        lookup = self._lookup_table('acronym', mapping)
+        index = [self._filter_lr_index(lookup.groups[i], hemisphere) for i in lookup.index.get_indexer(acronym)]
 
         return acronym, index
 
@@ -224,7 +288,7 @@ class _BrainRegions:
         :return: array of remapped acronyms
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(atlas_id, self.id)
+        inds = self._find_inds(atlas_id, 'id')
         return self.acronym[self.mappings[mapping]][inds]
 
     def id2id(self, atlas_id, mapping='Allen'):
@@ -236,7 +300,7 @@ class _BrainRegions:
         :return: array of remapped atlas ids
         """
 
-        inds = self._find_inds(atlas_id, self.id)
+        inds = self._find_inds(atlas_id, 'id')
         return self.id[self.mappings[mapping]][inds]
 
     def id2index(self, atlas_id, mapping='Allen'):
@@ -249,10 +313,8 @@ class _BrainRegions:
         """
 
         atlas_id = self.id2id(atlas_id, mapping=mapping)
-        index = list()
-        for id in atlas_id:
-            inds = np.where(self.id[self.mappings[mapping]] == id)[0]
-            index.append(inds)
+        lookup = self._lookup_table('id', mapping)
+        index = [lookup.groups[i] for i in lookup.index.get_indexer(atlas_id)]
 
         return atlas_id, index
 
@@ -314,12 +376,19 @@ class _BrainRegions:
         else:
             return values
 
-    def _find_inds(self, values, all_values):
+    def _find_inds(self, values, field, mapping=None):
+        """
+        Indices of the first region matching each value, values that are not found are dropped
+        :param values: scalar, list or array of values
+        :param field: name of the region attribute to search, 'id' or 'acronym'
+        :param mapping: optional mapping applied to the attribute
+        :return: np.array of indices
+        """
         if not isinstance(values, list) and not isinstance(values, np.ndarray):
             values = np.array([values])
-        _, inds = ismember(np.array(values), all_values)
-
-        return inds
+        lookup = self._lookup_table(field, mapping)
+        i = lookup.index.get_indexer(np.array(values).flatten())
+        return lookup.first[i[i >= 0]]
 
     def parse_acronyms_argument(self, acronyms, mode='raise'):
         """
@@ -502,7 +571,7 @@ class BrainRegions(_BrainRegions):
         :param target_map: map name onto which to map
         :return:
         """
-        _, inds = ismember(region_ids, self.id[self.mappings[source_map]])
+        inds = self._find_inds(region_ids, 'id', mapping=source_map)
         return self.id[self.mappings[target_map][inds]]
 
 
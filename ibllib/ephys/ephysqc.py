@@ -1,6 +1,8 @@
 """
 Quality control of raw Neuropixel electrophysiology data.
 """
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
 import logging
 import shutil
@@ -26,6 +28,7 @@ from phylib.io import model
 _logger = logging.getLogger(__name__)
 
 RMS_WIN_LENGTH_SECS = 3
+RMS_BLOCK_NWIN = 20  # number of rms windows per block, the unit of work for parallel / resumable rmsmap
 WELCH_WIN_LENGTH_SAMPLES = 1024
 NCH_WAVEFORMS = 32  # number of channels to be saved in templates.waveforms and channels.waveforms
 BATCHES_SPACING = 300
@@ -130,6 +133,11 @@ class EphysQC(base.QC):
         :param overwrite: bool, whether to overwrite locally existing outputs of this function. Default is False.
         :param stream: bool, whether to stream the samples of the .ap data if not locally available. Defaults to value
         set in class init (True if none set).
+        :param n_workers: int, number of processes used to compute the .ap samples metrics and the .lf rms map.
+        Default is 1.
+        :param batches_spacing: float, spacing in seconds between the .ap samples. Default is BATCHES_SPACING.
+        :param n_batches: int, if set, number of .ap samples evenly spread over the recording, supersedes
+        batches_spacing.
         :return: A list of QC output files. In case of a complete run that is one file for .ap and three files for .lf.
         """
         # If stream is explicitly given in run, overwrite value from init
@@ -170,17 +178,32 @@ class EphysQC(base.QC):
                     _logger.critical("Channel geometry seems incorrect")
                     raise ValueError("Wrong Neuropixel channel mapping used - ABORT")
 
-                t0s = np.arange(TMIN, sr.rl - SAMPLE_LENGTH, BATCHES_SPACING)
+                t0s = ap_sample_times(sr.rl, kwargs.get('batches_spacing', BATCHES_SPACING), kwargs.get('n_batches'))
                 all_rms = np.zeros((2, nc, t0s.shape[0]))
                 all_srs, channel_ok = (np.zeros((nc, t0s.shape[0])) for _ in range(2))
                 psds = np.zeros((nc, fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1, one_sided=True).size))
 
                 _logger.info(f'Computing RMS samples for .ap data {self.probe_path}')
-                for i, t0 in enumerate(t0s):
-                    sl = slice(int(t0 * sr.fs), int((t0 + SAMPLE_LENGTH) * sr.fs))
-                    raw = sr[sl, :-sr.nsync].T
-                    all_rms[0, :, i], all_rms[1, :, i], all_srs[:, i], channel_ok[:, i], psd =\
-                        self._compute_metrics_array(raw, sr.fs, h)
+                n_workers = kwargs.get('n_workers', 1)
+                # the next snippets are read in a background thread while the current ones are processed
+                raws = _prefetch(lambda t0: sr[int(t0 * sr.fs):int((t0 + SAMPLE_LENGTH) * sr.fs), :-sr.nsync].T,
+                                 t0s, n=n_workers + 1)
+                if n_workers > 1:
+                    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                        futures, pending = [], set()
+                        for raw in raws:
+                            # bound the number of snippets waiting to be processed
+                            if len(pending) >= 2 * n_workers:
+                                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            future = executor.submit(self._compute_metrics_array, raw, sr.fs, h)
+                            futures.append(future)
+                            pending.add(future)
+                        metrics = [f.result() for f in futures]
+                else:
+                    metrics = (self._compute_metrics_array(raw, sr.fs, h) for raw in raws)
+                for i, (rms_raw, rms_pre_proc, srs, labels, psd) in enumerate(metrics):
+                    all_rms[0, :, i], all_rms[1, :, i], all_srs[:, i], channel_ok[:, i] = (
+                        rms_raw, rms_pre_proc, srs, labels)
                     psds += psd
                 # Calculate the median RMS across all samples per channel
                 results = {'rms': np.median(all_rms, axis=-1),
@@ -201,62 +224,165 @@ class EphysQC(base.QC):
                 self.update_extended_qc(self.metrics)
         # If lf meta and bin file present, run the old qc on LF data
         if self.data.lf_meta and self.data.lf:
-            qc_files.extend(extract_rmsmap(self.data.lf, out_folder=self.out_path, overwrite=overwrite))
+            qc_files.extend(extract_rmsmap(self.data.lf, out_folder=self.out_path, overwrite=overwrite,
+                                           n_workers=kwargs.get('n_workers', 1)))
 
         return qc_files
 
 
-def rmsmap(sglx):
+def ap_sample_times(rl, batches_spacing=BATCHES_SPACING, n_batches=None):
+    """
+    Start times of the AP samples used for raw ephys QC, from TMIN to the end of the recording
+
+    :param rl: recording length in seconds
+    :param batches_spacing: spacing in seconds between two consecutive samples
+    :param n_batches: if set, number of samples evenly spread over the recording, supersedes batches_spacing
+    :return: np.array of sample start times in seconds
+    """
+    if n_batches is None:
+        return np.arange(TMIN, rl - SAMPLE_LENGTH, batches_spacing)
+    return np.linspace(TMIN, rl - SAMPLE_LENGTH, n_batches, endpoint=False)
+
+
+def _prefetch(fcn, args, n=2):
+    """
+    Generator that yields fcn(arg) for each arg in order, while the next n calls run ahead in a
+    background thread. Used to overlap reading of raw data with its processing.
+
+    :param fcn: function of a single argument
+    :param args: iterable of arguments
+    :param n: maximum number of results computed ahead
+    :return: generator of fcn(arg)
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        queue = deque()
+        for arg in args:
+            queue.append(executor.submit(fcn, arg))
+            if len(queue) > n:
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+
+
+def _rmsmap_block(sglx, firstlast):
+    """
+    Computes the RMS and the summed spectral density for a contiguous block of windows
+
+    :param sglx: open spikeglx reader or path to the binary file, in which case the reader is
+     opened and closed within the function (used for worker processes)
+    :param firstlast: (nwin, 2) array of first and last samples of each window
+    :return: TRMS (nwin, nc), nsamples (nwin,), spectral_density (nfreqs, nc)
+    """
+    sr = spikeglx.Reader(sglx) if isinstance(sglx, (str, Path)) else sglx
+    trms = np.zeros((len(firstlast), sr.nc))
+    nsamples = np.zeros((len(firstlast),))
+    spectral_density = np.zeros((fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1, one_sided=True).size, sr.nc))
+    for iw, (first, last) in enumerate(firstlast):
+        D = sr.read_samples(first_sample=first, last_sample=last)[0].transpose()
+        # remove low frequency noise below 1 Hz
+        D = fourier.hp(D, 1 / sr.fs, [0, 1])
+        trms[iw, :] = utils.rms(D)
+        nsamples[iw] = D.shape[1]
+        # the last window may be smaller than what is needed for welch
+        if last - first < WELCH_WIN_LENGTH_SAMPLES:
+            continue
+        # compute a smoothed spectrum using welch method
+        _, w = signal.welch(
+            D, fs=sr.fs, window='hann', nperseg=WELCH_WIN_LENGTH_SAMPLES,
+            detrend='constant', return_onesided=True, scaling='density', axis=-1
+        )
+        spectral_density += w.T
+    if sr is not sglx:
+        sr.close()
+    return trms, nsamples, spectral_density
+
+
+def rmsmap(sglx, n_workers=1, checkpoint_dir=None):
     """
     Computes RMS map in time domain and spectra for each channel of Neuropixel probe
 
+    The windows are processed in blocks of RMS_BLOCK_NWIN windows. Blocks may be distributed
+    across worker processes that each open their own reader, and each block result may be saved
+    in a checkpoint folder so that an interrupted computation resumes where it stopped.
+
     :param sglx: Open spikeglx reader
+    :param n_workers: number of processes, defaults to 1 (computed in the current process)
+    :param checkpoint_dir: optional folder where completed blocks are saved and loaded from
     :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
      and frequency scales
     """
     rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
     # the window generator will generates window indices
     wingen = utils.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
+    firstlast = np.array(list(wingen.firstlast))
+    blocks = np.arange(0, wingen.nwin, RMS_BLOCK_NWIN)
     # pre-allocate output dictionary of numpy arrays
     win = {'TRMS': np.zeros((wingen.nwin, sglx.nc)),
            'nsamples': np.zeros((wingen.nwin,)),
            'fscale': fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
     win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    with tqdm(total=wingen.nwin) as pbar:
-        for first, last in wingen.firstlast:
-            D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
-            # remove low frequency noise below 1 Hz
-            D = fourier.hp(D, 1 / sglx.fs, [0, 1])
-            iw = wingen.iw
-            win['TRMS'][iw, :] = utils.rms(D)
-            win['nsamples'][iw] = D.shape[1]
-            # the last window may be smaller than what is needed for welch
-            if last - first < WELCH_WIN_LENGTH_SAMPLES:
-                continue
-            # compute a smoothed spectrum using welch method
-            _, w = signal.welch(
-                D, fs=sglx.fs, window='hann', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                detrend='constant', return_onesided=True, scaling='density', axis=-1
-            )
-            win['spectral_density'] += w.T
-            # print at least every 20 windows
-            if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-                pbar.update(iw)
+    # load the blocks already computed by a previous run
+    results = {}
+    if checkpoint_dir is not None:
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        for ib, first in enumerate(blocks):
+            file_block = checkpoint_dir.joinpath(f'block_{ib:05d}.npz')
+            if file_block.exists():
+                block = np.load(file_block)
+                if np.all(block['firstlast'] == firstlast[first:first + RMS_BLOCK_NWIN]):
+                    results[ib] = (block['TRMS'], block['nsamples'], block['spectral_density'])
+        if len(results):
+            _logger.info(f'Resuming RMS map computation: {len(results)}/{blocks.size} blocks loaded from {checkpoint_dir}')
+
+    def _store(ib, result):
+        results[ib] = result
+        if checkpoint_dir is None:
+            return
+        # write to a temporary file and rename so that an interrupted write is never loaded
+        file_block = checkpoint_dir.joinpath(f'block_{ib:05d}.npz')
+        file_tmp = checkpoint_dir.joinpath(f'block_{ib:05d}.tmp.npz')
+        np.savez(file_tmp, TRMS=result[0], nsamples=result[1], spectral_density=result[2],
+                 firstlast=firstlast[blocks[ib]:blocks[ib] + RMS_BLOCK_NWIN])
+        file_tmp.replace(file_block)
+
+    todo = [ib for ib in range(blocks.size) if ib not in results]
+    with tqdm(total=blocks.size, initial=len(results)) as pbar:
+        if n_workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(
+                    _rmsmap_block, sglx.file_bin, firstlast[blocks[ib]:blocks[ib] + RMS_BLOCK_NWIN]): ib for ib in todo}
+                for future in as_completed(futures):
+                    _store(futures[future], future.result())
+                    pbar.update(1)
+        else:
+            for ib in todo:
+                _store(ib, _rmsmap_block(sglx, firstlast[blocks[ib]:blocks[ib] + RMS_BLOCK_NWIN]))
+                pbar.update(1)
+    # merge the blocks in order
+    for ib, first in enumerate(blocks):
+        trms, nsamples, spectral_density = results[ib]
+        win['TRMS'][first:first + RMS_BLOCK_NWIN, :] = trms
+        win['nsamples'][first:first + RMS_BLOCK_NWIN] = nsamples
+        win['spectral_density'] += spectral_density
     sglx.close()
     return win
 
 
-def extract_rmsmap(sglx, out_folder=None, overwrite=False):
+def extract_rmsmap(sglx, out_folder=None, overwrite=False, n_workers=1):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
+    Partial results are checkpointed in a `rmsmap_{type}_checkpoint` folder within the output
+    folder, which is removed once the ALF files are written. If the computation is interrupted,
+    the next call resumes from the completed blocks.
+
     :param sglx: Open spikeglx Reader with data for which to compute rmsmap
     :param out_folder: folder in which to store output ALF files. Default uses the folder in which
      the `fbin` file lives.
     :param overwrite: do not re-extract if all ALF files already exist
-    :param label: string or list of strings that will be appended to the filename before extension
+    :param n_workers: number of processes used to compute the rmsmap, defaults to 1
     :return: None
     """
     if out_folder is None:
@@ -272,10 +398,9 @@ def extract_rmsmap(sglx, out_folder=None, overwrite=False):
         _logger.warning(f'RMS map already exists for .{sglx.type} data in {out_folder}, skipping. Use overwrite option.')
         return files_time + files_freq
     # crunch numbers
-    rms = rmsmap(sglx)
+    checkpoint_dir = out_folder.joinpath(f'rmsmap_{sglx.type}_checkpoint')
+    rms = rmsmap(sglx, n_workers=n_workers, checkpoint_dir=checkpoint_dir)
     # output ALF files, single precision with the optional label as suffix before extension
-    if not out_folder.exists():
-        out_folder.mkdir()
     tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
     fdict = {'power': rms['spectral_density'].astype(np.single),
              'freqs': rms['fscale'].astype(np.single)}
@@ -283,6 +408,7 @@ def extract_rmsmap(sglx, out_folder=None, overwrite=False):
         out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
     out_freq = alfio.save_object_npy(
         out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
     return out_time + out_freq
 
 
@@ -121,7 +121,8 @@ def sync_spike_sorting(ap_file, out_path):
     # patch the spikes.times files manually
     st_file = out_path.joinpath('spikes.times.npy')
     spike_samples = np.load(out_path.joinpath('spikes.samples.npy'))
-    interp_times = apply_sync(sync_file, spike_samples / _sr(ap_file), forward=True)
+    spike_times = spike_samples / _sr(ap_file)
+    interp_times = apply_sync(sync_file, spike_times, forward=True, out=spike_times)
     np.save(st_file, interp_times)
     # get the list of output files
     out_files.extend([f for f in out_path.glob("*.*") if
@@ -197,11 +198,44 @@ def ks2_to_tar(ks_path, out_path, force=False):
     return [out_file]
 
 
+def _deduplicate_picks(amp_order, ilow, ihigh, trace, neighbours, ispike):
+    """
+    Greedy de-duplication of threshold crossings in a single pass: the picks are visited by decreasing
+    amplitude, each unassigned pick becomes a spike and suppresses the picks from neighbouring traces
+    within its time window. Labels ispike in place (-1 for suppressed picks) and returns it.
+    :param amp_order: indices of the picks sorted by amplitude
+    :param ilow, ihigh: for each pick, first and last + 1 indices of the picks within the time window
+    :param trace: trace index of each pick
+    :param neighbours: ntraces x ntraces boolean table of traces within the distance threshold
+    :param ispike: int array of zeros, size of the number of picks
+    """
+    spike_id = 1
+    for imax in amp_order:
+        if ispike[imax] != 0:
+            continue
+        neighbours_imax = neighbours[trace[imax]]
+        for i in range(ilow[imax], ihigh[imax]):
+            if neighbours_imax[trace[i]]:
+                ispike[i] = -1
+        ispike[imax] = spike_id
+        spike_id += 1
+    return ispike
+
+
+try:
+    import numba
+    _deduplicate_picks = numba.njit(nogil=True)(_deduplicate_picks)
+except ImportError:
+    pass
+
+
 def detection(data, fs, h, detect_threshold=-4, time_tol=.002, distance_threshold_um=70):
     """
     Detects and de-duplicates negative voltage spikes based on voltage thresholding.
-    The de-duplication step locks in maximum amplitude events. To account for collisions the amplitude
-    is assumed to be decaying from the peak. If this is a multipeak event, each is labeled as a spike.
+    The de-duplication step locks in maximum amplitude events: the threshold crossings are visited
+    once in amplitude order and suppress the crossings of neighbouring traces within the time window.
+    The neighbouring traces are tabulated once from the probe geometry. The de-duplication is
+    compiled with numba if it is installed.
 
     :param data: 2D numpy array nsamples x nchannels
     :param fs: sampling frequency (Hz)
@@ -211,38 +245,15 @@ def detection(data, fs, h, detect_threshold=-4, time_tol=.002, distance_threshol
     :param distance_threshold_um: distance for which exceeding threshold values are assumed to part of the same spike
     :return: spikes dictionary of vectors with keys "time", "trace", "amp" and "ispike"
     """
-    multipeak = False
-    time_bracket = np.array([-1, 1]) * time_tol
     inds, indtr = np.where(data < detect_threshold)
     picks = Bunch(time=inds / fs, trace=indtr, amp=data[inds, indtr], ispike=np.zeros(inds.size))
     amp_order = np.argsort(picks.amp)
-
+    # the picks are sorted by time, get the time window of each pick
+    ilow = np.searchsorted(picks.time, picks.time - time_tol)
+    ihigh = np.searchsorted(picks.time, picks.time + time_tol)
     hxy = h['x'] + 1j * h['y']
-
-    spike_id = 1
-    while np.any(picks.ispike == 0):
-        # find the first unassigned spike with the highest amplitude
-        iamp = np.where(picks.ispike[amp_order] == 0)[0][0]
-        imax = amp_order[iamp]
-        # look only within the time range
-        itlims = np.searchsorted(picks.time, picks.time[imax] + time_bracket)
-        itlims = np.arange(itlims[0], itlims[1])
-
-        offset = np.abs(hxy[picks.trace[itlims]] - hxy[picks.trace[imax]])
-        iit = np.where(offset < distance_threshold_um)[0]
-
-        picks.ispike[itlims[iit]] = -1
-        picks.ispike[imax] = spike_id
-        # handles collision with a simple amplitude decay model: if amplitude doesn't decay
-        # as a function of offset, then it's a collision and another spike is set
-        if multipeak:  # noqa
-            iii = np.lexsort((picks.amp[itlims[iit]], offset[iit]))
-            sorted_amps_db = 20 * np.log10(np.abs(picks.amp[itlims[iit][iii]]))
-            idetect = np.r_[0, np.where(np.diff(sorted_amps_db) > 12)[0] + 1]
-            picks.ispike[itlims[iit[iii[idetect]]]] = np.arange(idetect.size) + spike_id
-            spike_id += idetect.size
-        else:
-            spike_id += 1
-
+    neighbours = np.abs(hxy[:, np.newaxis] - hxy[np.newaxis, :]) < distance_threshold_um
+    ispike = _deduplicate_picks(amp_order, ilow, ihigh, picks.trace, neighbours, np.zeros(inds.size, dtype=np.int64))
+    picks.ispike = ispike.astype(float)
     detects = Bunch({k: picks[k][picks.ispike > 0] for k in picks})
     return detects
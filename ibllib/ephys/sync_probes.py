@@ -1,9 +1,10 @@
+import functools
 import logging
+from pathlib import Path
 
 import matplotlib.axes
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.interpolate import interp1d
 import one.alf.io as alfio
 import one.alf.exceptions
 from iblutil.util import Bunch
@@ -15,22 +16,89 @@ from ibllib.io.extractors.ephys_fpga import get_sync_fronts, get_ibl_sync_map
 _logger = logging.getLogger(__name__)
 
 
-def apply_sync(sync_file, times, forward=True):
+class ClockSync:
+    """
+    Piecewise linear mapping between a probe clock and the reference clock, built from the sync
+    points. Equivalent to scipy.interpolate.interp1d(..., fill_value='extrapolate') in both
+    directions, but the segments are computed once and the transform can be applied in place
+    and in chunks to arrays of any size.
+    """
+    CHUNK_SIZE = 2 ** 22
+
+    def __init__(self, sync_points):
+        """
+        :param sync_points: (n, 2) array of sync points: probe time, reference time
+        """
+        sync_points = np.asarray(sync_points, dtype=np.float64)
+        assert sync_points.ndim == 2 and sync_points.shape[1] == 2 and sync_points.shape[0] > 1
+        self.sync_points = sync_points
+        self._segments = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _from_file(sync_file, mtime_ns):
+        return ClockSync(np.load(sync_file))
+
+    @staticmethod
+    def from_file(sync_file):
+        """
+        Loads the sync points file, instances are memoized per file and modification time
+        :param sync_file: probe sync file (usually of the form _iblrig_ephysData.raw.imec1.sync.npy)
+        :return: ClockSync
+        """
+        sync_file = Path(sync_file).resolve()
+        return ClockSync._from_file(sync_file, sync_file.stat().st_mtime_ns)
+
+    def to_file(self, sync_file):
+        np.save(sync_file, self.sync_points)
+
+    def _get_segments(self, direction):
+        if direction not in self._segments:
+            x, y = self.sync_points.T if direction == 'forward' else self.sync_points[:, ::-1].T
+            if np.any(np.diff(x) < 0):  # as interp1d, sorts non monotonic sync points
+                isort = np.argsort(x, kind='mergesort')
+                x, y = (x[isort], y[isort])
+            self._segments[direction] = (x, y, np.diff(y) / np.diff(x))
+        return self._segments[direction]
+
+    def __call__(self, times, direction='forward', out=None):
+        """
+        :param times: array of times to transform
+        :param direction: 'forward' from probe time to reference time, 'reverse' otherwise
+        :param out: optional float64 output array, it may be the input array to transform in place
+        :return: transformed times
+        """
+        x, y, slope = self._get_segments(direction)
+        times = np.asarray(times)
+        if out is None:
+            out = np.empty(times.shape, dtype=np.float64)
+        assert out.shape == times.shape and out.flags.c_contiguous
+        tflat, oflat = (times.reshape(-1), out.reshape(-1))
+        for first in range(0, tflat.size, self.CHUNK_SIZE):
+            t = tflat[first:first + self.CHUNK_SIZE]
+            # same segment selection as interp1d: the end segments are extrapolated
+            ilo = np.clip(np.searchsorted(x, t), 1, x.size - 1) - 1
+            oflat[first:first + self.CHUNK_SIZE] = slope[ilo] * (t - x[ilo]) + y[ilo]
+        return out
+
+    def forward(self, times, out=None):
+        return self(times, direction='forward', out=out)
+
+    def reverse(self, times, out=None):
+        return self(times, direction='reverse', out=out)
+
+
+def apply_sync(sync_file, times, forward=True, out=None):
     """
     :param sync_file: probe sync file (usually of the form _iblrig_ephysData.raw.imec1.sync.npy)
     :param times: times in seconds to interpolate
     :param forward: if True goes from probe time to session time, from session time to probe time
     otherwise
+    :param out: optional float64 output array, may be times itself to interpolate in place
     :return: interpolated times
     """
-    sync_points = np.load(sync_file)
-    if forward:
-        fcn = interp1d(sync_points[:, 0],
-                       sync_points[:, 1], fill_value='extrapolate')
-    else:
-        fcn = interp1d(sync_points[:, 1],
-                       sync_points[:, 0], fill_value='extrapolate')
-    return fcn(times)
+    clock = ClockSync.from_file(sync_file)
+    return clock(times, direction='forward' if forward else 'reverse', out=out)
 
 
 def sync(ses_path, **kwargs):
@@ -174,13 +242,16 @@ def version3B(ses_path, display=True, type=None, tol=2.5, probe_names=None):
     return qc_all, out_files
 
 
-def sync_probe_front_times(t, tref, sr, display=False, type='smooth', tol=2.0):
+def sync_probe_front_times(t, tref, sr, display=False, type='smooth', tol=2.0, max_samples=2 ** 23):
     """
     From 2 timestamps vectors of equivalent length, output timestamps array to be used for
     linear interpolation
     :param t: time-serie to be synchronized
     :param tref: time-serie of the reference
     :param sr: sampling rate of the slave probe
+    :param max_samples: for the smooth type, maximum size of the upsampled residual. For sessions
+     too long to be upsampled at 300 Hz, the upsampling rate is lowered, it stays orders of
+     magnitude above the smoothing cut-off frequency.
     :return: a 2 columns by n-sync points array where each row corresponds
     to a sync point: sample_index (0 based), tref
     :return: quality Bool. False if tolerance is exceeded
@@ -204,6 +275,8 @@ def sync_probe_front_times(t, tref, sr, display=False, type='smooth', tol=2.0):
         PAD_LENGTH_SECS = 60
         STAT_LENGTH_SECS = 30  # median length to compute padding value
         SYNC_SAMPLING_RATE_SECS = 20
+        if (tref[-1] - tref[0]) * CAMERA_UPSAMPLING_RATE_HZ > max_samples:
+            CAMERA_UPSAMPLING_RATE_HZ = max(1, int(max_samples / (tref[-1] - tref[0])))
         t_upsamp = np.arange(tref[0], tref[-1], 1 / CAMERA_UPSAMPLING_RATE_HZ)
         res_upsamp = np.interp(t_upsamp, tref, residual)
         # padding needs extra care as the function oscillates and numpy fft performance is
@@ -242,8 +315,7 @@ def sync_probe_front_times(t, tref, sr, display=False, type='smooth', tol=2.0):
             plt.ylabel('Residual drift (samples @ 30kHz)')
             plt.xlabel('time (sec)')
     # test that the interp is within tol sample
-    fcn = interp1d(sync_points[:, 0], sync_points[:, 1], fill_value='extrapolate')
-    if np.any(np.abs((tref - fcn(t)) * sr) > (tol)):
+    if np.any(np.abs((tref - ClockSync(sync_points).forward(t)) * sr) > (tol)):
         _logger.error(f'Synchronization check exceeds tolerance of {tol} samples. Check !!')
         qc = False
         # plt.plot((tref - fcn(t)) * sr)
@@ -325,14 +325,96 @@ def _assign_events_to_trial(t_trial_start, t_event, take='last'):
     return t_event_nans
 
 
+class SyncIndex:
+    """
+    Per-channel index of the sync fronts. The fronts are ordered by channel then by time so that
+    the fronts of a channel within a time window are a contiguous slice found by binary search.
+    The ordering can be persisted next to the sync files as `_{namespace}_syncIndex.order.npy`.
+    """
+
+    def __init__(self, sync, order=None):
+        """
+        :param sync: dict with keys ('times', 'channels', 'polarities') of the sync fronts
+        :param order: (optional) precomputed indices sorting the fronts by channel then time
+        """
+        if order is None:
+            channels = sync['channels'].astype(np.int16)
+            if np.all(np.diff(sync['times']) >= 0):
+                # the fronts are sorted by time: a stable (radix) sort on the channels is enough
+                order = np.argsort(channels, kind='stable')
+            else:
+                order = np.lexsort((sync['times'], channels))
+        self.order = order
+        self.times = sync['times'][order]
+        self.polarities = sync['polarities'][order]
+        self.channels, self.offsets = np.unique(sync['channels'][order], return_index=True)
+        self.offsets = np.r_[self.offsets, order.size]
+
+    def fronts(self, channel_nb, tmin=None, tmax=None):
+        """
+        Return the sync front polarities and times for a given channel, see get_sync_fronts
+        """
+        ich = np.searchsorted(self.channels, channel_nb)
+        if ich == self.channels.size or self.channels[ich] != channel_nb:
+            first = last = 0
+        else:
+            first, last = self.offsets[ich:ich + 2]
+            times = self.times[first:last]
+            if tmax:
+                last = first + np.searchsorted(times, tmax, side='right')
+            if tmin:
+                first = first + np.searchsorted(times, tmin, side='left')
+        return Bunch({'times': self.times[first:last].copy(),
+                      'polarities': self.polarities[first:last].copy()})
+
+    def save(self, path, namespace='spikeglx', parts=''):
+        """Saves the index ordering next to the sync files, returns the list of files written"""
+        return alfio.save_object_npy(path, {'order': self.order}, 'syncIndex',
+                                     namespace=namespace, parts=parts)
+
+    @classmethod
+    def load(cls, sync, path, namespace='spikeglx', parts=''):
+        """
+        Loads the index of a sync dictionary from the files saved in path. If no index file is found
+        or if it doesn't match the sync, the index is computed.
+        """
+        alfname = dict(object='syncIndex', namespace=namespace)
+        if parts:
+            alfname['extra'] = parts
+        if alfio.exists(path, **alfname):
+            order = alfio.load_object(path, **alfname)['order']
+            if cls._sorts(sync, order):
+                return cls(sync, order=order)
+            _logger.warning(f'Sync index in {path} does not match the sync fronts, recomputing')
+        return cls(sync)
+
+    @staticmethod
+    def _sorts(sync, order):
+        """
+        Checks that the order is a permutation of the sync fronts sorting them by channel then time,
+        so that a stale or foreign index file is never used
+        """
+        n = sync['times'].size
+        if order.size != n or not np.issubdtype(order.dtype, np.integer):
+            return False
+        if n == 0:
+            return True
+        if order.min() < 0 or order.max() >= n or np.any(np.bincount(order, minlength=n) != 1):
+            return False
+        dchannels = np.diff(sync['channels'][order])
+        dtimes = np.diff(sync['times'][order])
+        return bool(np.all((dchannels > 0) | ((dchannels == 0) & (dtimes >= 0))))
+
+
 def get_sync_fronts(sync, channel_nb, tmin=None, tmax=None):
     """
     Return the sync front polarities and times for a given channel.
 
     Parameters
     ----------
-    sync : dict
-        'polarities' of fronts detected on sync trace for all 16 channels and their 'times'.
+    sync : dict, SyncIndex
+        'polarities' of fronts detected on sync trace for all 16 channels and their 'times'. If a
+        SyncIndex is provided, the fronts are found by binary search instead of a full scan.
     channel_nb : int
         The integer corresponding to the desired sync channel.
     tmin : float
@@ -345,6 +427,8 @@ def get_sync_fronts(sync, channel_nb, tmin=None, tmax=None):
     Bunch
         Channel times and polarities.
     """
+    if isinstance(sync, SyncIndex):
+        return sync.fronts(channel_nb, tmin=tmin, tmax=tmax)
     selection = sync['channels'] == channel_nb
     selection = np.logical_and(selection, sync['times'] <= tmax) if tmax else selection
     selection = np.logical_and(selection, sync['times'] >= tmin) if tmin else selection
@@ -576,6 +660,9 @@ def extract_sync(session_path, overwrite=False, ephys_files=None, namespace='spi
             sr = spikeglx.Reader(bin_file)
             sync, out_files = _sync_to_alf(sr, bin_file.parent, save=True, parts=efi.label)
             sr.close()
+        # the per-channel index is a local cache for get_sync_fronts, it is not part of the outputs
+        if overwrite or not file_exists or not alfio.exists(bin_file.parent, **{**alfname, 'object': 'syncIndex'}):
+            SyncIndex(sync).save(bin_file.parent, namespace=namespace, parts=efi.label)
         outputs.extend(out_files)
         syncs.extend([sync])
 
@@ -727,6 +814,9 @@ class FpgaTrials(extractors_base.BaseExtractor):
             _sync, _chmap = get_sync_and_chn_map(self.session_path, sync_collection)
             sync = sync or _sync
             chmap = chmap or _chmap
+        # index the fronts per channel once, the persisted index is used if available
+        if not isinstance(sync, SyncIndex):
+            sync = SyncIndex.load(sync, self.session_path.joinpath(sync_collection))
         # load the bpod data and performs a biased choice world training extraction
         # TODO these all need to pass in the collection so we can load for different protocols in different folders
         bpod_raw = raw_data_loaders.load_data(self.session_path, task_collection=task_collection)
@@ -9,7 +9,9 @@ from typing import Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
+import scipy.signal
 
 import ibllib.io.raw_data_loaders as rawio
 from ibllib.io.extractors import ephys_fpga
@@ -138,8 +140,9 @@ def _get_spacer_times(spacer_template, jitter, ttl_signal, t_quiet, thresh=3.0):
     dttl = np.diff(ttl_signal)
     # remove diffs larger than max diff in model to clean up signal
     dttl[dttl > np.max(spacer_model)] = 0
-    # convolve cleaned diff ttl signal w/ spacer model
-    conv_dttl = np.correlate(dttl, spacer_model, mode="full")
+    # correlate cleaned diff ttl signal w/ spacer model (matched filter), in the frequency domain
+    # when it is faster than the direct correlation
+    conv_dttl = scipy.signal.correlate(dttl, spacer_model, mode="full", method="auto")
     # find spacer location
     idxs_spacer_middle = np.where(
         (conv_dttl[1:-2] < thresh) & (conv_dttl[2:-1] > thresh) & (conv_dttl[3:] < thresh)
@@ -151,23 +154,24 @@ def _get_spacer_times(spacer_template, jitter, ttl_signal, t_quiet, thresh=3.0):
     idxs_spacer_middle += 2 - spacer_around
 
     # for each spacer make sure the times are monotonically non-decreasing before
-    # and monotonically non-increasing afterwards
-    is_valid = np.zeros((idxs_spacer_middle.size), dtype=bool)
-    for i, t in enumerate(idxs_spacer_middle):
-        before = all(np.diff(dttl[t - spacer_around:t]) >= 0)
-        after = all(np.diff(dttl[t + 1:t + 1 + spacer_around]) <= 0)
-        is_valid[i] = np.bitwise_and(before, after)
-
+    # and monotonically non-increasing afterwards. The windows of spacer_around - 1 consecutive
+    # diffs are strided views, padded so that windows truncated by the signal edges are valid.
+    ddttl = np.diff(dttl)
+    nw = max(spacer_around - 1, 0)
+    pad = np.ones(2 * spacer_around + 4, dtype=bool)
+    increasing = sliding_window_view(np.r_[pad, ddttl >= 0, pad], nw).all(axis=1)
+    decreasing = sliding_window_view(np.r_[pad, ddttl <= 0, pad], nw).all(axis=1)
+    # the diffs before the middle start at t - spacer_around, the diffs after at t + 1
+    is_valid = (increasing[idxs_spacer_middle - spacer_around + pad.size] &
+                decreasing[idxs_spacer_middle + 1 + pad.size])
     idxs_spacer_middle = idxs_spacer_middle[is_valid]
 
     # pull out spacer times (middle)
     ts_spacer_middle = ttl_signal[idxs_spacer_middle]
     # put beginning/end of spacer times into an array
     spacer_length = np.max(spacer_template)
-    spacer_times = np.zeros(shape=(ts_spacer_middle.shape[0], 2))
-    for i, t in enumerate(ts_spacer_middle):
-        spacer_times[i, 0] = t - (spacer_length / 2) - t_quiet
-        spacer_times[i, 1] = t + (spacer_length / 2) + t_quiet
+    spacer_times = np.c_[ts_spacer_middle - (spacer_length / 2) - t_quiet,
+                         ts_spacer_middle + (spacer_length / 2) + t_quiet]
     return spacer_times, conv_dttl
 
 
@@ -291,16 +295,14 @@ def _reshape_RF(RF_file, meta_stim):
     where frame2ttl placed to create TTL trace.
     :param RF_file: vector to be reshaped, containing RF info
     :param meta_stim: variable containing metadata information on RF
-    :return: frames (reshaped RF), analog trace (0-1 values)
+    :return: frames (reshaped RF, read-only memory mapped view of the file), analog trace (0-1 values)
     """
-    frame_array = np.fromfile(RF_file, dtype="uint8")
+    frame_array = np.memmap(RF_file, dtype="uint8", mode="r")
     y_pix, x_pix, _ = meta_stim["stim_file_shape"]
     frames = np.transpose(np.reshape(frame_array, [y_pix, x_pix, -1], order="F"), [2, 1, 0])
     ttl_trace = frames[:, 0, 0]
     # Convert values to 0,1,-1 for simplicity
-    ttl_analogtrace_01 = np.zeros(np.size(ttl_trace))
-    ttl_analogtrace_01[np.where(ttl_trace == 0)] = -1
-    ttl_analogtrace_01[np.where(ttl_trace == 255)] = 1
+    ttl_analogtrace_01 = np.select([ttl_trace == 0, ttl_trace == 255], [-1., 1.], default=0.)
     return frames, ttl_analogtrace_01
 
 
@@ -620,6 +622,9 @@ class PassiveChoiceWorld(BaseExtractor):
                  sync_map: dict = None, plot: bool = False, **kwargs) -> tuple:
         if sync is None or sync_map is None:
             sync, sync_map = ephys_fpga.get_sync_and_chn_map(self.session_path, sync_collection)
+        # index the sync fronts once: the fronts of each channel and period are then found by binary search
+        if not isinstance(sync, ephys_fpga.SyncIndex):
+            sync = ephys_fpga.SyncIndex(sync)
 
         # Get the start and end times of this protocol
         if (protocol_number := kwargs.get('protocol_number')) is not None:  # look for spacer
@@ -131,31 +131,67 @@ def load_camera_frameData(session_path, camera: str = 'left', raw: bool = False)
                 embeddedFrameCounter,   # Frame counter (int)
                 embeddedGPIOPinState    # GPIO pin state integer representation of 4 pins
             }
+
+    See Also:
+        load_camera_frameData_columns: memory-mapped loader returning numpy columns, with the
+        GPIO as an (n, 4) boolean array, optionally restricted to a time range
+    """
+    df_dict = load_camera_frameData_columns(session_path, camera=camera, raw=raw)
+    if raw:
+        return pd.DataFrame(df_dict)
+    df_dict["embeddedGPIOPinState"] = [np.array(x) for x in df_dict["embeddedGPIOPinState"].tolist()]
+    parsed_df = pd.DataFrame.from_dict(df_dict)
+    return parsed_df
+
+
+def load_camera_frameData_columns(session_path, camera: str = 'left', raw: bool = False,
+                                  time_range=None) -> dict:
+    """ Loads binary frame data from Bonsai camera recording workflow as numpy columns.
+
+    The file is memory-mapped and only the rows within the time range are read and converted.
+
+    Args:
+        session_path (StrPath): Path to session folder
+        camera (str, optional): Load FramsData for specific camera. Defaults to 'left'.
+        raw (bool, optional): Whether to return raw or parsed data. Defaults to False.
+        time_range (tuple, optional): (start, stop) in seconds from the first frame, based on the
+            Timestamp column. Only frames with start <= Timestamp < stop are returned.
+
+    Returns:
+        dict of numpy arrays with keys {
+            Timestamp,              # float64 seconds from first frame, (raw: int64 UTC ticks)
+            embeddedTimeStamp,      # float64 seconds from first frame, (raw: int64 camera timestamp)
+            embeddedFrameCounter,   # int64 frame number from first frame, (raw: int64 frame counter)
+            embeddedGPIOPinState    # (n, 4) bool state of each of the 4 GPIO pins,
+                                    # (raw: int64 integer representation of 4 pins)
+        }
     """
     camera = assert_valid_label(camera)
     fpath = Path(session_path).joinpath("raw_video_data")
     fpath = next(fpath.glob(f"_iblrig_{camera}Camera.frameData*.bin"), None)
     assert fpath, f"{fpath}\nFile not Found: Could not find bin file for cam <{camera}>"
-    rdata = np.fromfile(fpath, dtype=np.float64)
-    assert rdata.size % 4 == 0, "Dimension mismatch: bin file length is not mod 4"
-    rows = int(rdata.size / 4)
-    data = np.reshape(rdata.astype(np.int64), (rows, 4))
-    df_dict = dict.fromkeys(
-        ["Timestamp", "embeddedTimeStamp", "embeddedFrameCounter", "embeddedGPIOPinState"]
-    )
-    df = pd.DataFrame(data, columns=df_dict.keys())
+    nbytes = fpath.stat().st_size
+    assert nbytes % 32 == 0, "Dimension mismatch: bin file length is not mod 4"
+    keys = ["Timestamp", "embeddedTimeStamp", "embeddedFrameCounter", "embeddedGPIOPinState"]
+    if nbytes == 0:
+        data = np.zeros((0, 4))
+    else:
+        data = np.memmap(fpath, dtype=np.float64, mode='r', shape=(nbytes // 32, 4))
+    # the Timestamp column is monotonic: the time range is found by binary search on the memmap
+    first, last = (0, data.shape[0])
+    if time_range is not None and data.shape[0] > 0:
+        first, last = np.searchsorted(data[:, 0], data[0, 0] + np.array(time_range) * 10_000_000)
+    rows = np.array(data[first:last]).astype(np.int64)
     if raw:
-        return df
-
-    df_dict["Timestamp"] = (data[:, 0] - data[0, 0]) / 10_000_000  # in seconds from first frame
-    camerats = uncycle_pgts(convert_pgts(data[:, 1]))
-    df_dict["embeddedTimeStamp"] = camerats - camerats[0]  # in seconds from first frame
-    df_dict["embeddedFrameCounter"] = data[:, 2] - data[0, 2]  # from start
-    gpio = (np.right_shift(np.tile(data[:, 3], (4, 1)).T, np.arange(31, 27, -1)) & 0x1) == 1
-    df_dict["embeddedGPIOPinState"] = [np.array(x) for x in gpio.tolist()]
-
-    parsed_df = pd.DataFrame.from_dict(df_dict)
-    return parsed_df
+        return dict(zip(keys, rows.T.copy()))
+    df_dict = dict.fromkeys(keys)
+    df_dict["Timestamp"] = (rows[:, 0] - int(data[0, 0])) / 10_000_000 if rows.size else np.zeros(0)
+    # the camera timestamps are uncycled from the first frame, as they wrap every 128 seconds
+    camerats = uncycle_pgts(convert_pgts(np.array(data[:last, 1]).astype(np.int64)))
+    df_dict["embeddedTimeStamp"] = camerats[first:] - camerats[0] if rows.size else np.zeros(0)
+    df_dict["embeddedFrameCounter"] = rows[:, 2] - int(data[0, 2]) if rows.size else np.zeros(0, dtype=np.int64)
+    df_dict["embeddedGPIOPinState"] = (np.right_shift(rows[:, 3, np.newaxis], np.arange(31, 27, -1)) & 0x1) == 1
+    return df_dict
 
 
 def load_camera_ssv_times(session_path, camera: str):
@@ -171,8 +207,8 @@ def load_camera_ssv_times(session_path, camera: str):
     camera = assert_valid_label(camera)
     video_path = Path(session_path).joinpath('raw_video_data')
     if next(video_path.glob(f'_iblrig_{camera}Camera.frameData*.bin'), None):
-        df = load_camera_frameData(session_path, camera=camera)
-        return df['Timestamp'].values, df['embeddedTimeStamp'].values
+        df = load_camera_frameData_columns(session_path, camera=camera)
+        return df['Timestamp'], df['embeddedTimeStamp']
 
     file = next(video_path.glob(f'_iblrig_{camera.lower()}Camera.timestamps*.ssv'), None)
     if not file:
@@ -230,8 +266,8 @@ def load_camera_frame_count(session_path, label: str, raw=True):
     label = assert_valid_label(label)
     video_path = Path(session_path).joinpath('raw_video_data')
     if next(video_path.glob(f'_iblrig_{label}Camera.frameData*.bin'), None):
-        df = load_camera_frameData(session_path, camera=label)
-        return df['embeddedFrameCounter'].values
+        df = load_camera_frameData_columns(session_path, camera=label)
+        return df['embeddedFrameCounter']
 
     # Load frame count
     glob = video_path.glob(f'_iblrig_{label}Camera.frame_counter*.bin')
@@ -268,8 +304,8 @@ def load_camera_gpio(session_path, label: str, as_dicts=False):
 
     # Load pin state
     if next(raw_path.glob(f'_iblrig_{label}Camera.frameData*.bin'), False):
-        df = load_camera_frameData(session_path, camera=label, raw=False)
-        gpio = np.array([x for x in df['embeddedGPIOPinState'].values])
+        df = load_camera_frameData_columns(session_path, camera=label, raw=False)
+        gpio = df['embeddedGPIOPinState']
         if len(gpio) == 0:
             return [None] * 4 if as_dicts else None
     else:
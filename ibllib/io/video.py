@@ -1,6 +1,9 @@
 """Functions for fetching video frames, meta data and file locations"""
 import sys
 import re
+import struct
+import queue
+import threading
 from datetime import timedelta
 from pathlib import Path
 
@@ -12,6 +15,7 @@ from one.api import ONE
 from one import params
 
 VIDEO_LABELS = ('left', 'right', 'body')
+KEYFRAME_INTERVAL = 250  # assumed keyframe interval when the keyframe table can't be read (x264 default)
 
 
 class VideoStreamer:
@@ -43,6 +47,83 @@ class VideoStreamer:
         self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
         return self.cap.read()
 
+    def get_frames(self, frame_numbers, **kwargs):
+        """
+        Returns the frames for the given frame indices, see get_video_frames_preload
+        """
+        return get_video_frames_preload(self, frame_numbers, **kwargs)
+
+
+def _mp4_boxes(fid, start, end):
+    """Iterates over the mp4 boxes between the start and end file positions: yields type, start, end"""
+    pos = start
+    while pos + 8 <= end:
+        fid.seek(pos)
+        size, box = struct.unpack('>I4s', fid.read(8))
+        header = 8
+        if size == 1:  # 64 bits box size
+            size, header = (struct.unpack('>Q', fid.read(8))[0], 16)
+        elif size == 0:  # box extends to the end of the file
+            size = end - pos
+        if size < header:
+            return
+        yield box.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+
+def get_keyframes(video_path):
+    """
+    Returns the indices of the keyframes of a local mp4 file, read from the sync sample table
+    (stss box) of the video track.
+    :param video_path: local path to mp4 file
+    :return: sorted numpy array of 0-based keyframe indices, or None if the table can't be read
+    """
+    def find(fid, start, end, *path):
+        for box, bstart, bend in _mp4_boxes(fid, start, end):
+            if box == path[0]:
+                return (bstart, bend) if len(path) == 1 else find(fid, bstart, bend, *path[1:])
+
+    try:
+        with open(video_path, 'rb') as fid:
+            moov = find(fid, 0, fid.seek(0, 2), 'moov')
+            for box, start, end in _mp4_boxes(fid, *moov):
+                if box != 'trak' or not (hdlr := find(fid, start, end, 'mdia', 'hdlr')):
+                    continue
+                fid.seek(hdlr[0] + 8)  # version/flags and pre-defined fields
+                if fid.read(4) != b'vide':
+                    continue
+                stbl = find(fid, start, end, 'mdia', 'minf', 'stbl')
+                if stss := find(fid, *stbl, 'stss'):
+                    fid.seek(stss[0] + 4)
+                    n, = struct.unpack('>I', fid.read(4))
+                    return np.frombuffer(fid.read(4 * n), dtype='>u4').astype(np.int64) - 1
+                # without sync sample table, all samples are keyframes
+                stsz = find(fid, *stbl, 'stsz')
+                fid.seek(stsz[0] + 8)
+                return np.arange(struct.unpack('>I', fid.read(4))[0])
+    except (OSError, TypeError, struct.error):
+        pass
+    return None
+
+
+def _plan_seeks(frame_numbers, keyframes, position=None):
+    """
+    For sorted unique frame indices, determines whether to seek or to decode forward from the previous
+    frame. Seeking restarts decoding from the nearest keyframe before the frame, so it is only worth it
+    if that keyframe is after the current position.
+    :param frame_numbers: sorted unique frame indices
+    :param keyframes: sorted keyframe indices
+    :param position: index of the next frame to be decoded, None if unknown
+    :return: boolean array, True where the capture position must be set
+    """
+    frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+    if frame_numbers.size == 0:
+        return np.zeros(0, dtype=bool)
+    next_frame = np.r_[-1 if position is None else position, frame_numbers[:-1] + 1]
+    ikf = np.searchsorted(keyframes, frame_numbers, side='right') - 1
+    previous_keyframe = np.where(ikf >= 0, keyframes[np.maximum(ikf, 0)], 0)
+    return np.logical_or(next_frame < 0, previous_keyframe > next_frame)
+
 
 def get_video_frame(video_path, frame_number):
     """
@@ -61,18 +142,23 @@ def get_video_frame(video_path, frame_number):
 
 
 def get_video_frames_preload(vid, frame_numbers=None, mask=Ellipsis, as_list=False,
-                             func=lambda x: x, quiet=False):
+                             func=lambda x: x, quiet=False, keyframes=None):
     """
     Obtain numpy array corresponding to a particular video frame in video.
     Fetching and returning a list is about 33% faster but may be less memory controlled. NB: Any
     gain in speed will be lost if subsequently converted to array.
-    :param vid: URL or local path to mp4 file or cv2.VideoCapture instance.
+    The frames are decoded in increasing order on a background thread: the capture position is only
+    set when the nearest keyframe before a frame is after the current position, otherwise the
+    frames are decoded forward.
+    :param vid: URL or local path to mp4 file, VideoStreamer or cv2.VideoCapture instance.
     :param frame_numbers: video frames to be returned. If None, return all frames.
     :param mask: a logical mask or slice to apply to frames
     :param as_list: if true the frames are returned as a list, this is faster but may be less
     memory efficient
     :param func: Function to be applied to each frame. Applied after masking if applicable.
     :param quiet: if true, suppress frame loading progress output.
+    :param keyframes: sorted keyframe indices. By default read from local mp4 files, otherwise a
+    keyframe every KEYFRAME_INTERVAL frames is assumed.
     :return: numpy array corresponding to frame of interest, or list if as_list is True.
     Default dimensions are (n, w, h, 3) where n = len(frame_numbers)
 
@@ -81,36 +167,81 @@ def get_video_frames_preload(vid, frame_numbers=None, mask=Ellipsis, as_list=Fal
     """
     is_cap = not isinstance(vid, (str, Path))
     if is_cap:
-        cap = vid
+        cap = vid.cap if isinstance(vid, VideoStreamer) else vid
     else:
         is_url = isinstance(vid, str) and vid.startswith('http')
         cap = VideoStreamer(vid).cap if is_url else cv2.VideoCapture(str(vid))
+        if keyframes is None and not is_url:
+            keyframes = get_keyframes(vid)
     assert cap.isOpened(), 'Failed to open video'
 
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     frame_numbers = frame_numbers if frame_numbers is not None else range(frame_count)
+    if keyframes is None:
+        keyframes = np.arange(0, max(frame_count, 1), KEYFRAME_INTERVAL)
 
-    # Setting the index is extremely slow; determine where frame index must be set
-    # The first index is always explicitly set.
-    to_set = np.insert(np.diff(frame_numbers), 0, 0) != 1
+    # Setting the index is extremely slow; the frames are read in increasing order, decoding
+    # forward unless a keyframe is found between the current position and the next frame
+    targets, iout = np.unique(np.asarray(frame_numbers, dtype=np.int64), return_inverse=True)
+    to_set = _plan_seeks(targets, keyframes, position=None if is_cap else 0)
+    isort = np.argsort(iout, kind='stable')
+    bounds = np.searchsorted(iout[isort], np.arange(targets.size + 1))
     if as_list:
         frame_images = [None] * len(frame_numbers)
     else:
-        ret, frame = cap.read()
+        w, h = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        frame = np.zeros((h, w, 3), np.uint8)
         frame_images = np.zeros((len(frame_numbers), *func(frame[mask or ...]).shape), np.uint8)
-    for ii, i in enumerate(frame_numbers):
-        if not quiet:
-            sys.stdout.write(f'\rloading frame {ii}/{len(frame_numbers)}')
-            sys.stdout.flush()
-        if to_set[ii]:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = cap.read()
-        if ret:
-            frame_images[ii] = func(frame[mask or ...])
-        else:
-            print(f'failed to read frame #{i}')
+
+    # decode on a background thread, opencv releases the GIL
+    frames, stop, error = (queue.Queue(maxsize=16), threading.Event(), [])
+
+    def decode():
+        try:
+            position = 0
+            for i, set_position in zip(targets, to_set):
+                if stop.is_set():
+                    break
+                if set_position:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+                else:
+                    for _ in range(i - position):
+                        cap.grab()
+                position = i + 1
+                frames.put(cap.read())
+        except Exception as e:
+            error.append(e)
+        finally:
+            frames.put(None)
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        for ii, i in enumerate(targets):
+            if not quiet:
+                sys.stdout.write(f'\rloading frame {ii}/{len(targets)}')
+                sys.stdout.flush()
+            if (item := frames.get()) is None:
+                break
+            ret, frame = item
+            if ret:
+                frame = func(frame[mask or ...])
+                for iframe in isort[bounds[ii]:bounds[ii + 1]]:
+                    frame_images[iframe] = frame
+            else:
+                print(f'failed to read frame #{i}')
+    finally:
+        # unblock and wait for the decoding thread before releasing the capture
+        stop.set()
+        while thread.is_alive():
+            try:
+                frames.get(timeout=.1)
+            except queue.Empty:
+                pass
     if not is_cap:
         cap.release()
+    if error:
+        raise error[0]
     if not quiet:
         sys.stdout.write('\x1b[2K\r')  # Erase current line in stdout
     return frame_images
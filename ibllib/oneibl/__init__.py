@@ -1 +1,22 @@
 """IBL pipeline-specific ONE functions"""
+import threading
+
+from one.api import ONE
+
+_WORKER = threading.local()
+
+
+def worker_one(base_url):
+    """
+    Returns a ONE client for the given base URL, instantiated once per thread of each process. This
+    is meant for pool workers, which can't share a ONE instance as it isn't thread safe and can't
+    be passed to other processes.
+
+    :param base_url: the Alyx database URL
+    :return: one.api.One instance, with the REST cache disabled
+    """
+    if not hasattr(_WORKER, 'one'):
+        _WORKER.one = {}
+    if base_url not in _WORKER.one:
+        _WORKER.one[base_url] = ONE(base_url=base_url, cache_rest=None)
+    return _WORKER.one[base_url]
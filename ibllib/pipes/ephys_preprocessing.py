@@ -135,7 +135,7 @@ class RawEphysQC(tasks.Task):
             _logger.info(f"\nRunning QC for probe insertion {pname}")
             try:
                 eqc = ephysqc.EphysQC(pid, session_path=self.session_path, one=self.one)
-                qc_files.extend(eqc.run(update=True, overwrite=overwrite))
+                qc_files.extend(eqc.run(update=True, overwrite=overwrite, n_workers=self.cpu))
                 _logger.info("Creating LFP QC plots")
                 plot_task = LfpPlots(pid, session_path=self.session_path, one=self.one)
                 _ = plot_task.run()
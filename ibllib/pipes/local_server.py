@@ -1,5 +1,6 @@
 import logging
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from pathlib import Path
 import pkg_resources
@@ -9,13 +10,14 @@ import sys
 import traceback
 import importlib
 
-from one.api import ONE
+from one.api import ONE, One
 from one.webclient import AlyxClient
 from one.remote.globus import get_lab_from_endpoint_id
 
 from ibllib.io.extractors.base import get_pipeline, get_task_protocol, get_session_extractor_type
 from ibllib.pipes import tasks, training_preprocessing, ephys_preprocessing
 from ibllib.time import date2isostr
+from ibllib.oneibl import worker_one
 from ibllib.oneibl.registration import IBLRegistrationClient, register_session_raw_data, get_lab
 from ibllib.oneibl.data_handlers import get_local_data_repository
 from ibllib.io.session_params import read_params
@@ -199,7 +201,27 @@ def task_queue(mode='all', lab=None, alyx=None):
     return sorted_tasks
 
 
-def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None, **kwargs):
+def _get_session_path(subjects_path, eid, one, cache):
+    """Reconstructs the local session path from an Alyx session id, caching the REST result"""
+    if eid not in cache:
+        ses = one.alyx.rest('sessions', 'list', django=f"pk,{eid}")[0]
+        cache[eid] = Path(subjects_path).joinpath(
+            Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
+    return cache[eid]
+
+
+def _task_class(tdict):
+    strmodule, strclass = tdict['executable'].rsplit('.', 1)
+    return getattr(importlib.import_module(strmodule), strclass)
+
+
+def _run_alyx_task_process(tdict, session_path, base_url, **kwargs):
+    """Runs an Alyx task in a pool process, instantiating one ONE client per process"""
+    return tasks.run_alyx_task(tdict=tdict, session_path=session_path, one=worker_one(base_url), **kwargs)
+
+
+def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None,
+                 n_workers=1, gpu_slots=1, large_slots=1, pool='process', **kwargs):
     """
     Function to run a list of tasks (task dictionary from Alyx query) on a local server
     :param subjects_path:
@@ -208,14 +230,25 @@ def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_o
     :param dry:
     :param count: maximum number of tasks to run
     :param time_out: between each task, if time elapsed is greater than time out, returns (seconds)
+    :param n_workers: number of CPU slots. If above 1, independent tasks are run concurrently, see
+     _tasks_runner_concurrent
+    :param gpu_slots: (concurrent mode) maximum number of GPU tasks running at once
+    :param large_slots: (concurrent mode) maximum number of large jobs running at once
+    :param pool: (concurrent mode) 'process' runs each task in a separate process with its own
+     ONE client, 'thread' runs tasks in threads sharing the `one` instance, which is only allowed for
+     a local stand-in Alyx client for offline runs as ONE and Alyx clients aren't thread safe
     :param kwargs:
     :return: list of dataset dictionaries
     """
     if one is None:
         one = ONE(cache_rest=None)
+    if n_workers > 1 and not dry:
+        return _tasks_runner_concurrent(subjects_path, tasks_dict, one=one, count=count, time_out=time_out,
+                                        n_workers=n_workers, gpu_slots=gpu_slots, large_slots=large_slots,
+                                        pool=pool, **kwargs)
     tstart = time.time()
     c = 0
-    last_session = None
+    session_paths = {}
     all_datasets = []
     for tdict in tasks_dict:
         # if the count is reached or if the time_out has been elapsed, break the loop and return
@@ -223,11 +256,7 @@ def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_o
             break
         # reconstruct the session local path. As many jobs belong to the same session
         # cache the result
-        if last_session != tdict['session']:
-            ses = one.alyx.rest('sessions', 'list', django=f"pk,{tdict['session']}")[0]
-            session_path = Path(subjects_path).joinpath(
-                Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
-            last_session = tdict['session']
+        session_path = _get_session_path(subjects_path, tdict['session'], one, session_paths)
         if dry:
             print(session_path, tdict['name'])
         else:
@@ -237,3 +266,84 @@ def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_o
                 all_datasets.extend(dsets)
                 c += 1
     return all_datasets
+
+
+def _tasks_runner_concurrent(subjects_path, tasks_dict, one=None, count=5, time_out=None,
+                             n_workers=2, gpu_slots=1, large_slots=1, pool='process', **kwargs):
+    """
+    Schedules the tasks of the queue on a pool of workers. Tasks are considered in the queue order
+    (ie. by priority) and a task is started as soon as:
+    -   none of its parents from the queue are pending or running
+    -   no other task of the same session is running (one task per session at a time)
+    -   there are enough CPU slots (task.cpu, capped to n_workers) and GPU slots (task.gpu) free
+    -   the number of large jobs running is below large_slots
+    -   for GPU tasks, no GPU lock file is found (see Task.is_locked)
+    No new task is started once `time_out` has elapsed, or if the tasks that registered datasets and
+    the running tasks could reach `count`. The function returns after the running tasks completed.
+    :return: list of dataset dictionaries
+    """
+    tstart = time.time()
+    c = 0
+    session_paths = {}
+    all_datasets = []
+    pending = list(tasks_dict)
+    running = {}  # future: (tdict, cpu, gpu, large)
+    if pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        func, fkwargs = (_run_alyx_task_process, dict(base_url=one.alyx.base_url, **kwargs))
+    elif pool == 'thread':
+        # ONE and Alyx clients aren't thread safe: threads are only meant for offline stand-in clients
+        if isinstance(one, (One, AlyxClient)) or isinstance(getattr(one, 'alyx', None), AlyxClient):
+            raise ValueError('The thread pool requires an offline stand-in Alyx client, use pool="process" with ONE')
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        func, fkwargs = (tasks.run_alyx_task, dict(one=one, **kwargs))
+    else:
+        raise ValueError(f'Unknown pool "{pool}"')
+    with executor:
+        while pending or running:
+            if not (c >= count or (time_out and time.time() - tstart > time_out)):
+                busy_ids = set(t['id'] for t in pending) | set(r[0]['id'] for r in running.values())
+                busy_sessions = set(r[0]['session'] for r in running.values())
+                cpu = sum(r[1] for r in running.values())
+                gpu = sum(r[2] for r in running.values())
+                large = sum(r[3] for r in running.values())
+                for tdict in list(pending):
+                    # running tasks may register datasets: don't start more than count
+                    if c + len(running) >= count:
+                        break
+                    if busy_ids.intersection(tdict['parents']) or tdict['session'] in busy_sessions:
+                        continue
+                    try:
+                        classe = _task_class(tdict)
+                    except Exception:
+                        _logger.error(traceback.format_exc())
+                        pending.remove(tdict)
+                        continue
+                    tcpu, tgpu = (min(classe.cpu, n_workers), classe.gpu)
+                    tlarge = int(classe.job_size == 'large')
+                    if cpu + tcpu > n_workers or gpu + tgpu > gpu_slots or large + tlarge > large_slots:
+                        continue
+                    if tgpu and classe.is_locked():
+                        continue
+                    session_path = _get_session_path(subjects_path, tdict['session'], one, session_paths)
+                    future = executor.submit(func, tdict=tdict, session_path=session_path, **fkwargs)
+                    running[future] = (tdict, tcpu, tgpu, tlarge)
+                    pending.remove(tdict)
+                    busy_sessions.add(tdict['session'])
+                    cpu, gpu, large = (cpu + tcpu, gpu + tgpu, large + tlarge)
+            # nothing running means that the remaining tasks can't be started during this run
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tdict = running.pop(future)[0]
+                try:
+                    task, dsets = future.result()
+                except Exception:
+                    _logger.error(traceback.format_exc())
+                    _logger.warning(f"Running task {tdict['name']} for session {tdict['session']} errored")
+                    continue
+                if dsets:
+                    all_datasets.extend(dsets)
+                    c += 1
+    return all_datasets
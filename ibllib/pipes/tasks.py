@@ -351,9 +351,10 @@ class Task(abc.ABC):
         """creates a lock file with the current time"""
         return Task.make_lock_file(self.name, self.time_out_secs)
 
-    def is_locked(self):
+    @classmethod
+    def is_locked(cls):
         """Checks if there is a lock file for this given task"""
-        lock_file = self._lock_file_path()
+        lock_file = cls._lock_file_path()
         if not lock_file.exists():
             return False
 
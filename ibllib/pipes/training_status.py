@@ -1,7 +1,11 @@
+import logging
+from functools import partial
+
 import one.alf.io as alfio
 from one.alf.exceptions import ALFObjectNotFound
 
 from ibllib.io.raw_data_loaders import load_bpod
+from ibllib.oneibl import worker_one
 from ibllib.oneibl.registration import _get_session_times
 from ibllib.io.extractors.base import get_pipeline, get_session_extractor_type
 
@@ -9,6 +13,9 @@ from ibllib.plots.snapshot import ReportSnapshot
 from iblutil.numerical import ismember
 from brainbox.behavior import training
 
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from pathlib import Path
@@ -18,6 +25,7 @@ from matplotlib.lines import Line2D
 from datetime import datetime
 import seaborn as sns
 
+_logger = logging.getLogger(__name__)
 
 TRAINING_STATUS = {'untrainable': (-4, (0, 0, 0, 0)),
                    'unbiasable': (-3, (0, 0, 0, 0)),
@@ -83,14 +91,63 @@ def load_existing_dataframe(subj_path):
         return None
 
 
-def load_trials(sess_path, one, force=True):
+def summary_cache_path(subj_path):
+    return Path(subj_path).joinpath('training_sessions.json')
+
+
+def load_summary_cache(subj_path):
+    """
+    Load the per-session summary cache from disk, if it doesn't exist returns an empty dictionary
+    :param subj_path: path to subject folder
+    :return: dict {session_path: {'hash': trials files hash, 'summary': session summary}}
+    """
+    cache_location = summary_cache_path(subj_path)
+    if cache_location.exists():
+        with open(cache_location, 'r') as fid:
+            return json.load(fid)
+    return {}
+
+
+def save_summary_cache(cache, subj_path):
+    """
+    Save the per-session summary cache to disk
+    :param cache: dict {session_path: {'hash': trials files hash, 'summary': session summary}}
+    :param subj_path: path to subject folder
+    :return:
+    """
+    with open(summary_cache_path(subj_path), 'w') as fid:
+        json.dump(cache, fid)
+
+
+def trials_hash(sess_path):
+    """
+    Hash of the name, size and modification time of the local trials files of a session
+    :param sess_path: session path
+    :return: hexadecimal digest, None if there are no local trials files
+    """
+    files = sorted(Path(sess_path).joinpath('alf').glob('*trials.*'))
+    if len(files) == 0:
+        return None
+    md5 = hashlib.md5()
+    for file in files:
+        stat = file.stat()
+        md5.update(f'{file.name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return md5.hexdigest()
+
+
+def load_trials(sess_path, one, force=True, trials_cache=None):
     """
     Load trials data for session. First attempts to load from local session path, if this fails will attempt to download via ONE,
     if this also fails, will then attempt to re-extraxt locally
     :param sess_path: session path
     :param one: ONE instance
+    :param trials_cache: optional dictionary of trials keyed by session path, trials are loaded once per session
     :return:
     """
+    if trials_cache is not None:
+        if str(sess_path) not in trials_cache:
+            trials_cache[str(sess_path)] = load_trials(sess_path, one, force=force)
+        return trials_cache[str(sess_path)]
     # try and load trials locally
     try:
         trials = alfio.load_object(sess_path.joinpath('alf'), 'trials', short_keys=True)
@@ -120,18 +177,19 @@ def load_trials(sess_path, one, force=True):
     return trials
 
 
-def load_combined_trials(sess_paths, one, force=True):
+def load_combined_trials(sess_paths, one, force=True, trials_cache=None):
     """
     Load and concatenate trials for multiple sessions. Used when we want to concatenate trials for two sessions on the same day
     :param sess_paths: list of paths to sessions
     :param one: ONE instance
+    :param trials_cache: optional dictionary of trials keyed by session path, see load_trials
     :return:
     """
     trials_dict = {}
     for sess_path in sess_paths:
-        trials = load_trials(Path(sess_path), one, force=force)
+        trials = load_trials(Path(sess_path), one, force=force, trials_cache=trials_cache)
         if trials is not None:
-            trials_dict[Path(sess_path).stem] = load_trials(Path(sess_path), one, force=force)
+            trials_dict[Path(sess_path).stem] = trials
 
     return training.concatenate_trials(trials_dict)
 
@@ -140,6 +198,10 @@ def get_latest_training_information(sess_path, one):
     """
     Extracts the latest training status.
 
+    The per-session summaries are cached in the subject folder (see load_summary_cache) and are only
+    recomputed when the session's trials files change. Trials are loaded at most once per session when
+    recomputing the training status over several dates.
+
     Parameters
     ----------
     sess_path : pathlib.Path
@@ -155,13 +217,22 @@ def get_latest_training_information(sess_path, one):
 
     subj_path = sess_path.parent.parent
     df = load_existing_dataframe(subj_path)
+    summary_cache = load_summary_cache(subj_path)
+    trials_cache = {}
+
+    # Sessions whose trials changed since they were summarised need to be recomputed
+    if df is not None:
+        stale = [sp for sp, cached in summary_cache.items() if trials_hash(sp) not in (None, cached['hash'])]
+        stale_dates = df.loc[df['session_path'].isin(stale), 'date'].unique()
+        df = df[~df['date'].isin(stale_dates)]
 
     # Find the dates and associated session paths where we don't have data stored in our dataframe
     missing_dates = check_up_to_date(subj_path, df)
 
     # Iterate through the dates to fill up our training dataframe
     for _, grp in missing_dates.groupby('date'):
-        sess_dicts = get_training_info_for_session(grp.session_path.values, one)
+        sess_dicts = get_training_info_for_session(grp.session_path.values, one, summary_cache=summary_cache,
+                                                   trials_cache=trials_cache)
         if len(sess_dicts) == 0:
             continue
 
@@ -176,13 +247,14 @@ def get_latest_training_information(sess_path, one):
     df = df.reset_index(drop=True)
     # Save our dataframe
     save_dataframe(df, subj_path)
+    save_summary_cache(summary_cache, subj_path)
 
     # Now go through the backlog and compute the training status for sessions. If for example one was missing as it is cumulative
     # we need to go through and compute all the back log
     # Find the earliest date in missing dates that we need to recompute the training status for
     missing_status = find_earliest_recompute_date(df.drop_duplicates('date').reset_index(drop=True))
     for date in missing_status:
-        df = compute_training_status(df, date, one)
+        df = compute_training_status(df, date, one, trials_cache=trials_cache)
 
     df_lim = df.drop_duplicates(subset='session_path', keep='first')
     # Detect untrainable
@@ -204,6 +276,65 @@ def get_latest_training_information(sess_path, one):
     return df
 
 
+def _get_latest_training_information_worker(sess_path, base_url):
+    """Updates the training table of a subject in a pool worker, instantiating one ONE client per worker"""
+    return get_latest_training_information(sess_path, worker_one(base_url))
+
+
+def get_training_information_for_subjects(subj_paths, one, n_workers=1, rebuild=False, pool='process'):
+    """
+    Update the training tables of several subjects, e.g. all the subjects of a lab, in parallel.
+
+    Parameters
+    ----------
+    subj_paths : list of pathlib.Path
+        The subject folders containing the dated session folders.
+    one : one.api.One, None
+        An ONE instance. With several workers, as ONE isn't thread safe, each worker instantiates a
+        client with the same base URL. If None, only the local data are used.
+    n_workers : int
+        The number of subjects processed concurrently.
+    rebuild : bool
+        If True, the training tables are recomputed from scratch. The cached session summaries are
+        kept so that only the training status is recomputed for unchanged sessions.
+    pool : {'process', 'thread'}
+        Whether to process the subjects in separate processes or in threads.
+
+    Returns
+    -------
+    dict
+        A map of subject folder name to training table, subjects that failed are logged and skipped.
+    """
+    sess_paths = {}
+    for subj_path in map(Path, subj_paths):
+        sessions = sorted(alfio.iter_sessions(subj_path))
+        if len(sessions) == 0:
+            continue
+        if rebuild and save_path(subj_path).exists():
+            save_path(subj_path).unlink()
+        sess_paths[subj_path.name] = sessions[-1]
+
+    if n_workers > 1 and one is not None:
+        fcn = partial(_get_latest_training_information_worker, base_url=one.alyx.base_url)
+    else:
+        fcn = partial(get_latest_training_information, one=one)
+    if n_workers > 1 and pool == 'process':
+        executor = ProcessPoolExecutor(n_workers)
+    elif n_workers == 1 or pool == 'thread':
+        executor = ThreadPoolExecutor(n_workers)
+    else:
+        raise ValueError(f'Unknown pool "{pool}"')
+    with executor:
+        futures = {subject: executor.submit(fcn, sess_path) for subject, sess_path in sess_paths.items()}
+    dfs = {}
+    for subject, future in futures.items():
+        try:
+            dfs[subject] = future.result()
+        except Exception as ex:
+            _logger.error(f'{subject}: failed to compute training status: {ex}')
+    return dfs
+
+
 def find_earliest_recompute_date(df):
     """
     Find the earliest date that we need to compute the training status from. Training status depends on previous sessions
@@ -220,12 +351,14 @@ def find_earliest_recompute_date(df):
     return df[first_index:].date.values
 
 
-def compute_training_status(df, compute_date, one, force=True):
+def compute_training_status(df, compute_date, one, force=True, trials_cache=None):
     """
     Compute the training status for compute date based on training from that session and two previous days
     :param df: training dataframe
     :param compute_date: date to compute training on
     :param one: ONE instance
+    :param trials_cache: optional dictionary of trials keyed by session path, when computing the status over
+     consecutive dates this avoids reloading the trials of the previous days
     :return:
     """
 
@@ -255,7 +388,8 @@ def compute_training_status(df, compute_date, one, force=True):
         # If habituation skip
         if df_date.iloc[-1]['task_protocol'] == 'habituation':
             continue
-        trials[df_date.iloc[-1]['date']] = load_combined_trials(df_date.session_path.values, one, force=force)
+        trials[df_date.iloc[-1]['date']] = load_combined_trials(
+            df_date.session_path.values, one, force=force, trials_cache=trials_cache)
         protocol.append(df_date.iloc[-1]['task_protocol'])
         status.append(df_date.iloc[-1]['training_status'])
         if df_date.iloc[-1]['combined_n_delay'] >= 900:  # delay of 15 mins
@@ -320,11 +454,72 @@ def compute_session_duration_delay_location(sess_path, **kwargs):
     return session_duration, session_delay, session_location
 
 
-def get_training_info_for_session(session_paths, one, force=True):
+def _to_json(value):
+    """Convert numpy arrays and scalars of a session summary to JSON serializable types"""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def compute_session_summary(session_path, task_protocol, one, force=True, summary_cache=None, trials_cache=None):
+    """
+    Compute the performance, psychometric fit parameters, reaction time, trial count, session duration, delay and location
+    of a single session.
+    :param session_path: session path
+    :param task_protocol: the session extractor type, e.g. 'training' or 'biased'
+    :param one: ONE instance
+    :param summary_cache: optional dictionary of summaries keyed by session path, see load_summary_cache. Cached
+     summaries are returned as long as the local trials files are unchanged, new summaries are added to the cache
+    :param trials_cache: optional dictionary of trials keyed by session path, see load_trials
+    :return: dict of session summary, None if the trials can't be loaded
+    """
+    key = str(session_path)
+    if summary_cache is not None and key in summary_cache:
+        if summary_cache[key]['hash'] == trials_hash(session_path):
+            summary = dict(summary_cache[key]['summary'])
+            summary['performance'] = np.array(summary['performance'], dtype=float)
+            summary['contrasts'] = np.array(summary['contrasts'], dtype=float)
+            return summary
+
+    trials = load_trials(session_path, one, force=force, trials_cache=trials_cache)
+    if trials is None:
+        return None
+
+    summary = {}
+    summary['performance'], summary['contrasts'], _ = training.compute_performance(trials, prob_right=True)
+    if task_protocol == 'training':
+        summary['bias_50'], summary['thres_50'], summary['lapsehigh_50'], summary['lapselow_50'] = \
+            training.compute_psychometric(trials)
+        summary['bias_20'], summary['thres_20'], summary['lapsehigh_20'], summary['lapselow_20'] = \
+            (np.nan, np.nan, np.nan, np.nan)
+        summary['bias_80'], summary['thres_80'], summary['lapsehigh_80'], summary['lapselow_80'] = \
+            (np.nan, np.nan, np.nan, np.nan)
+    else:
+        psych_50, psych_20, psych_80 = training.compute_psychometric_batch([trials] * 3, blocks=[0.5, 0.2, 0.8])
+        summary['bias_50'], summary['thres_50'], summary['lapsehigh_50'], summary['lapselow_50'] = psych_50
+        summary['bias_20'], summary['thres_20'], summary['lapsehigh_20'], summary['lapselow_20'] = psych_20
+        summary['bias_80'], summary['thres_80'], summary['lapsehigh_80'], summary['lapselow_80'] = psych_80
+
+    summary['performance_easy'] = training.compute_performance_easy(trials)
+    summary['reaction_time'] = training.compute_median_reaction_time(trials)
+    summary['n_trials'] = training.compute_n_trials(trials)
+    summary['sess_duration'], summary['n_delay'], summary['location'] = \
+        compute_session_duration_delay_location(session_path)
+
+    # The hash is computed after loading as the trials may have been downloaded or extracted
+    hash_ = trials_hash(session_path)
+    if summary_cache is not None and hash_ is not None:
+        summary_cache[key] = {'hash': hash_, 'summary': {k: _to_json(v) for k, v in summary.items()}}
+    return summary
+
+
+def get_training_info_for_session(session_paths, one, force=True, summary_cache=None, trials_cache=None):
     """
     Extract the training information needed for plots for each session
     :param session_paths: list of session paths on same date
     :param one: ONE instance
+    :param summary_cache: optional dictionary of session summaries, see compute_session_summary
+    :param trials_cache: optional dictionary of trials keyed by session path, see load_trials
     :return:
     """
 
@@ -356,31 +551,11 @@ def get_training_info_for_session(session_paths, one, force=True):
 
         else:
             # if we can't compute trials then we need to pass
-            trials = load_trials(session_path, one, force=force)
-            if trials is None:
+            summary = compute_session_summary(session_path, sess_dict['task_protocol'], one, force=force,
+                                              summary_cache=summary_cache, trials_cache=trials_cache)
+            if summary is None:
                 continue
-
-            sess_dict['performance'], sess_dict['contrasts'], _ = training.compute_performance(trials, prob_right=True)
-            if sess_dict['task_protocol'] == 'training':
-                sess_dict['bias_50'], sess_dict['thres_50'], sess_dict['lapsehigh_50'], sess_dict['lapselow_50'] = \
-                    training.compute_psychometric(trials)
-                sess_dict['bias_20'], sess_dict['thres_20'], sess_dict['lapsehigh_20'], sess_dict['lapselow_20'] = \
-                    (np.nan, np.nan, np.nan, np.nan)
-                sess_dict['bias_80'], sess_dict['thres_80'], sess_dict['lapsehigh_80'], sess_dict['lapselow_80'] = \
-                    (np.nan, np.nan, np.nan, np.nan)
-            else:
-                sess_dict['bias_50'], sess_dict['thres_50'], sess_dict['lapsehigh_50'], sess_dict['lapselow_50'] = \
-                    training.compute_psychometric(trials, block=0.5)
-                sess_dict['bias_20'], sess_dict['thres_20'], sess_dict['lapsehigh_20'], sess_dict['lapselow_20'] = \
-                    training.compute_psychometric(trials, block=0.2)
-                sess_dict['bias_80'], sess_dict['thres_80'], sess_dict['lapsehigh_80'], sess_dict['lapselow_80'] = \
-                    training.compute_psychometric(trials, block=0.8)
-
-            sess_dict['performance_easy'] = training.compute_performance_easy(trials)
-            sess_dict['reaction_time'] = training.compute_median_reaction_time(trials)
-            sess_dict['n_trials'] = training.compute_n_trials(trials)
-            sess_dict['sess_duration'], sess_dict['n_delay'], sess_dict['location'] = \
-                compute_session_duration_delay_location(session_path)
+            sess_dict.update(summary)
             sess_dict['training_status'] = 'not_computed'
 
         sess_dicts.append(sess_dict)
@@ -392,12 +567,10 @@ def get_training_info_for_session(session_paths, one, force=True):
 
     if len(sess_dicts) > 1 and len(set(protocols)) == 1:  # Only if all protocols are the same
         print(f'{len(sess_dicts)} sessions being combined for date {sess_dicts[0]["date"]}')
-        combined_trials = load_combined_trials(session_paths, one, force=force)
+        combined_trials = load_combined_trials(session_paths, one, force=force, trials_cache=trials_cache)
         performance, contrasts, _ = training.compute_performance(combined_trials, prob_right=True)
-        psychs = {}
-        psychs['50'] = training.compute_psychometric(trials, block=0.5)
-        psychs['20'] = training.compute_psychometric(trials, block=0.2)
-        psychs['80'] = training.compute_psychometric(trials, block=0.8)
+        psychs = dict(zip(['50', '20', '80'], training.compute_psychometric_batch(
+            [combined_trials] * 3, blocks=[0.5, 0.2, 0.8])))
 
         performance_easy = training.compute_performance_easy(combined_trials)
         reaction_time = training.compute_median_reaction_time(combined_trials)
@@ -33,6 +33,7 @@ Run the QC for all cameras
 >>> qcs['left'].metrics  # Dict of checks and outcomes for left camera
 """
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from inspect import getmembers, isfunction
 from pathlib import Path
 from itertools import chain
@@ -125,6 +126,7 @@ class CameraQC(base.QC):
         the remote source.
         :param log: A logging.Logger instance, if None the 'ibllib' logger is used
         :param one: An ONE instance for fetching and setting the QC on Alyx
+        :param n_threads: The number of threads used to compute the frame features
         """
         # When an eid is provided, we will download the required data by default (if necessary)
         download_data = not is_session_path(session_path_or_eid)
@@ -133,6 +135,7 @@ class CameraQC(base.QC):
         self.n_samples = kwargs.pop('n_samples', 100)
         self.sync_collection = kwargs.pop('sync_collection', None)
         self.sync = kwargs.pop('sync_type', None)
+        self.n_threads = kwargs.pop('n_threads', 4)
         super().__init__(session_path_or_eid, **kwargs)
 
         # Data
@@ -155,6 +158,7 @@ class CameraQC(base.QC):
                 'frame_samples', 'timestamps', 'camera_times', 'bonsai_times')
         self.data = Bunch.fromkeys(keys)
         self.frame_samples_idx = None
+        self._frame_features = {}  # cache of per-frame features of the frame samples
 
         # QC outcomes map
         self.metrics = None
@@ -479,14 +483,21 @@ class CameraQC(base.QC):
         outcome = next(k for k, v in base.CRITERIA.items() if v == code)
 
         if update:
-            extended = {
-                k: 'NOT_SET' if v is None else v
-                for k, v in self.metrics.items()
-            }
-            self.update_extended_qc(extended)
-            self.update(outcome, namespace)
+            self.update_metrics(outcome)
         return outcome, self.metrics
 
+    def update_metrics(self, outcome):
+        """
+        Updates the session QC and extended QC fields on Alyx with the computed metrics
+        :param outcome: the overall outcome of the QC checks
+        """
+        extended = {
+            k: 'NOT_SET' if v is None else v
+            for k, v in self.metrics.items()
+        }
+        self.update_extended_qc(extended)
+        self.update(outcome, f'video{self.label.capitalize()}')
+
     def remove_check(self, checks):
         if len(self.checks_to_remove) == 0:
             return checks
@@ -497,6 +508,28 @@ class CameraQC(base.QC):
                 checks.pop(idx)
             return checks
 
+    def frame_features(self, key, fcn, frames):
+        """
+        Computes a feature for each frame, fcn(frame), in a thread pool (OpenCV releases the GIL).
+        The features of the frame samples are cached by key so that the checks share them.
+
+        :param key: A hashable identifying the feature and its parameters
+        :param fcn: A function of a single frame
+        :param frames: An array of frames
+        :return: A list of features, one per frame
+        """
+        cached = self._frame_features.get(key)
+        if cached is not None and cached[0] is frames:
+            return cached[1]
+        if self.n_threads > 1 and len(frames) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                features = list(executor.map(fcn, frames))
+        else:
+            features = [fcn(frame) for frame in frames]
+        if frames is self.data['frame_samples']:
+            self._frame_features[key] = (frames, features)
+        return features
+
     def check_brightness(self, bounds=(40, 200), max_std=20, roi=True, display=False):
         """Check that the video brightness is within a given range
         The mean brightness of each frame must be with the bounds provided, and the standard
@@ -768,7 +801,8 @@ class CameraQC(base.QC):
         ####
         ref_h = cv2.calcHist([refs[0]], [0], None, [256], [0, 256])
         frames = refs if test else self.data['frame_samples']
-        hists = [cv2.calcHist([x], [0], None, [256], [0, 256]) for x in frames]
+        hists = self.frame_features(
+            'calcHist', lambda x: cv2.calcHist([x], [0], None, [256], [0, 256]), frames)
         corr = np.array([cv2.compareHist(test_h, ref_h, cv2.HISTCMP_CORREL) for test_h in hists])
         if pct_thresh:
             corr *= 100
@@ -892,8 +926,6 @@ class CameraQC(base.QC):
             img = np.empty((n, *ref.shape), dtype=np.uint8)
             for i, k in enumerate(kernal_sz):
                 img[i] = ref.copy() if k == 0 else cv2.blur(ref, (k, k))
-            if equalize:
-                [cv2.equalizeHist(x, x) for x in img]
             if display:
                 # Plot blurred images
                 f, axes = plt.subplots(1, len(kernal_sz))
@@ -904,14 +936,37 @@ class CameraQC(base.QC):
             # Sub-sample the frame samples
             idx = np.unique(np.linspace(0, len(self.data['frame_samples']) - 1, n, dtype=int))
             img = self.data['frame_samples'][idx]
-            if equalize:
-                [cv2.equalizeHist(x, x) for x in img]
 
-        # A measure of the sharpness effectively taking the second derivative of the image
-        lpc_var = np.empty((min(n, len(img)), len(roi)))
-        for i, frame in enumerate(img[::-1]):
+        # Second test is to highpass with dft
+        h, w = img.shape[1:]
+        cX, cY = w // 2, h // 2
+        sz = 60  # Seems to be the magic number for high pass
+        mask = np.ones((h, w, 2), bool)
+        mask[cY - sz:cY + sz, cX - sz:cX + sz] = False
+
+        def high_pass(frame):
+            dft = cv2.dft(np.float32(frame), flags=cv2.DFT_COMPLEX_OUTPUT)
+            f_shift = np.fft.fftshift(dft) * mask  # Shift & remove low frequencies
+            f_ishift = np.fft.ifftshift(f_shift)  # Shift back
+            filt_frame = cv2.idft(f_ishift)  # Reconstruct
+            filt_frame = cv2.magnitude(filt_frame[..., 0], filt_frame[..., 1])
+            # Re-normalize to 8-bits to make threshold simpler
+            img_back = cv2.normalize(filt_frame, None, alpha=0, beta=256,
+                                     norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            return dft, img_back
+
+        def focus_features(frame):
+            """Returns the Laplacian variance per ROI and the mean high-passed brightness of a frame"""
+            if equalize:
+                cv2.equalizeHist(frame, frame)
+            # A measure of the sharpness effectively taking the second derivative of the image
             lpc = cv2.Laplacian(frame, cv2.CV_16S, ksize=1)
-            lpc_var[i] = [lpc[mask].var() for mask in roi]
+            return [lpc[r].var() for r in roi], np.mean(high_pass(frame)[1])
+
+        # the frames are a copy of the frame samples, equalized in place, hence not cached
+        features = self.frame_features(None, focus_features, img[::-1])
+        lpc_var = np.array([x[0] for x in features]).reshape(len(img), len(roi))
+        filt_mean = np.array([x[1] for x in features])
 
         if display:
             # Plot the first sample image
@@ -938,38 +993,23 @@ class CameraQC(base.QC):
             plt.tight_layout()
             plt.legend()
 
-        # Second test is to highpass with dft
-        h, w = img.shape[1:]
-        cX, cY = w // 2, h // 2
-        sz = 60  # Seems to be the magic number for high pass
-        mask = np.ones((h, w, 2), bool)
-        mask[cY - sz:cY + sz, cX - sz:cX + sz] = False
-        filt_mean = np.empty(len(img))
-        for i, frame in enumerate(img[::-1]):
-            dft = cv2.dft(np.float32(frame), flags=cv2.DFT_COMPLEX_OUTPUT)
-            f_shift = np.fft.fftshift(dft) * mask  # Shift & remove low frequencies
-            f_ishift = np.fft.ifftshift(f_shift)  # Shift back
-            filt_frame = cv2.idft(f_ishift)  # Reconstruct
-            filt_frame = cv2.magnitude(filt_frame[..., 0], filt_frame[..., 1])
-            # Re-normalize to 8-bits to make threshold simpler
-            img_back = cv2.normalize(filt_frame, None, alpha=0, beta=256,
-                                     norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-            filt_mean[i] = np.mean(img_back)
-            if i == len(img) - 1 and display:
-                # Plot Fourier transforms
-                f = plt.figure()
-                gs = f.add_gridspec(2, 3)
-                self.imshow(img[0], ax=f.add_subplot(gs[0, 0]), title='Original frame')
-                dft_shift = np.fft.fftshift(dft)
-                magnitude = 20 * np.log(cv2.magnitude(dft_shift[..., 0], dft_shift[..., 1]))
-                self.imshow(magnitude, ax=f.add_subplot(gs[0, 1]), title='Magnitude spectrum')
-                self.imshow(img_back, ax=f.add_subplot(gs[0, 2]), title='Filtered frame')
-                ax = f.add_subplot(gs[1, :])
-                ax.plot(filt_mean)
-                ax.axhline(threshold[1], 0, n, linestyle=':', color='r', label='lower threshold')
-                ax.set(xlabel='Frame sample', ylabel='Mean of filtered frame')
-                f.suptitle('Discrete Fourier Transform')
-                plt.show()
+        if display:
+            dft, img_back = high_pass(img[0])
+            # Plot Fourier transforms
+            f = plt.figure()
+            gs = f.add_gridspec(2, 3)
+            self.imshow(img[0], ax=f.add_subplot(gs[0, 0]), title='Original frame')
+            dft_shift = np.fft.fftshift(dft)
+            magnitude = 20 * np.log(cv2.magnitude(dft_shift[..., 0], dft_shift[..., 1]))
+            self.imshow(magnitude, ax=f.add_subplot(gs[0, 1]), title='Magnitude spectrum')
+            self.imshow(img_back, ax=f.add_subplot(gs[0, 2]), title='Filtered frame')
+            ax = f.add_subplot(gs[1, :])
+            ax.plot(filt_mean)
+            ax.axhline(threshold[1], 0, n, linestyle=':', color='r', label='lower threshold')
+            ax.set(xlabel='Frame sample', ylabel='Mean of filtered frame')
+            f.suptitle('Discrete Fourier Transform')
+            plt.show()
+
         passes = np.all(lpc_var > threshold[0]) or np.all(filt_mean > threshold[1])
         return 'PASS' if passes else 'FAIL'
 
@@ -996,13 +1036,15 @@ class CameraQC(base.QC):
 
         frames = refs if test else self.data['frame_samples']
         template = refs[0][tuple(slice(*r) for r in roi)]
-        top_left = []  # [(x1, y1), ...]
-        for frame in frames:
+
+        def match_template(frame):
             res = cv2.matchTemplate(frame, template, metric)
             min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
             # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
-            top_left.append(min_loc if metric < 2 else max_loc)
+            return min_loc if metric < 2 else max_loc
             # bottom_right = (top_left[0] + w, top_left[1] + h)
+        key = ('matchTemplate', tuple(map(tuple, roi)), metric, hash(template.tobytes()))
+        top_left = self.frame_features(key, match_template, frames)  # [(x1, y1), ...]
         return top_left, roi, template
 
     @staticmethod
@@ -1282,7 +1324,18 @@ def run_all_qc(session, cameras=('left', 'right', 'body'), **kwargs):
 
     run_args = {k: kwargs.pop(k) for k in ('download_data', 'extract_times', 'update')
                 if k in kwargs.keys()}
+    update = run_args.pop('update', False)
+    # the ONE instance is shared by the cameras and isn't thread safe: the data are loaded and the
+    # Alyx fields updated sequentially, only the checks, dominated by video decoding and OpenCV, run
+    # concurrently
     for camera in cameras:
         qc[camera] = CamQC(session, camera, **kwargs)
-        qc[camera].run(**run_args)
+        qc[camera].load_data(**run_args)
+    with ThreadPoolExecutor(max_workers=max(len(cameras), 1)) as executor:
+        futures = {camera: executor.submit(qc[camera].run, update=False) for camera in cameras}
+        outcomes = {camera: future.result()[0] for camera, future in futures.items()}
+    if update:
+        for camera in cameras:
+            if qc[camera].metrics:  # no metrics are computed when the data are missing
+                qc[camera].update_metrics(outcomes[camera])
     return qc
@@ -72,6 +72,55 @@ class TestSyncExtraction(unittest.TestCase):
                 ephys_fpga.extract_sync(tdir)
                 self.assertEqual(1, len(log.output))
                 self.assertIn('SGLX sync found', log.output[0])
+            # the sync index is written next to the sync files and is not part of the outputs
+            self.assertFalse(any('syncIndex' in f.name for f in files))
+            label = spikeglx.glob_ephys_files(tdir)[0].label
+            self.assertTrue(next(ses_path.glob('_spikeglx_syncIndex.order*.npy')).exists())
+            sync_index = ephys_fpga.SyncIndex.load(syncs[0], bin_file.parent, parts=label)
+            for ch in range(nidq['sync_depth']):
+                np.testing.assert_array_equal(sync_index.fronts(ch).times,
+                                              ephys_fpga.get_sync_fronts(syncs[0], ch).times)
+
+
+class TestSyncIndex(unittest.TestCase):
+
+    def test_sync_fronts(self):
+        rng = np.random.default_rng(12)
+        n = 5000
+        sync = {'times': np.sort(rng.uniform(0, 100, n)),
+                'channels': rng.integers(0, 16, n).astype(float),
+                'polarities': rng.choice([-1., 1.], n)}
+        sync_index = ephys_fpga.SyncIndex(sync)
+        for ch in [0, 3, 15, 16]:
+            for tmin, tmax in [(None, None), (10.5, None), (None, 42.), (sync['times'][12], sync['times'][1000])]:
+                expected = ephys_fpga.get_sync_fronts(sync, ch, tmin=tmin, tmax=tmax)
+                fronts = ephys_fpga.get_sync_fronts(sync_index, ch, tmin=tmin, tmax=tmax)
+                np.testing.assert_array_equal(fronts.times, expected.times)
+                np.testing.assert_array_equal(fronts.polarities, expected.polarities)
+        # unsorted times are supported as well
+        isort = rng.permutation(n)
+        sync_index = ephys_fpga.SyncIndex({k: sync[k][isort] for k in sync})
+        np.testing.assert_array_equal(sync_index.fronts(3, tmin=10.5).times,
+                                      ephys_fpga.get_sync_fronts(sync, 3, tmin=10.5).times)
+        # save and reload, an index that doesn't match the sync is recomputed
+        with tempfile.TemporaryDirectory() as tdir:
+            sync_index = ephys_fpga.SyncIndex(sync)
+            sync_index.save(tdir)
+            np.testing.assert_array_equal(ephys_fpga.SyncIndex.load(sync, tdir).order, sync_index.order)
+            np.save(next(Path(tdir).glob('*.npy')), np.arange(n))
+            with self.assertLogs(ephys_fpga._logger, level='WARNING'):
+                reloaded = ephys_fpga.SyncIndex.load(sync, tdir)
+            np.testing.assert_array_equal(reloaded.order, sync_index.order)
+            # an index sorting the channels but not the times within a channel is recomputed too
+            stale = sync_index.order.copy()
+            stale[:2] = stale[1::-1]
+            # as well as an index repeating fronts
+            repeated = np.r_[sync_index.order[:1], sync_index.order[:-1]]
+            for order in (stale, repeated):
+                np.save(next(Path(tdir).glob('*.npy')), order)
+                with self.assertLogs(ephys_fpga._logger, level='WARNING'):
+                    reloaded = ephys_fpga.SyncIndex.load(sync, tdir)
+                np.testing.assert_array_equal(reloaded.order, sync_index.order)
 
 
 class TestIblChannelMaps(unittest.TestCase):
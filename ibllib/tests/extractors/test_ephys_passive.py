@@ -27,6 +27,26 @@ class TestsPassiveExtractor(unittest.TestCase):
         )
         self.assertTrue(np.array_equal(Tq, Xq))
 
+    def test_get_spacer_times(self):
+        meta = passive._load_passive_stim_meta()
+        spacer_template = np.array(meta['VISUAL_STIM_0']['ttl_frame_nums'], dtype=np.float32) / passive.FRAME_FS
+        # random frame2ttl flips with 3 spacers inserted
+        np.random.seed(42)
+        ttl, t0, spacer_middles = ([], 0, [])
+        for i in range(3):
+            ttl.append(t0 + np.cumsum(np.random.uniform(.02, 2, 500)))
+            t0 = ttl[-1][-1] + 5
+            ttl.append(t0 + spacer_template)
+            spacer_middles.append(t0 + spacer_template[len(spacer_template) // 2 - 1])
+            t0 = ttl[-1][-1] + 5
+        ttl = np.concatenate(ttl)
+        spacer_times, conv_dttl = passive._get_spacer_times(
+            spacer_template=spacer_template, jitter=3 / passive.FRAME_FS, ttl_signal=ttl, t_quiet=40)
+        self.assertEqual(conv_dttl.size, ttl.size + spacer_template.size - 7)
+        self.assertEqual(spacer_times.shape, (3, 2))
+        np.testing.assert_allclose(np.diff(spacer_times, axis=1), np.max(spacer_template) + 80)
+        np.testing.assert_allclose(np.mean(spacer_times, axis=1), spacer_middles, rtol=1e-6)
+
     def tearDown(self):
         pass
 
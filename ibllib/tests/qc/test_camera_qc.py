@@ -2,6 +2,8 @@ import unittest
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import logging
+import threading
+from unittest import mock
 
 import numpy as np
 import matplotlib
@@ -10,7 +12,7 @@ from one.api import ONE
 from iblutil.util import Bunch
 
 from ibllib.tests import TEST_DB
-from ibllib.qc.camera import CameraQC, get_task_collection
+from ibllib.qc.camera import CameraQC, get_task_collection, run_all_qc
 from ibllib.io.raw_data_loaders import load_camera_ssv_times
 from ibllib.tests.fixtures import utils
 
@@ -192,6 +194,19 @@ class TestCameraQC(unittest.TestCase):
         thr = [ln._y[0] for ln in plt.figure(fig).axes[2].lines[1:]]
         self.assertCountEqual(thr, thresh, 'unexpected thresholds in figure')
 
+    def test_frame_features(self):
+        self.qc.data['frame_samples'] = self.qc.load_reference_frames('left')
+        top_left, *_ = self.qc.find_face()
+        self.assertEqual(1, len(self.qc._frame_features))
+        # the template matching of the frame samples is cached
+        self.assertIs(top_left, self.qc.find_face()[0])
+        # the results don't depend on the number of threads
+        self.qc.n_threads = 1
+        self.assertEqual(top_left, self.qc.find_face(test=True)[0])
+        # new frame samples invalidate the cache
+        self.qc.data['frame_samples'] = self.qc.data['frame_samples'][::-1].copy()
+        self.assertEqual(top_left[::-1], self.qc.find_face()[0])
+
     def test_check_resolution(self):
         self.qc.data['video'] = {'width': 1280, 'height': 1024}
         self.assertEqual('PASS', self.qc.check_resolution())
@@ -279,6 +294,29 @@ class TestCameraQC(unittest.TestCase):
         with self.assertRaises(AssertionError):
             self.qc.ensure_required_data()
 
+    def test_run_all_qc(self):
+        """Test for ibllib.qc.camera.run_all_qc"""
+        calls = []
+
+        def record(name):
+            def fcn(qc, *args, **kwargs):
+                calls.append((name, qc.label, threading.current_thread()))
+                qc.metrics = {f'_video{qc.label.capitalize()}_foo': 'PASS'}
+                return 'PASS', qc.metrics
+            return fcn
+
+        with mock.patch.object(CameraQC, 'load_data', record('load_data')), \
+                mock.patch.object(CameraQC, 'run', record('run')), \
+                mock.patch.object(CameraQC, 'update_metrics', record('update_metrics')):
+            qcs = run_all_qc(self.session_path, cameras=('left', 'right'), one=self.one,
+                             update=True, download_data=False, stream=False)
+        self.assertCountEqual(['left', 'right'], qcs.keys())
+        # the data loading and Alyx updates use the shared ONE instance in the calling thread
+        for name in ('load_data', 'update_metrics'):
+            labels = [label for n, label, thread in calls if n == name and thread is threading.current_thread()]
+            self.assertEqual(['left', 'right'], labels)
+        self.assertEqual(2, sum(n == 'run' for n, *_ in calls))
+
     def test_get_task_collection(self):
         """Test for ibllib.qc.camera.get_task_collection"""
         params = {'version': '1.0.0', 'tasks': [
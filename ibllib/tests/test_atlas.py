@@ -1,12 +1,15 @@
 import unittest
+import tempfile
+from pathlib import Path
 
+import nrrd
 import numpy as np
 import matplotlib.pyplot as plt
 
 from ibllib.atlas import (BrainCoordinates, cart2sph, sph2cart, Trajectory,
                           Insertion, ALLEN_CCF_LANDMARKS_MLAPDV_UM, AllenAtlas)
 from ibllib.atlas.regions import BrainRegions, FranklinPaxinosRegions
-from ibllib.atlas.plots import prepare_lr_data, reorder_data
+from ibllib.atlas.plots import prepare_lr_data, reorder_data, compute_volume_from_points
 from iblutil.numerical import ismember
 
 
@@ -44,6 +47,37 @@ class TestBrainRegions(unittest.TestCase):
         d = self.brs.descendants(ids=leaves['id'])
         self.assertTrue(np.all(np.sort(leaves['id']) == np.sort(d['id'])))
 
+    def test_nested_sets(self):
+        br = self.brs
+        tin, tout = br._nested_sets()
+        # the entry numbers are a permutation and each region interval contains its own entry
+        np.testing.assert_array_equal(np.sort(tin), np.arange(br.id.size))
+        self.assertTrue(np.all((tin < tout) & (tout <= br.id.size)))
+        # the interval of each region with a parent is nested in the interval of its parent
+        pmask, iparent = ismember(br.parent, br.id)
+        ichild = np.where(pmask)[0]
+        self.assertTrue(np.all(tin[iparent] < tin[ichild]))
+        self.assertTrue(np.all(tout[ichild] <= tout[iparent]))
+        # descendants of several regions are the union of the descendants
+        ids = np.array([453, -688, 12993])
+        _, inds = br.descendants(ids, return_indices=True)
+        expected = np.unique(np.concatenate([br.descendants(i, return_indices=True)[1] for i in ids]))
+        np.testing.assert_array_equal(inds, expected)
+        _, inds = br.ancestors(ids, return_indices=True)
+        expected = np.unique(np.concatenate([br.ancestors(i, return_indices=True)[1] for i in ids]))
+        np.testing.assert_array_equal(inds, expected)
+
+    def test_lookup_tables(self):
+        # values that are not found are dropped, duplicates are kept in the query order
+        inds = self.brs._find_inds(['CA3', 'foo', 'VM', 'CA3'], 'acronym')
+        np.testing.assert_array_equal(self.brs.acronym[inds], ['CA3', 'VM', 'CA3'])
+        np.testing.assert_array_equal(self.brs.id[inds], [463, 685, 463])
+        # the first region is returned for lateralized acronyms, all regions are in the groups
+        lookup = self.brs._lookup_table('acronym', 'Beryl-lr')
+        igroup = lookup.groups[lookup.index.get_loc('CA3')]
+        np.testing.assert_array_equal(igroup, np.where(self.brs.acronym[self.brs.mappings['Beryl-lr']] == 'CA3')[0])
+        self.assertEqual(lookup.first[lookup.index.get_loc('CA3')], igroup[0])
+
     def test_ancestors_descendants_indices(self):
         br = self.brs
         tpath = np.array([997, 8, 567, 688, 695, 315, 453, 12993])
@@ -316,6 +350,51 @@ class TestAtlas(unittest.TestCase):
         self.assertTrue(self.ba.regions.volume.shape == self.ba.regions.acronym.shape)
 
 
+class TestAtlasCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.hist_path = Path(self.tmp.name)
+        # small 50um volumes (ml, dv, ap) on disk, wide enough in ml to contain Bregma
+        shape = (240, 12, 6)
+        label = np.zeros(shape, dtype=np.uint32)
+        label[20:220, 3:9, 1:5] = 997
+        label[100:140, 4:8, 2:4] = 8
+        image = np.random.default_rng(0).integers(0, 500, shape).astype(np.uint16)
+        nrrd.write(str(self.hist_path.joinpath('average_template_50.nrrd')), image, index_order='C')
+        nrrd.write(str(self.hist_path.joinpath('annotation_50.nrrd')), label, index_order='C')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_volume_and_surface_cache(self):
+        ba = AllenAtlas(res_um=50, hist_path=self.hist_path)
+        self.assertTrue(self.hist_path.joinpath('average_template_50.npy').exists())
+        self.assertTrue(self.hist_path.joinpath('annotation_50_lut_v01.npy').exists())
+        # the raw annotations are only read once to compute the remapped volume and aren't cached
+        self.assertFalse(self.hist_path.joinpath('annotation_50.npy').exists())
+        self.assertIsInstance(ba.label, np.memmap)
+        ba.compute_surface()
+        self.assertTrue(self.hist_path.joinpath('annotation_50_lut_v01_surface.npy').exists())
+        # the second instance reads the memory mapped volumes and the cached surface
+        ba2 = AllenAtlas(res_um=50, hist_path=self.hist_path)
+        self.assertIsInstance(ba2.image, np.memmap)
+        np.testing.assert_array_equal(ba.image, ba2.image)
+        np.testing.assert_array_equal(ba.label, ba2.label)
+        ba2.compute_surface()
+        self.assertIsInstance(ba2.surface, np.memmap)
+        for k in ('top', 'bottom', 'surface', 'srf_xyz'):
+            np.testing.assert_array_equal(getattr(ba, k), getattr(ba2, k))
+        # the surface is the same as computed from the in memory label volume
+        ba3 = AllenAtlas(res_um=50, hist_path=self.hist_path)
+        ba3._surface_cache = None
+        ba3.label = np.array(ba3.label)
+        ba3.compute_surface()
+        for k in ('top', 'bottom', 'surface', 'srf_xyz'):
+            np.testing.assert_array_equal(getattr(ba, k), getattr(ba3, k))
+        self.assertTrue(np.sum(ba.surface) > 0)
+
+
 class TestAtlasPlots(unittest.TestCase):
 
     @classmethod
@@ -352,6 +431,35 @@ class TestAtlasPlots(unittest.TestCase):
         assert im.get_array().shape == (self.ba.bc.ny, self.ba.bc.nx, 3)
         ax.clear()
 
+    def test_compute_volume_from_points(self):
+        from scipy.ndimage import gaussian_filter
+        from scipy.stats import binned_statistic
+        ba = self.ba
+        rng = np.random.default_rng(4)
+        xyz = np.c_[rng.uniform(-.002, .002, 500), rng.uniform(-.004, 0, 500), rng.uniform(-.004, -.001, 500)]
+        values = rng.uniform(size=500)
+        nvox = ba.image.size
+        idx = ba._lookup(xyz)
+        sigma = 100 / (np.sqrt(8 * np.log(2)) * ba.res_um)
+        for aggr, vals in [('sum', None), ('mean', values)]:
+            # dense computation on the full volume
+            if vals is None:
+                expected = np.bincount(idx, minlength=nvox)
+            else:
+                expected = binned_statistic(idx, vals, range=[0, nvox], statistic=aggr, bins=nvox).statistic
+                expected[np.isnan(expected)] = 0
+            expected = gaussian_filter(expected.reshape(ba.image.shape).astype(np.float32), sigma=sigma)
+            expected[ba.label == 0] = np.nan
+            volume = compute_volume_from_points(xyz, vals, aggr=aggr, fwhm=100, ba=ba)
+            np.testing.assert_allclose(volume, expected, atol=1e-6)
+            # slices, including a slice outside of the points bounding box
+            for axis, coordinate in [(0, .001), (1, -.002), (2, -.003), (1, -.007)]:
+                vslice = compute_volume_from_points(xyz, vals, aggr=aggr, fwhm=100, ba=ba, coordinate=coordinate, axis=axis)
+                np.testing.assert_allclose(vslice, ba.slice(coordinate, axis, volume=expected), atol=1e-6)
+        # no smoothing
+        volume = compute_volume_from_points(xyz, fwhm=0, ba=ba)
+        self.assertEqual(np.nansum(volume), np.sum(ba.label.flat[idx] != 0))
+
     def tearDown(self) -> None:
         plt.close('all')
 
@@ -386,6 +494,31 @@ class TestAtlasSlicesConversion(unittest.TestCase):
         assert (np.all(aids == np.array([0])))
         assert (np.isclose(proportions, np.array([1.])))
 
+    def test_lookups_proportions_batch(self):
+        ba = AllenAtlas(res_um=25, mock=True)
+        ba.label = np.random.default_rng(42).integers(0, ba.regions.id.size, ba.label.shape).astype(np.int16)
+        # points in the volume, one of them at the edge to test the out of volume voxels
+        xyz = np.r_[ba.bc.i2xyz(np.array([[200, 250, 100], [201, 251, 150], [0, 3, 100]])), ba.bc.i2xyz([[5, 7, 9]])]
+        radius_um = 100
+        for cache_mapping in [False, True]:
+            props = ba.get_labels_proportions(xyz, radius_um=radius_um, mapping='Beryl',
+                                              cache_mapping=cache_mapping, chunk_size=3)
+            self.assertEqual(props.shape, (xyz.shape[0], ba.regions.id.size))
+            np.testing.assert_allclose(np.asarray(props.sum(axis=1)).ravel(), 1)
+            for i in range(xyz.shape[0]):
+                # brute force computation over a box of voxels around the point, clipped to the volume
+                ixyz = ba.bc.xyz2i(xyz[i])
+                ii = np.stack(np.meshgrid(*[np.arange(max(ixyz[j] - 10, 0), min(ixyz[j] + 11, ba.bc.nxyz[j]))
+                                            for j in range(3)], indexing='ij'), axis=-1).reshape(-1, 3)
+                ii = ii[np.sqrt(np.sum(((ii - ixyz) * ba.bc.dxyz * 1e6) ** 2, axis=1)) <= radius_um]
+                labs = ba.regions.mappings['Beryl'][ba.label.flat[ba._lookup_inds(ii)]]
+                ilabs, counts = np.unique(labs, return_counts=True)
+                np.testing.assert_array_equal(props[i].indices, ilabs)
+                np.testing.assert_allclose(props[i].data, counts / counts.sum())
+            aids, proportions = ba.get_labels(xyz[0], mapping='Beryl', radius_um=radius_um)
+            np.testing.assert_array_equal(aids, ba.regions.id[props[0].indices])
+            np.testing.assert_allclose(proportions, props[0].data)
+
     def test_plot_slices(self):
         axs = self.ba.plot_slices(np.array([0, -.0024, -.0038]))
         assert axs.shape == (2, 2)
@@ -514,6 +647,33 @@ class TestInsertion(unittest.TestCase):
         brain_exit = insertion.get_brain_exit(insertion.trajectory, brain_atlas)
         self.assertTrue(brain_exit[2] == brain_atlas.bc.i2z(104))
 
+    def test_get_brain_intersections(self):
+        brain_atlas = _create_mock_atlas()
+        # the mock brain is a slab spanning the dv indices 100 to 104, the last insertion is outside of the volume
+        x = np.array([0, 1e-3, 2e-3, 1])
+        y = np.array([0, -1e-3, -2e-3, 0])
+        z = np.zeros(4)
+        phi = np.array([0, 45, 180, 0])
+        theta = np.array([0, 10, 30, 0])
+        depth = np.array([4e-3, 4e-3, 5e-3, 4e-3])
+        res = Insertion.get_brain_intersections(x, y, z, phi, theta, depth, brain_atlas)
+        for i in range(3):
+            ins = Insertion(x=x[i], y=y[i], z=z[i], phi=phi[i], theta=theta[i], depth=depth[i])
+            np.testing.assert_allclose(res.tip[i], ins.tip)
+            # the intersections lie on the trajectory, within one voxel of the surface voxels
+            np.testing.assert_allclose(ins.trajectory.mindist(res.entry[i:i + 1]), 0, atol=1e-12)
+            self.assertAlmostEqual(res.entry[i, 2], brain_atlas.bc.i2z(99.5))
+            self.assertAlmostEqual(res.exit[i, 2], brain_atlas.bc.i2z(104.5))
+            self.assertLess(np.linalg.norm(res.entry[i] - ins.get_brain_entry(ins.trajectory, brain_atlas)), 50e-6)
+            self.assertLess(np.linalg.norm(res.exit[i] - ins.get_brain_exit(ins.trajectory, brain_atlas)), 50e-6)
+            # the voxels crossed are face connected and the vertical insertion crosses the whole dv axis
+            ixyz = np.c_[np.unravel_index(res.voxels[res.indptr[i]:res.indptr[i + 1]], brain_atlas.label.shape)]
+            np.testing.assert_array_equal(np.sum(np.abs(np.diff(ixyz, axis=0)), axis=1), 1)
+        self.assertEqual(res.indptr[1], brain_atlas.bc.nz)
+        self.assertEqual(res.indptr[4], res.voxels.size)
+        self.assertEqual(res.indptr[4], res.indptr[3])
+        self.assertTrue(np.all(np.isnan(res.entry[3])) and np.all(np.isnan(res.exit[3])))
+
 
 class TestTrajectory(unittest.TestCase):
 
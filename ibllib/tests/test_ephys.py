@@ -1,5 +1,6 @@
 # Mock dataset
 import unittest
+from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import numpy as np
@@ -7,9 +8,10 @@ import scipy.signal
 
 from one.api import ONE
 import neuropixel
+import spikeglx
 from neurodsp import voltage
 
-from ibllib.ephys import ephysqc, spikes
+from ibllib.ephys import ephysqc, spikes, sync_probes
 from ibllib.tests import TEST_DB
 from ibllib.tests.fixtures import utils
 
@@ -167,6 +169,104 @@ class TestEphysQC(unittest.TestCase):
         self.qc._ensure_required_data()
 
 
+class TestApSamples(unittest.TestCase):
+
+    def test_ap_sample_times(self):
+        t0s = ephysqc.ap_sample_times(1000)
+        np.testing.assert_array_equal(t0s, ephysqc.TMIN + np.arange(4) * ephysqc.BATCHES_SPACING)
+        t0s = ephysqc.ap_sample_times(1000, batches_spacing=100)
+        self.assertEqual(t0s.size, 10)
+        t0s = ephysqc.ap_sample_times(1000, n_batches=24)
+        self.assertEqual(t0s.size, 24)
+        self.assertTrue(t0s[0] == ephysqc.TMIN and t0s[-1] < 1000 - ephysqc.SAMPLE_LENGTH)
+
+    def test_prefetch(self):
+        calls = []
+
+        def fcn(x):
+            calls.append(x)
+            return x * 2
+        res = []
+        for r in ephysqc._prefetch(fcn, range(10), n=3):
+            res.append(r)
+            # the reads never run more than n + 1 items ahead of the consumer
+            self.assertTrue(len(calls) <= len(res) + 4)
+        self.assertEqual(res, [x * 2 for x in range(10)])
+
+
+class TestClockSync(unittest.TestCase):
+
+    def setUp(self):
+        tprobe = np.arange(0, 4000, 20.)
+        self.sync_points = np.c_[tprobe, tprobe * (1 + 1e-5) + .3 + np.random.normal(0, 1e-5, tprobe.size)]
+        self.times = np.random.uniform(-100, 4200, 1000)
+
+    def test_interpolation(self):
+        from scipy.interpolate import interp1d
+        clock = sync_probes.ClockSync(self.sync_points)
+        for direction, (a, b) in zip(['forward', 'reverse'], [(0, 1), (1, 0)]):
+            expected = interp1d(self.sync_points[:, a], self.sync_points[:, b], fill_value='extrapolate')(self.times)
+            np.testing.assert_array_equal(clock(self.times, direction=direction), expected)
+        # in place and chunked transform
+        expected = clock.forward(self.times)
+        clock.CHUNK_SIZE = 64
+        times = self.times.copy()
+        self.assertIs(clock.forward(times, out=times), times)
+        np.testing.assert_array_equal(times, expected)
+        np.testing.assert_allclose(clock.reverse(times), self.times, rtol=1e-12)
+
+    def test_apply_sync(self):
+        with TemporaryDirectory() as td:
+            sync_file = Path(td).joinpath('_spikeglx_ephysData_g0_t0.imec0.sync.npy')
+            sync_probes.ClockSync(self.sync_points).to_file(sync_file)
+            self.assertIs(sync_probes.ClockSync.from_file(sync_file), sync_probes.ClockSync.from_file(sync_file))
+            np.testing.assert_allclose(
+                sync_probes.apply_sync(sync_file, sync_probes.apply_sync(sync_file, self.times), forward=False), self.times,
+                rtol=1e-12)
+
+    def test_sync_long_session(self):
+        tref = np.arange(0, 3600., .5)
+        tprobe = tref * (1 + 2e-5) + .1 + np.random.normal(0, 5e-6, tref.size)
+        sync_points, qc = sync_probes.sync_probe_front_times(tprobe, tref, 30000)
+        # when the session is too long to be upsampled at 300 Hz the rate is lowered
+        sync_points_, qc_ = sync_probes.sync_probe_front_times(tprobe, tref, 30000, max_samples=2 ** 17)
+        self.assertTrue(qc and qc_)
+        self.assertLess(np.max(np.abs(sync_points - sync_points_)) * 30000, .1)
+
+
+class TestRmsMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        meta_file = Path(__file__).parent.joinpath('fixtures', 'sync_ephys_fpga', 'sample3B_g0_t0.nidq.meta')
+        self.bin_file = Path(self.tempdir.name).joinpath('sample3B_g0_t0.nidq.bin')
+        # 2**17 samples per window: 25 windows makes 2 blocks, the last one being incomplete
+        spikeglx._mock_spikeglx_file(self.bin_file, meta_file, ns=2 ** 17 * 25 - 1000, nc=2, sync_depth=8, random=True)
+
+    def test_rmsmap_parallel_resume(self):
+        rms = ephysqc.rmsmap(spikeglx.Reader(self.bin_file))
+        self.assertEqual(rms['TRMS'].shape, (25, 2))
+        rms_ = ephysqc.rmsmap(spikeglx.Reader(self.bin_file), n_workers=2)
+        for k in rms:
+            np.testing.assert_allclose(rms[k], rms_[k])
+        # the checkpointed blocks are re-used on subsequent runs
+        checkpoint_dir = Path(self.tempdir.name).joinpath('checkpoint')
+        ephysqc.rmsmap(spikeglx.Reader(self.bin_file), checkpoint_dir=checkpoint_dir)
+        block_files = sorted(checkpoint_dir.glob('block_*.npz'))
+        self.assertEqual(len(block_files), 2)
+        block = dict(np.load(block_files[1]))
+        block['TRMS'][:] = 0
+        np.savez(block_files[1], **block)
+        rms_ = ephysqc.rmsmap(spikeglx.Reader(self.bin_file), n_workers=2, checkpoint_dir=checkpoint_dir)
+        np.testing.assert_array_equal(rms_['TRMS'][:ephysqc.RMS_BLOCK_NWIN], rms['TRMS'][:ephysqc.RMS_BLOCK_NWIN])
+        self.assertTrue(np.all(rms_['TRMS'][ephysqc.RMS_BLOCK_NWIN:] == 0))
+        # the checkpoint folder is removed once the output files are written
+        files = ephysqc.extract_rmsmap(spikeglx.Reader(self.bin_file), n_workers=2)
+        self.assertEqual(len(files), 4)
+        self.assertFalse(self.bin_file.parent.joinpath('rmsmap_nidq_checkpoint').exists())
+
+
 class TestDetectSpikes(unittest.TestCase):
 
     def test_spike_detection(self):
@@ -209,6 +309,32 @@ class TestDetectSpikes(unittest.TestCase):
         assert np.mean(xcor > .8) > .95
         assert np.nanmedian(xcor) > .99
 
+    def test_spike_detection_deduplication(self):
+        """
+        Compares the single pass de-duplication with the iterative greedy algorithm on noisy data
+        """
+        fs = 30000
+        h = neuropixel.trace_header(version=1)
+        data = np.random.default_rng(42).normal(size=(3000, h['x'].size)).astype(np.float32)
+        detects = spikes.detection(data, fs=fs, h=h, detect_threshold=-3.5)
+        # reference iterative implementation
+        inds, indtr = np.where(data < -3.5)
+        time, amp, ispike = (inds / fs, data[inds, indtr], np.zeros(inds.size))
+        amp_order = np.argsort(amp)
+        hxy = h['x'] + 1j * h['y']
+        spike_id = 1
+        while np.any(ispike == 0):
+            imax = amp_order[np.where(ispike[amp_order] == 0)[0][0]]
+            itlims = np.arange(*np.searchsorted(time, time[imax] + np.array([-1, 1]) * .002))
+            ispike[itlims[np.abs(hxy[indtr[itlims]] - hxy[indtr[imax]]) < 70]] = -1
+            ispike[imax] = spike_id
+            spike_id += 1
+        self.assertTrue(detects.time.size > 100)
+        np.testing.assert_array_equal(detects.time, time[ispike > 0])
+        np.testing.assert_array_equal(detects.trace, indtr[ispike > 0])
+        np.testing.assert_array_equal(detects.amp, amp[ispike > 0])
+        np.testing.assert_array_equal(detects.ispike, ispike[ispike > 0])
+
 
 class TestDetectBadChannels(unittest.TestCase):
 
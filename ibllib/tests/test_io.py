@@ -7,6 +7,7 @@ from pathlib import Path
 import sys
 import logging
 
+import cv2
 import numpy as np
 from one.api import ONE
 from iblutil.io import params
@@ -294,6 +295,26 @@ class TestsRawDataLoaders(unittest.TestCase):
         self.assertTrue(fd.dtypes.to_dict() == parsed_dtypes)
         self.assertTrue(all([x == np.int64 for x in fd_raw.dtypes]))
 
+    def test_load_camera_frameData_columns(self):
+        fd = raw.load_camera_frameData(self.bin_session_path)
+        fc = raw.load_camera_frameData_columns(self.bin_session_path)
+        self.assertEqual(fc['embeddedGPIOPinState'].shape, (fd.shape[0], 4))
+        self.assertEqual(fc['embeddedGPIOPinState'].dtype, bool)
+        np.testing.assert_array_equal(np.vstack(fd['embeddedGPIOPinState'].values), fc['embeddedGPIOPinState'])
+        for k in ['Timestamp', 'embeddedTimeStamp', 'embeddedFrameCounter']:
+            np.testing.assert_array_equal(fd[k].values, fc[k])
+        # raw columns
+        fc_raw = raw.load_camera_frameData_columns(self.bin_session_path, raw=True)
+        fd_raw = raw.load_camera_frameData(self.bin_session_path, raw=True)
+        for k in fd_raw.columns:
+            np.testing.assert_array_equal(fd_raw[k].values, fc_raw[k])
+        # time range selection
+        t0, t1 = fd['Timestamp'].values[[2, -3]]
+        fr = raw.load_camera_frameData_columns(self.bin_session_path, time_range=(t0, t1))
+        isel = np.logical_and(fd['Timestamp'].values >= t0, fd['Timestamp'].values < t1)
+        for k in fr:
+            np.testing.assert_array_equal(fr[k], fc[k][isel])
+
     def tearDown(self):
         self.tempfile.close()
         os.unlink(self.tempfile.name)
@@ -461,6 +482,46 @@ class TestVideo(unittest.TestCase):
             video.assert_valid_label(None)
 
 
+class TestVideoFrames(unittest.TestCase):
+    """Tests for the video frames reader (no database required)"""
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.video_path = Path(tmpdir.name).joinpath('_iblrig_leftCamera.raw.mp4')
+        writer = cv2.VideoWriter(str(self.video_path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (64, 48))
+        rng = np.random.default_rng(0)
+        for i in range(120):
+            writer.write(rng.integers(0, 255, (48, 64, 3), dtype=np.uint8))
+        writer.release()
+
+    def test_get_keyframes(self):
+        keyframes = video.get_keyframes(self.video_path)
+        self.assertEqual(0, keyframes[0])
+        self.assertTrue(np.all(np.diff(keyframes) > 0) and keyframes[-1] < 120)
+        self.assertIsNone(video.get_keyframes(Path(__file__)))
+
+    def test_plan_seeks(self):
+        keyframes = np.arange(0, 1000, 100)
+        frames = np.array([5, 6, 50, 150, 160, 199, 200, 800])
+        expected = [False, False, False, True, False, False, False, True]
+        np.testing.assert_array_equal(video._plan_seeks(frames, keyframes, position=0), expected)
+        # unknown initial position
+        self.assertTrue(video._plan_seeks(frames, keyframes)[0])
+
+    def test_get_video_frames_preload(self):
+        expected = video.get_video_frames_preload(self.video_path, quiet=True)
+        self.assertEqual(expected.shape, (120, 48, 64, 3))
+        frame_numbers = [50, 3, 4, 4, 119, 13, 60, 61, 0]
+        frames = video.get_video_frames_preload(self.video_path, frame_numbers, mask=np.s_[:, :, 0], quiet=True)
+        np.testing.assert_array_equal(frames, expected[frame_numbers, :, :, 0])
+        # capture input with list output, and keyframes every 10 frames
+        frames = video.get_video_frames_preload(cv2.VideoCapture(str(self.video_path)), frame_numbers,
+                                                as_list=True, quiet=True, keyframes=np.arange(0, 120, 10))
+        for frame, i in zip(frames, frame_numbers):
+            np.testing.assert_array_equal(frame, expected[i])
+
+
 class TestSessionParams(unittest.TestCase):
     """Tests for ibllib.io.session_params module"""
 
@@ -1,9 +1,11 @@
 import json
 import logging
 import os
+import pickle
 import shutil
 import subprocess
 import tempfile
+import threading
 import unittest
 from pathlib import Path
 from unittest import mock
@@ -12,14 +14,18 @@ import numpy as np
 import datetime
 import random
 import string
+import time
 
-from one.api import ONE
+from one.api import ONE, One
+from one.webclient import AlyxClient
 import iblutil.io.params as iopar
+from iblutil.util import Bunch
 from packaging.version import Version, InvalidVersion
 
+import brainbox
 import ibllib.io.extractors.base
 import ibllib.tests.fixtures.utils as fu
-from ibllib.pipes import misc
+from ibllib.pipes import misc, local_server, tasks, training_status
 from ibllib.tests import TEST_DB
 import ibllib.pipes.scan_fix_passive_files as fix
 from ibllib.pipes.ephys_preprocessing import SpikeSorting
@@ -647,5 +653,187 @@ class TestSpikeSortingTask(unittest.TestCase):
             SpikeSorting.parse_version('version-twelve')
 
 
+class SmallTask(tasks.Task):
+    pass
+
+
+class LargeTask(tasks.Task):
+    job_size = 'large'
+    cpu = 2
+
+
+class GpuTask(tasks.Task):
+    gpu = 1
+    job_size = 'large'
+
+
+class TestTasksRunner(unittest.TestCase):
+    """Tests the concurrent scheduler of local_server.tasks_runner with a stand-in Alyx client"""
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.addCleanup(self.td.cleanup)
+        # the stand-in Alyx client only needs to resolve sessions
+        self.one = mock.MagicMock()
+        self.one.alyx.rest.side_effect = lambda *args, django='', **kwargs: [
+            {'subject': 'algernon', 'start_time': '2021-02-12T12:00:00', 'number': int(django[-1])}]
+        self.log = []
+
+        def run_alyx_task(tdict=None, session_path=None, one=None, **kwargs):
+            self.log.append(('start', tdict['id'], session_path))
+            time.sleep(.05)
+            self.log.append(('end', tdict['id'], session_path))
+            return tdict, [{'name': tdict['id']}]
+        patcher = mock.patch('ibllib.pipes.tasks.run_alyx_task', side_effect=run_alyx_task)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks.Task, '_lock_file_path', return_value=Path(self.td.name).joinpath('gpu.lock'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _tdict(tid, session, classe, parents=()):
+        return {'id': tid, 'name': classe.__name__, 'session': session, 'parents': list(parents),
+                'executable': f'ibllib.tests.test_pipes.{classe.__name__}'}
+
+    def _running(self):
+        """Returns the list of sets of running tasks after each start event"""
+        running, out = set(), []
+        for event, tid, _ in self.log:
+            if event == 'start':
+                running.add(tid)
+                out.append(set(running))
+            else:
+                running.remove(tid)
+        return out
+
+    def test_concurrent(self):
+        queue = [self._tdict('a0', 's0', LargeTask), self._tdict('a1', 's0', SmallTask, parents=['a0']),
+                 self._tdict('b0', 's1', SmallTask), self._tdict('b1', 's1', SmallTask),
+                 self._tdict('c0', 's2', GpuTask), self._tdict('d0', 's3', LargeTask),
+                 self._tdict('e0', 's4', GpuTask, parents=['b1'])]
+        dsets = local_server.tasks_runner(self.td.name, queue, one=self.one, count=10, n_workers=3, pool='thread')
+        self.assertEqual(set(d['name'] for d in dsets), set(t['id'] for t in queue))
+        # the session path is queried once per session
+        self.assertEqual(self.one.alyx.rest.call_count, 5)
+        events = [(event, tid) for event, tid, _ in self.log]
+        # parents completed before children started
+        self.assertTrue(events.index(('end', 'a0')) < events.index(('start', 'a1')))
+        self.assertTrue(events.index(('end', 'b1')) < events.index(('start', 'e0')))
+        for running in self._running():
+            # one task per session, one large job at a time and cpu slots respected
+            ses = [t[0] for t in running]
+            self.assertEqual(len(ses), len(set(ses)))
+            self.assertTrue(len(running.intersection({'a0', 'c0', 'd0', 'e0'})) <= 1)
+            self.assertTrue(sum(2 if t in ('a0', 'd0') else 1 for t in running) <= 3)
+        # several tasks ran concurrently
+        self.assertTrue(max(map(len, self._running())) > 1)
+        self.assertEqual(Path(self.log[0][2]), Path(self.td.name).joinpath('algernon', '2021-02-12', '000'))
+
+    def test_count_and_locks(self):
+        queue = [self._tdict(f'{i}', f's{i}', SmallTask) for i in range(6)]
+        dsets = local_server.tasks_runner(self.td.name, queue, one=self.one, count=2, n_workers=2, pool='thread')
+        # once the count is reached no new task starts, running tasks complete
+        self.assertEqual(len(dsets), 2)
+        # a GPU lock prevents GPU tasks from starting, the rest of the queue runs
+        tasks.Task.make_lock_file('other_task')
+        self.log = []
+        queue = [self._tdict('gpu', 's0', GpuTask), self._tdict('cpu', 's1', SmallTask)]
+        dsets = local_server.tasks_runner(self.td.name, queue, one=self.one, count=5, n_workers=2, pool='thread')
+        self.assertEqual([d['name'] for d in dsets], ['cpu'])
+
+    def test_thread_pool_client(self):
+        # ONE and Alyx clients aren't thread safe and are rejected by the thread pool
+        queue = [self._tdict('a0', 's0', SmallTask)]
+        for one in (mock.MagicMock(spec=One), mock.MagicMock(spec=AlyxClient)):
+            with self.assertRaises(ValueError):
+                local_server.tasks_runner(self.td.name, queue, one=one, n_workers=2, pool='thread')
+
+
+class TestTrainingSummaryCache(unittest.TestCase):
+
+    def setUp(self):
+        fixture = Path(brainbox.__file__).parent.joinpath('tests', 'fixtures', 'trials_test.pickle')
+        with open(fixture, 'rb') as fid:
+            self.trials = Bunch(pickle.load(fid)['2020-08-25'])
+        self.tmp = tempfile.TemporaryDirectory()
+        self.subj_path = Path(self.tmp.name).joinpath('subject')
+        self.session_path = self.subj_path.joinpath('2020-08-25', '001')
+        self.session_path.joinpath('alf').mkdir(parents=True)
+        self.session_path.joinpath('alf', '_ibl_trials.table.pqt').write_bytes(b'table')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compute_session_summary(self):
+        with mock.patch.object(training_status, 'load_trials', return_value=self.trials) as load_trials, \
+                mock.patch.object(training_status, 'compute_session_duration_delay_location',
+                                  return_value=(60, 0, 'training_rig')):
+            cache = {}
+            summary = training_status.compute_session_summary(self.session_path, 'training', None, summary_cache=cache)
+            self.assertEqual(1, load_trials.call_count)
+            self.assertIn(str(self.session_path), cache)
+            # the cache is persisted in the subject folder
+            training_status.save_summary_cache(cache, self.subj_path)
+            cache = training_status.load_summary_cache(self.subj_path)
+            cached = training_status.compute_session_summary(self.session_path, 'training', None, summary_cache=cache)
+            self.assertEqual(1, load_trials.call_count)
+            self.assertEqual(summary.keys(), cached.keys())
+            for k in summary:
+                np.testing.assert_array_equal(summary[k], cached[k])
+            # changing the trials files invalidates the summary
+            self.session_path.joinpath('alf', '_ibl_trials.table.pqt').write_bytes(b'new table')
+            training_status.compute_session_summary(self.session_path, 'training', None, summary_cache=cache)
+            self.assertEqual(2, load_trials.call_count)
+
+    def test_load_trials_cache(self):
+        with mock.patch('one.alf.io.load_object', return_value=self.trials) as load_object:
+            trials_cache = {}
+            for _ in range(3):
+                trials = training_status.load_combined_trials(
+                    [self.session_path], None, trials_cache=trials_cache)
+            self.assertEqual(1, load_object.call_count)
+            np.testing.assert_array_equal(trials['choice'], self.trials['choice'])
+
+    def test_get_training_information_for_subjects(self):
+        subj_paths = [self.subj_path, Path(self.tmp.name).joinpath('failing'), Path(self.tmp.name).joinpath('empty')]
+        subj_paths[1].joinpath('2020-08-24', '001').mkdir(parents=True)
+        subj_paths[1].joinpath('2020-08-25', '002').mkdir(parents=True)
+        subj_paths[2].mkdir()
+        self.subj_path.joinpath('2020-08-24', '001').mkdir(parents=True)
+        training_status.save_path(self.subj_path).write_text('date')
+
+        def get_latest_training_information(sess_path, one):
+            if sess_path.parts[-3] == 'failing':
+                raise ValueError('no trials')
+            return sess_path
+
+        for kwargs in (dict(n_workers=1), dict(n_workers=2, pool='thread')):
+            with self.subTest(**kwargs), \
+                    mock.patch.object(training_status, 'get_latest_training_information',
+                                      side_effect=get_latest_training_information) as latest, \
+                    self.assertLogs(training_status._logger, logging.ERROR):
+                dfs = training_status.get_training_information_for_subjects(subj_paths, None, **kwargs)
+                # the training tables are updated from the latest session of each subject
+                self.assertCountEqual([self.session_path, subj_paths[1].joinpath('2020-08-25', '002')],
+                                      [call.args[0] for call in latest.call_args_list])
+                # subjects without sessions are skipped and failed subjects are logged and skipped
+                self.assertEqual({'subject': self.session_path}, dfs)
+                self.assertTrue(training_status.save_path(self.subj_path).exists())
+        # with several threads, each one uses its own client as ONE isn't thread safe
+        one = mock.MagicMock()
+        with mock.patch.object(training_status, 'get_latest_training_information') as latest, \
+                mock.patch.object(training_status, 'worker_one', side_effect=lambda url: (url, threading.get_ident())):
+            training_status.get_training_information_for_subjects(subj_paths, one, n_workers=2, pool='thread')
+        self.assertEqual(2, latest.call_count)
+        for call in latest.call_args_list:
+            self.assertEqual(one.alyx.base_url, call.args[1][0])
+            self.assertNotEqual(threading.get_ident(), call.args[1][1])
+        # rebuild removes the training tables of the subjects
+        with mock.patch.object(training_status, 'get_latest_training_information'):
+            training_status.get_training_information_for_subjects([self.subj_path], None, rebuild=True)
+        self.assertFalse(training_status.save_path(self.subj_path).exists())
+
+
 if __name__ == "__main__":
     unittest.main(exit=False, verbosity=2)